@@ -0,0 +1,115 @@
+"""
+Ejecutor del agente: varias rondas LLM -> tools con presupuesto de pasos y de latencia.
+
+En cada paso el LLM puede pedir varias tools; las de una misma respuesta son
+independientes y corren en paralelo (las síncronas en un ThreadPoolExecutor, las
+async directamente en el event loop). El último paso permitido (o el primero que
+empieza con el presupuesto de latencia agotado) se hace SIN tools, así el modelo
+siempre termina con un texto para el cliente.
+
+Cada paso deja su contabilidad (tokens, cached tokens, latencia LLM y por tool)
+en `steps`, que server.py guarda en la metadata de message_logs.
+"""
+import asyncio
+import logging
+import time
+from concurrent.futures import Executor
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from langchain_core.messages import ToolMessage
+
+from prompts import token_usage
+
+logger = logging.getLogger(__name__)
+
+
+def _ms(start: float) -> float:
+    return round((time.perf_counter() - start) * 1000, 1)
+
+
+class AgentExecutor:
+    def __init__(self, llm, tools: List[Any], pool: Executor, max_steps: int = 4, max_seconds: float = 40.0,
+                 once_per_turn: Set[str] = frozenset(), on_response: Optional[Callable[[Any], Any]] = None):
+        self.llm_with_tools = llm.bind_tools(tools)
+        # Paso final: mismas tools declaradas (prefijo cacheable) pero prohibido llamarlas
+        self.llm_final = llm.bind_tools(tools, tool_choice="none")
+        self.pool = pool
+        self.max_steps = max(2, max_steps) # Al menos una ronda de tools + la respuesta final
+        self.max_seconds = max_seconds
+        self.once_per_turn = set(once_per_turn)
+        self.on_response = on_response
+
+    async def _run_tool(self, call: Dict, handlers: Dict[str, Callable], already_called: Set[str]) -> Dict:
+        name = call["name"]
+        start = time.perf_counter()
+        if name in self.once_per_turn and name in already_called:
+            # Nunca dos órdenes (u otra tool de efecto) en el mismo turno
+            return {"name": name, "content": f"⚠️ `{name}` ya se ejecutó en este turno. NO lo repitas; usa el resultado anterior.",
+                    "ms": 0.0, "ok": False, "skipped": True}
+        already_called.add(name)
+        handler = handlers.get(name)
+        if handler is None:
+            return {"name": name, "content": "Error", "ms": 0.0, "ok": False}
+        logger.info(f"🛠️ Tool Call: {name} {call['args']}")
+        try:
+            if asyncio.iscoroutinefunction(handler):
+                content = await handler(dict(call["args"]))
+            else:
+                loop = asyncio.get_running_loop()
+                content = await loop.run_in_executor(self.pool, handler, dict(call["args"]))
+            ok = True
+        except Exception as e:
+            logger.error(f"❌ Error ejecutando tool {name}: {e}")
+            content, ok = f"Error ejecutando {name}: {e}", False
+        return {"name": name, "content": str(content), "ms": _ms(start), "ok": ok}
+
+    async def run(self, messages: List[Any], handlers: Dict[str, Callable]) -> Dict:
+        """Corre el bucle sobre `messages` (se extiende in-place). Retorna contenido final y contabilidad.
+
+        `handlers` mapea nombre de tool -> función(args) del turno (async, o síncrona para el pool).
+        """
+        turn_start = time.perf_counter()
+        deadline = turn_start + self.max_seconds
+        steps: List[Dict] = []
+        already_called: Set[str] = set()
+        content = ""
+        stop_reason = "answer"
+
+        for n in range(1, self.max_steps + 1):
+            final_step = n == self.max_steps or time.perf_counter() >= deadline
+            if final_step and n > 1:
+                stop_reason = "max_steps" if n == self.max_steps else "latency_budget"
+            llm = self.llm_final if final_step and n > 1 else self.llm_with_tools
+
+            start = time.perf_counter()
+            response = await llm.ainvoke(messages)
+            usage = (getattr(response, "response_metadata", None) or {}).get("token_usage") or {}
+            prompt_tokens, cached_tokens = token_usage(response)
+            step = {"step": n, "llm_ms": _ms(start), "prompt_tokens": prompt_tokens, "cached_tokens": cached_tokens,
+                    "completion_tokens": usage.get("completion_tokens", 0), "total_tokens": usage.get("total_tokens", 0),
+                    "tools": []}
+            steps.append(step)
+            if self.on_response:
+                self.on_response(response)
+            messages.append(response)
+            content = response.content
+
+            tool_calls = getattr(response, "tool_calls", None) or []
+            if not tool_calls or llm is self.llm_final:
+                break
+
+            # Tools independientes de una misma respuesta: en paralelo, resultados en el orden pedido
+            results = await asyncio.gather(*[self._run_tool(call, handlers, already_called) for call in tool_calls])
+            for call, result in zip(tool_calls, results):
+                messages.append(ToolMessage(tool_call_id=call["id"], content=result["content"]))
+                step["tools"].append({k: v for k, v in result.items() if k != "content"})
+
+        return {
+            "content": content,
+            "steps": steps,
+            "stop_reason": stop_reason,
+            "total_tokens": sum(s["total_tokens"] for s in steps),
+            "prompt_tokens": sum(s["prompt_tokens"] for s in steps),
+            "cached_tokens": sum(s["cached_tokens"] for s in steps),
+            "elapsed_ms": _ms(turn_start),
+        }
@@ -1,15 +1,28 @@
 """
 🕵️‍♂️ Juez Silencioso (Auditor de Conversaciones)
 Analiza conversaciones recientes y propone reglas de mejora.
+
+- Incremental: cada teléfono tiene una marca de agua (created_at del último mensaje
+  auditado, tabla `audit_watermarks`). Sólo se re-audita si llegaron mensajes nuevos.
+- Concurrente: las llamadas al LLM corren en paralelo con un semáforo (AUDIT_CONCURRENCY).
+- Reanudable: la marca de agua se guarda apenas termina cada conversación, así si el
+  proceso se cae, la siguiente corrida sigue con las que faltaban.
+- Cada corrida reporta throughput (conversaciones/min) y tokens gastados.
+
+`main()` sigue siendo síncrona para que server.py la corra con run_in_executor.
 """
 import os
 import json
-from typing import List, Dict
+import time
+import asyncio
+import threading
+from typing import List, Dict, Iterator, Optional, Tuple
 import datetime
 from dotenv import load_dotenv
 from supabase import create_client, Client
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import SystemMessage, HumanMessage
+from conversation_stream import iter_conversations, parse_ts
 
 load_dotenv()
 
@@ -25,47 +38,26 @@ if not all([SUPABASE_URL, SUPABASE_KEY, OPENAI_API_KEY]):
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 llm = ChatOpenAI(model_name="gpt-4o", temperature=0.0) # Modelo inteligente para auditar
 
-def get_recent_conversations(days=1) -> Dict[str, List[Dict]]:
-    """Obtiene logs de los últimos N días agrupados por teléfono."""
+AUDIT_CONCURRENCY = int(os.getenv("AUDIT_CONCURRENCY", "4"))
+AUDIT_LOOKBACK_DAYS = int(os.getenv("AUDIT_LOOKBACK_DAYS", "1"))
+WATERMARKS_LOCAL_PATH = "audit_watermarks.json" # Fallback si la tabla no existe
+_run_lock = threading.Lock() # Cron y botón manual no deben auditar a la vez
+
+def get_recent_conversations(days=1) -> Iterator[Tuple[str, List[Dict]]]:
+    """Conversaciones de los últimos N días, una a una y agrupadas por teléfono (ver conversation_stream)."""
     print(f"📥 Descargando conversaciones de los últimos {days} días...")
-    
-    cutoff = (datetime.datetime.now() - datetime.timedelta(days=days)).isoformat()
-    
-    # Obtener mensajes
-    try:
-        res = supabase.table("message_logs") \
-            .select("*") \
-            .gte("created_at", cutoff) \
-            .order("created_at", desc=True) \
-            .execute()
-        
-        logs = res.data
-        conversations = {}
-        
-        for log in logs:
-            phone = log.get("phone_number")
-            if not phone: continue
-            
-            if phone not in conversations:
-                conversations[phone] = []
-            
-            conversations[phone].append({
-                "role": log.get("role"),
-                "content": log.get("content"),
-                "timestamp": log.get("created_at")
-            })
-            
-        # Ordenar cronológicamente
-        for phone in conversations:
-            conversations[phone].sort(key=lambda x: x["timestamp"])
-            
-        return conversations
-    except Exception as e:
-        print(f"❌ Error obteniendo logs: {e}")
-        return {}
+    cutoff = (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=days)).isoformat()
+    return iter_conversations(supabase, cutoff)
 
-def analyze_conversation(phone: str, messages: List[Dict]):
-    """Usa GPT-4o para auditar una conversación."""
+def token_spend(response) -> Dict[str, int]:
+    usage = getattr(response, "usage_metadata", None) or {}
+    if not usage:
+        raw = (getattr(response, "response_metadata", None) or {}).get("token_usage") or {}
+        usage = {"input_tokens": raw.get("prompt_tokens", 0), "output_tokens": raw.get("completion_tokens", 0)}
+    return {"input_tokens": usage.get("input_tokens", 0) or 0, "output_tokens": usage.get("output_tokens", 0) or 0}
+
+async def analyze_conversation(phone: str, messages: List[Dict]):
+    """Usa GPT-4o para auditar una conversación. Retorna (análisis, tokens)."""
     
     # Formatear chat como string
     chat_text = ""
@@ -103,22 +95,24 @@ def analyze_conversation(phone: str, messages: List[Dict]):
     }}
     """
     
+    tokens = {"input_tokens": 0, "output_tokens": 0}
     try:
-        response = llm.invoke([
+        response = await llm.ainvoke([
             SystemMessage(content="Eres un sistema de auditoría de calidad para IA."),
             HumanMessage(content=audit_prompt)
         ])
+        tokens = token_spend(response)
         
         content = response.content.strip()
         # Limpiar markdown json si existe
         if content.startswith("```json"):
             content = content.replace("```json", "").replace("```", "")
         
-        return json.loads(content)
+        return json.loads(content), tokens
         
     except Exception as e:
         print(f"❌ Error en análisis LLM: {e}")
-        return None
+        return None, tokens
 
 def save_learning(phone: str, analysis: Dict):
     """Guarda el aprendizaje en Supabase."""
@@ -146,16 +140,118 @@ def save_learning(phone: str, analysis: Dict):
         with open("local_agent_learnings.jsonl", "a", encoding="utf-8") as f:
             f.write(json.dumps(record, ensure_ascii=False) + "\n")
 
+# --- MARCAS DE AGUA (auditoría incremental) ---
+def load_watermarks() -> Dict[str, str]:
+    """phone -> created_at del último mensaje ya auditado (keyset por teléfono: PostgREST corta en ~1000 filas)."""
+    try:
+        marks, last_phone, page_size = {}, None, 1000
+        while True:
+            query = supabase.table("audit_watermarks").select("phone_number, last_message_at")
+            if last_phone is not None:
+                query = query.gt("phone_number", last_phone)
+            res = query.order("phone_number").limit(page_size).execute()
+            rows = res.data or []
+            marks.update({r["phone_number"]: r["last_message_at"] for r in rows})
+            if len(rows) < page_size:
+                return marks
+            last_phone = rows[-1]["phone_number"]
+    except Exception as e:
+        print(f"⚠️ No se pudo leer audit_watermarks ({e}). Usando archivo local.")
+        try:
+            with open(WATERMARKS_LOCAL_PATH, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+def save_watermark(phone: str, last_message_at: str):
+    try:
+        supabase.table("audit_watermarks").upsert({
+            "phone_number": phone,
+            "last_message_at": last_message_at,
+            "audited_at": datetime.datetime.now(datetime.timezone.utc).isoformat()
+        }).execute()
+    except Exception:
+        # Fallback local (mismo criterio que save_learning)
+        marks = {}
+        try:
+            with open(WATERMARKS_LOCAL_PATH, encoding="utf-8") as f:
+                marks = json.load(f)
+        except (OSError, ValueError):
+            pass
+        marks[phone] = last_message_at
+        with open(WATERMARKS_LOCAL_PATH, "w", encoding="utf-8") as f:
+            json.dump(marks, f)
+
+def has_new_messages(msgs: List[Dict], watermark: Optional[str]) -> bool:
+    return watermark is None or parse_ts(msgs[-1]["created_at"]) > parse_ts(watermark)
+
+async def audit_async(days: int = AUDIT_LOOKBACK_DAYS, concurrency: int = AUDIT_CONCURRENCY) -> Dict:
+    started = time.perf_counter()
+    watermarks = await asyncio.to_thread(load_watermarks)
+    report = {"conversations": 0, "audited": 0, "skipped_unchanged": 0, "errors": 0,
+              "errors_detected": 0, "input_tokens": 0, "output_tokens": 0}
+
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    tasks = set()
+
+    async def audit_one(phone: str, msgs: List[Dict]):
+        try:
+            analysis, tokens = await analyze_conversation(phone, msgs)
+            report["input_tokens"] += tokens["input_tokens"]
+            report["output_tokens"] += tokens["output_tokens"]
+            if not analysis:
+                report["errors"] += 1 # Sin marca de agua: se reintenta en la próxima corrida
+                return
+            await asyncio.to_thread(save_learning, phone, analysis)
+            await asyncio.to_thread(save_watermark, phone, msgs[-1]["created_at"])
+            report["audited"] += 1
+            report["errors_detected"] += 1 if analysis.get("error_detected") else 0
+        except Exception as e:
+            print(f"❌ Error auditando {phone}: {e}")
+            report["errors"] += 1 # Sin marca de agua: se reintenta en la próxima corrida
+        finally:
+            semaphore.release()
+
+    # Se lee la siguiente conversación sólo cuando hay un cupo libre: memoria acotada a `concurrency` chats
+    conversations = get_recent_conversations(days)
+    while True:
+        await semaphore.acquire()
+        try:
+            item = await asyncio.to_thread(next, conversations, None)
+        except Exception as e:
+            print(f"❌ Error obteniendo logs: {e}")
+            item = None
+        if item is None:
+            semaphore.release()
+            break
+        phone, msgs = item
+        report["conversations"] += 1
+        if len(msgs) < 2 or not has_new_messages(msgs, watermarks.get(phone)): # Ignorar chats vacíos y sin cambios
+            report["skipped_unchanged"] += 1 if len(msgs) >= 2 else 0
+            semaphore.release()
+            continue
+        task = asyncio.create_task(audit_one(phone, msgs))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    await asyncio.gather(*tasks)
+    print(f"📊 {report['conversations']} conversaciones activas, {report['skipped_unchanged']} sin mensajes nuevos desde su última auditoría.")
+
+    elapsed = time.perf_counter() - started
+    report["elapsed_s"] = round(elapsed, 1)
+    report["conversations_per_min"] = round(report["audited"] / elapsed * 60, 1) if elapsed else 0.0
+    print(f"🏁 Auditoría: {report['audited']} conversaciones en {report['elapsed_s']}s "
+          f"({report['conversations_per_min']}/min), tokens: {report['input_tokens']} entrada / {report['output_tokens']} salida.")
+    return report
+
 def main():
-    conversations = get_recent_conversations(days=1)
-    print(f"📊 Encontradas {len(conversations)} conversaciones activas hoy.")
-    
-    for phone, msgs in conversations.items():
-        if len(msgs) < 2: continue # Ignorar chats vacíos
-        
-        analysis = analyze_conversation(phone, msgs)
-        if analysis:
-            save_learning(phone, analysis)
+    """Punto de entrada síncrono (cron/botón: server.py lo corre en un thread con run_in_executor)."""
+    if not _run_lock.acquire(blocking=False):
+        print("⏳ Ya hay una auditoría en curso; se omite esta ejecución.")
+        return {"status": "already_running"}
+    try:
+        return asyncio.run(audit_async())
+    finally:
+        _run_lock.release()
 
 if __name__ == "__main__":
     main()
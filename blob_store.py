@@ -0,0 +1,71 @@
+"""
+Almacenamiento direccionado por contenido para el bucket `chat-media`.
+
+Un solo objeto físico por sha256 (`blobs/ab/abcdef...pdf`). Las filas de
+`file_metadata` conservan su ruta lógica en `file_path` (carpeta del cliente/orden,
+la que muestra el explorador) y apuntan al objeto real con `blob_path`. Un PDF
+reenviado por WhatsApp o vuelto a subir desde el dashboard no se sube de nuevo:
+sólo se crea la fila que apunta al blob existente.
+
+Este módulo sólo tiene la parte pura (rutas, hash, caché de hashes conocidos y
+contadores); las llamadas a Supabase viven en server.py.
+"""
+import hashlib
+from collections import OrderedDict
+from typing import Optional
+
+BLOB_PREFIX = "blobs"
+
+
+def sha256_hex(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def blob_path_for(content_hash: str, ext: str) -> str:
+    """Ruta física del blob (dos caracteres de fan-out para no tener una carpeta gigante)."""
+    ext = (ext or "bin").lstrip(".").lower()
+    return f"{BLOB_PREFIX}/{content_hash[:2]}/{content_hash}.{ext}"
+
+
+def is_duplicate_error(message: str) -> bool:
+    """Storage responde 409 "Duplicate" / "already exists" si el blob ya estaba (p.ej. subido por otro worker)."""
+    message = (message or "").lower()
+    return "already exists" in message or "duplicate" in message
+
+
+class BlobRegistry:
+    """LRU de hashes ya presentes en el bucket -> blob_path (evita ir a la DB en reenvíos seguidos)."""
+
+    def __init__(self, max_items: int = 20000):
+        self.max_items = max_items
+        self._paths: "OrderedDict[str, str]" = OrderedDict()
+        self.uploads = 0
+        self.reused = 0
+        self.bytes_uploaded = 0
+        self.bytes_saved = 0
+
+    def get(self, content_hash: str) -> Optional[str]:
+        path = self._paths.get(content_hash)
+        if path is not None:
+            self._paths.move_to_end(content_hash)
+        return path
+
+    def add(self, content_hash: str, path: str):
+        self._paths[content_hash] = path
+        self._paths.move_to_end(content_hash)
+        while len(self._paths) > self.max_items:
+            self._paths.popitem(last=False)
+
+    def record(self, size: int, reused: bool):
+        if reused:
+            self.reused += 1
+            self.bytes_saved += size
+        else:
+            self.uploads += 1
+            self.bytes_uploaded += size
+
+    def stats(self) -> dict:
+        total = self.uploads + self.reused
+        return {"known_hashes": len(self._paths), "uploads": self.uploads, "reused": self.reused,
+                "dedupe_ratio": round(self.reused / total, 3) if total else 0.0,
+                "bytes_uploaded": self.bytes_uploaded, "bytes_saved": self.bytes_saved}
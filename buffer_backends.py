@@ -0,0 +1,191 @@
+"""
+Backends del buffer de mensajes (coalescencia de ráfagas por teléfono).
+
+Cada mensaje entrante hace un `append` que, de forma atómica, agrega el texto y
+"rearma" el buffer: sube la generación y corre el deadline. El worker que recibió
+el mensaje programa un timer local; al vencer llama a `claim(phone, generation)`.
+Sólo el timer de la ÚLTIMA generación puede reclamar, y el claim borra los mensajes
+en la misma transacción, así que cada ráfaga se procesa como máximo una vez aunque
+haya varios workers/réplicas compartiendo el backend.
+
+Backends:
+  - memory: dict en proceso (un solo worker, se pierde al reiniciar).
+  - sqlite: archivo local en modo WAL, compartido entre workers del mismo host y
+            durable ante reinicios (`pending()` permite re-armar al arrancar).
+"""
+import asyncio
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Tuple
+
+
+class BufferBackend(ABC):
+    """Interfaz común de los backends del buffer (un backend incompleto falla al crearse, no a mitad de turno)."""
+
+    @abstractmethod
+    async def append(self, phone: str, text: str, push_name: Optional[str], delay: float) -> int:
+        """Agrega `text` y rearma el deadline. Retorna la nueva generación."""
+
+    @abstractmethod
+    async def claim(self, phone: str, generation: int) -> Optional[Tuple[List[str], Optional[str]]]:
+        """Saca (mensajes, push_name) si `generation` sigue siendo la vigente; si no, None."""
+
+    @abstractmethod
+    async def pending(self) -> List[Tuple[str, int, float]]:
+        """Lista (phone, generation, deadline) de buffers aún no reclamados."""
+
+    @abstractmethod
+    async def put_result(self, job_id: str, text: str):
+        """Publica el texto final de un trabajo de media (ver media_ingest.py)."""
+
+    @abstractmethod
+    async def pop_result(self, job_id: str) -> Optional[str]:
+        """Saca el texto final de un trabajo de media, o None si aún no existe."""
+
+
+class MemoryBufferBackend(BufferBackend):
+    """Buffer en memoria del proceso. Atómico porque corre dentro de un único event loop."""
+
+    def __init__(self):
+        self._data: Dict[str, Dict] = {}
+        self._results: Dict[str, str] = {}
+
+    async def append(self, phone, text, push_name, delay):
+        entry = self._data.get(phone)
+        if entry is None:
+            entry = self._data[phone] = {"generation": 0, "messages": [], "push_name": push_name}
+        entry["generation"] += 1
+        entry["deadline"] = time.time() + delay
+        entry["messages"].append(text)
+        if push_name:
+            entry["push_name"] = push_name
+        return entry["generation"]
+
+    async def claim(self, phone, generation):
+        entry = self._data.get(phone)
+        if entry is None or entry["generation"] != generation:
+            return None
+        del self._data[phone]
+        return entry["messages"], entry["push_name"]
+
+    async def pending(self):
+        return [(phone, e["generation"], e["deadline"]) for phone, e in self._data.items()]
+
+    async def put_result(self, job_id, text):
+        self._results[job_id] = text
+
+    async def pop_result(self, job_id):
+        return self._results.pop(job_id, None)
+
+
+class SQLiteBufferBackend(BufferBackend):
+    """Buffer durable en SQLite. Las transacciones BEGIN IMMEDIATE serializan a los workers."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS buffer_phones (
+                phone TEXT PRIMARY KEY,
+                generation INTEGER NOT NULL,
+                deadline REAL NOT NULL,
+                push_name TEXT
+            )""")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS buffer_messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                phone TEXT NOT NULL,
+                text TEXT NOT NULL
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_buffer_messages_phone ON buffer_messages(phone, id)")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS media_results (
+                job_id TEXT PRIMARY KEY,
+                text TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )""")
+
+    def _append_sync(self, phone, text, push_name, delay):
+        with self._lock:
+            cur = self._conn.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                cur.execute("INSERT INTO buffer_messages (phone, text) VALUES (?, ?)", (phone, text))
+                cur.execute("""
+                    INSERT INTO buffer_phones (phone, generation, deadline, push_name) VALUES (?, 1, ?, ?)
+                    ON CONFLICT(phone) DO UPDATE SET
+                        generation = generation + 1,
+                        deadline = excluded.deadline,
+                        push_name = COALESCE(excluded.push_name, buffer_phones.push_name)
+                """, (phone, time.time() + delay, push_name))
+                generation = cur.execute("SELECT generation FROM buffer_phones WHERE phone = ?", (phone,)).fetchone()[0]
+                cur.execute("COMMIT")
+                return generation
+            except Exception:
+                cur.execute("ROLLBACK")
+                raise
+
+    def _claim_sync(self, phone, generation):
+        with self._lock:
+            cur = self._conn.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                row = cur.execute("SELECT generation, push_name FROM buffer_phones WHERE phone = ?", (phone,)).fetchone()
+                if not row or row[0] != generation:
+                    cur.execute("ROLLBACK")
+                    return None
+                messages = [r[0] for r in cur.execute("SELECT text FROM buffer_messages WHERE phone = ? ORDER BY id", (phone,))]
+                cur.execute("DELETE FROM buffer_messages WHERE phone = ?", (phone,))
+                cur.execute("DELETE FROM buffer_phones WHERE phone = ?", (phone,))
+                cur.execute("COMMIT")
+                return messages, row[1]
+            except Exception:
+                cur.execute("ROLLBACK")
+                raise
+
+    def _pending_sync(self):
+        with self._lock:
+            return [tuple(r) for r in self._conn.execute("SELECT phone, generation, deadline FROM buffer_phones")]
+
+    def _put_result_sync(self, job_id, text):
+        with self._lock:
+            # Limpieza oportunista de resultados que nadie reclamó en 1 hora
+            self._conn.execute("DELETE FROM media_results WHERE created_at < ?", (time.time() - 3600,))
+            self._conn.execute("INSERT OR REPLACE INTO media_results (job_id, text, created_at) VALUES (?, ?, ?)",
+                               (job_id, text, time.time()))
+
+    def _pop_result_sync(self, job_id):
+        with self._lock:
+            row = self._conn.execute("SELECT text FROM media_results WHERE job_id = ?", (job_id,)).fetchone()
+            if row:
+                self._conn.execute("DELETE FROM media_results WHERE job_id = ?", (job_id,))
+            return row[0] if row else None
+
+    async def append(self, phone, text, push_name, delay):
+        return await asyncio.to_thread(self._append_sync, phone, text, push_name, delay)
+
+    async def claim(self, phone, generation):
+        return await asyncio.to_thread(self._claim_sync, phone, generation)
+
+    async def pending(self):
+        return await asyncio.to_thread(self._pending_sync)
+
+    async def put_result(self, job_id, text):
+        await asyncio.to_thread(self._put_result_sync, job_id, text)
+
+    async def pop_result(self, job_id):
+        return await asyncio.to_thread(self._pop_result_sync, job_id)
+
+
+def create_buffer_backend(kind: str, path: str = "buffer.db") -> BufferBackend:
+    """Fábrica según BUFFER_BACKEND ('memory' o 'sqlite')."""
+    if kind == "sqlite":
+        return SQLiteBufferBackend(path)
+    if kind != "memory":
+        raise ValueError(f"BUFFER_BACKEND desconocido: {kind}")
+    return MemoryBufferBackend()
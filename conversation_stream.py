@@ -0,0 +1,87 @@
+"""
+Lectura de `message_logs` por conversación (auditor nocturno, reportes y scripts).
+
+- Sólo pide las columnas que se usan (`phone_number, role, content, created_at` y el
+  `id` como desempate); nada de metadata ni payloads de entrega.
+- Paginación por keyset sobre (phone_number, created_at, id) en vez de offset o de un
+  único request: PostgREST corta la respuesta en su tope de filas sin avisar, y con
+  offset las filas que llegan durante la lectura desplazan las páginas.
+- Como viene ordenado por teléfono, las conversaciones salen completas una a una:
+  en memoria hay a lo más una página más la conversación en curso.
+
+Funciona con el cliente síncrono de supabase (`create_client`), que es el que usan
+audit_now.py y los scripts. `parse_ts` lo comparten también server.py y el auditor.
+"""
+import re
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+
+BASE_COLUMNS = "id, phone_number, role, content, created_at"
+PAGE_SIZE = 1000
+
+
+def parse_ts(value: str) -> datetime:
+    """Parsea timestamps de PostgREST (fracciones de segundo de largo variable, sufijo Z).
+
+    Siempre retorna un datetime con zona: los timestamps sin offset se toman como UTC,
+    así se pueden comparar con `datetime.now(timezone.utc)` sin TypeError.
+    """
+    value = value.replace("Z", "+00:00")
+    match = re.match(r"^(.*T\d{2}:\d{2}:\d{2})(\.\d+)?(.*)$", value)
+    if match and match.group(2):
+        value = match.group(1) + match.group(2)[:7].ljust(7, "0") + match.group(3)
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def _quote(value) -> str:
+    """Valor entre comillas para filtros `or` de PostgREST (timestamps traen ':' y '.')."""
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def keyset_filter(last: Dict) -> str:
+    """Filas estrictamente después de `last` en el orden (phone_number, created_at, id)."""
+    phone, ts, row_id = _quote(last["phone_number"]), _quote(last["created_at"]), _quote(last["id"])
+    return (f"phone_number.gt.{phone},"
+            f"and(phone_number.eq.{phone},created_at.gt.{ts}),"
+            f"and(phone_number.eq.{phone},created_at.eq.{ts},id.gt.{row_id})")
+
+
+def iter_message_pages(client, since: str, until: Optional[str] = None, columns: str = "",
+                       page_size: int = PAGE_SIZE) -> Iterator[List[Dict]]:
+    """Páginas de mensajes con `created_at` en [since, until), ordenadas por teléfono y fecha.
+
+    `columns` agrega columnas extra a la proyección (p.ej. "intent, leads(name)").
+    """
+    select = f"{BASE_COLUMNS}, {columns}" if columns else BASE_COLUMNS
+    last = None
+    while True:
+        query = client.table("message_logs").select(select) \
+            .gte("created_at", since) \
+            .not_.is_("phone_number", "null")
+        if until:
+            query = query.lt("created_at", until)
+        if last is not None:
+            query = query.or_(keyset_filter(last))
+        res = query.order("phone_number").order("created_at").order("id").limit(page_size).execute()
+        rows = res.data or []
+        if rows:
+            yield rows
+        if len(rows) < page_size:
+            return
+        last = rows[-1]
+
+
+def iter_conversations(client, since: str, until: Optional[str] = None, columns: str = "",
+                       page_size: int = PAGE_SIZE) -> Iterator[Tuple[str, List[Dict]]]:
+    """(teléfono, mensajes en orden cronológico) por cada conversación con actividad en la ventana."""
+    phone, messages = None, []
+    for page in iter_message_pages(client, since, until, columns, page_size):
+        for row in page:
+            if row["phone_number"] != phone:
+                if messages:
+                    yield phone, messages
+                phone, messages = row["phone_number"], []
+            messages.append(row)
+    if messages:
+        yield phone, messages
@@ -35,17 +35,24 @@ export default function FileExplorer({ isDarkMode }) {
     const defaultLayoutPluginInstance = defaultLayoutPlugin();
     const BACKEND_URL = import.meta.env.VITE_API_URL;
 
+    const [nextCursor, setNextCursor] = useState(null);
+
     useEffect(() => {
         fetchFiles();
-    }, []);
+    }, [currentPath]);
 
-    const fetchFiles = async () => {
-        setLoading(true);
+    // El backend lista sólo los hijos de la carpeta actual (con conteos y tamaños), paginado por cursor.
+    // Con ETag + Cache-Control: no-cache el navegador revalida y una carpeta sin cambios es un 304.
+    const fetchFiles = async (cursor = null) => {
+        setLoading(!cursor);
         try {
-            const response = await fetch(`${BACKEND_URL}/storage/tree`);
+            const params = new URLSearchParams({ path: currentPath.join('/'), limit: '200' });
+            if (cursor) params.set('cursor', cursor);
+            const response = await fetch(`${BACKEND_URL}/storage/folders?${params}`);
             if (response.ok) {
                 const data = await response.json();
-                setFiles(data);
+                setFiles(prev => cursor ? [...prev, ...data.items] : data.items);
+                setNextCursor(data.next_cursor);
             }
         } catch (error) {
             console.error("Error fetching files:", error);
@@ -55,43 +62,8 @@ export default function FileExplorer({ isDarkMode }) {
         }
     };
 
-    // Logic to build the folder tree from flat metadata
-    const buildTree = () => {
-        const root = {};
-        files.forEach(file => {
-            let parts = file.file_path.split('/');
-            // Si la ruta empieza con 'archivos/', omitimos ese primer nivel para evitar redundancia
-            if (parts[0] === 'archivos') {
-                parts.shift();
-            }
-
-            let current = root;
-            parts.forEach((part, index) => {
-                if (!current[part]) {
-                    current[part] = {
-                        name: part,
-                        type: index === parts.length - 1 ? 'file' : 'folder',
-                        children: {},
-                        metadata: index === parts.length - 1 ? file : null
-                    };
-                }
-                current = current[part].children;
-            });
-        });
-        return root;
-    };
-
     const getVisibleItems = () => {
-        let current = buildTree();
-
-        // Navigate to current path
-        for (const folder of currentPath) {
-            if (current[folder]) {
-                current = current[folder].children;
-            }
-        }
-
-        const items = Object.values(current).map(item => ({
+        const items = files.map(item => ({
             ...item,
             isFolder: item.type === 'folder'
         }));
@@ -304,10 +276,23 @@ export default function FileExplorer({ isDarkMode }) {
                                     <span className="mt-2 text-xs font-medium text-[var(--text-main)] text-center line-clamp-2 break-all">
                                         {item.name}
                                     </span>
+                                    {item.isFolder && (
+                                        <span className="text-[10px] text-gray-400">{item.file_count} archivos</span>
+                                    )}
                                 </div>
                             ))}
                         </div>
                     )}
+                    {!loading && nextCursor && (
+                        <div className="flex justify-center mt-6">
+                            <button
+                                onClick={() => fetchFiles(nextCursor)}
+                                className="px-4 py-2 text-sm font-bold rounded-lg border border-gray-200 dark:border-white/10 text-[var(--text-main)] hover:bg-white dark:hover:bg-white/5"
+                            >
+                                Cargar más
+                            </button>
+                        </div>
+                    )}
                 </div>
             </div>
 
@@ -326,7 +311,7 @@ export default function FileExplorer({ isDarkMode }) {
                         <div className="aspect-square bg-gray-100 dark:bg-white/5 rounded-xl mb-4 flex items-center justify-center border border-gray-200 dark:border-white/10 overflow-hidden relative group">
                             {selectedFile.file_type?.includes('image') ? (
                                 <img
-                                    src={supabase.storage.from("chat-media").getPublicUrl(selectedFile.file_path).data.publicUrl}
+                                    src={supabase.storage.from("chat-media").getPublicUrl(selectedFile.blob_path || selectedFile.file_path).data.publicUrl}
                                     alt="preview"
                                     className="w-full h-full object-cover"
                                 />
@@ -352,7 +337,7 @@ export default function FileExplorer({ isDarkMode }) {
                                         <Worker workerUrl={`https://unpkg.com/pdfjs-dist@3.11.174/build/pdf.worker.min.js`}>
                                             <div className={isDarkMode ? 'rpv-core__viewer--dark' : ''} style={{ height: '100%' }}>
                                                 <Viewer
-                                                    fileUrl={supabase.storage.from("chat-media").getPublicUrl(selectedFile.file_path).data.publicUrl}
+                                                    fileUrl={supabase.storage.from("chat-media").getPublicUrl(selectedFile.blob_path || selectedFile.file_path).data.publicUrl}
                                                     plugins={[defaultLayoutPluginInstance]}
                                                     theme={isDarkMode ? 'dark' : 'light'}
                                                 />
@@ -392,7 +377,7 @@ export default function FileExplorer({ isDarkMode }) {
 
                     <div className="p-4 bg-gray-50 dark:bg-white/5 border-t border-gray-200 dark:border-white/10 grid grid-cols-2 gap-2">
                         <a
-                            href={supabase.storage.from("chat-media").getPublicUrl(selectedFile.file_path).data.publicUrl}
+                            href={supabase.storage.from("chat-media").getPublicUrl(selectedFile.blob_path || selectedFile.file_path).data.publicUrl}
                             target="_blank"
                             rel="noopener noreferrer"
                             className="flex items-center justify-center gap-2 px-4 py-2 bg-[var(--color-primary)] text-white rounded-lg text-sm font-bold"
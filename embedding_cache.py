@@ -0,0 +1,111 @@
+"""
+Caché de embeddings: LRU en memoria + tier opcional en disco (SQLite, float32).
+
+La llave es el sha256 del texto normalizado (minúsculas, espacios colapsados), así
+los "Hola", "hola " y "APROBADO" de miles de clientes se embeben una sola vez.
+Las peticiones concurrentes del mismo texto comparten una única llamada a OpenAI.
+"""
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.split()).lower()
+
+
+def cache_key(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class _DiskTier:
+    """Vectores como BLOB float32 en SQLite (4 bytes por dimensión)."""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vec BLOB NOT NULL)")
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[List[float]]:
+        with self._lock:
+            row = self._conn.execute("SELECT vec FROM embeddings WHERE key = ?", (key,)).fetchone()
+        if not row:
+            return None
+        return array("f", row[0]).tolist()
+
+    def put(self, key: str, vector: List[float]):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO embeddings (key, vec) VALUES (?, ?)", (key, array("f", vector).tobytes()))
+            self._conn.commit()
+
+
+class EmbeddingCache:
+    def __init__(self, embed_fn: Callable[[str], Awaitable[List[float]]], max_items: int = 5000, disk_path: Optional[str] = None):
+        self.embed_fn = embed_fn
+        self.max_items = max_items
+        self._lru: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._disk = _DiskTier(disk_path) if disk_path else None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _remember(self, key: str, vector: List[float]):
+        self._lru[key] = vector
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_items:
+            self._lru.popitem(last=False)
+
+    async def get(self, text: str) -> List[float]:
+        key = cache_key(text)
+        vector = self._lru.get(key)
+        if vector is not None:
+            self._lru.move_to_end(key)
+            self.hits += 1
+            return vector
+
+        # Otro request ya está embebiendo este mismo texto: esperamos su resultado
+        if key in self._inflight:
+            self.hits += 1
+            return await asyncio.shield(self._inflight[key])
+
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            vector = None
+            if self._disk:
+                vector = await asyncio.to_thread(self._disk.get, key)
+                if vector is not None:
+                    self.disk_hits += 1
+            if vector is None:
+                self.misses += 1
+                vector = await self.embed_fn(text)
+                if vector and self._disk:
+                    await asyncio.to_thread(self._disk.put, key, vector)
+            if vector:
+                self._remember(key, vector)
+            fut.set_result(vector)
+            return vector
+        except Exception as e:
+            fut.set_exception(e)
+            fut.exception() # Marcar como consumida si nadie más la esperaba
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "openai_calls_saved": self.hits + self.disk_hits,
+            "hit_rate": round((self.hits + self.disk_hits) / total, 3) if total else 0.0,
+            "size": len(self._lru),
+        }
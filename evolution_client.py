@@ -0,0 +1,190 @@
+"""
+Cliente único de Evolution API (WhatsApp).
+
+- Reutiliza el pool keep-alive de httpx del servidor (no abre conexiones por envío).
+- Reintenta con backoff exponencial + jitter ante 5xx, 429, timeouts y errores de red.
+- Rate limiter global (token bucket) para no exceder el ritmo que tolera la instancia.
+- Cola FIFO por destinatario: los mensajes a un mismo cliente salen en orden
+  (un worker por número, que termina cuando su cola se vacía), y clientes distintos
+  se atienden en paralelo.
+
+Nota: reintentar tras un timeout de lectura puede duplicar un mensaje si Evolution
+alcanzó a procesarlo; lo preferimos a perder la respuesta al cliente.
+"""
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+from urllib.parse import quote
+
+import httpx
+
+from turn_metrics import TurnTimings
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """`rate` tokens por segundo con ráfagas de hasta `burst`."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class EvolutionClient:
+    def __init__(self, base_url: str, api_key: str, instance: str, rate_per_sec: float = 20.0, burst: int = 20,
+                 max_retries: int = 3, backoff_base: float = 0.5):
+        self.base_url = (base_url or "").rstrip("/")
+        self.api_key = api_key
+        self.instance = quote(instance or "")
+        self.http: Optional[httpx.AsyncClient] = None # Se asigna en el startup (pool compartido)
+        self.limiter = TokenBucket(rate_per_sec, burst)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self._queues: Dict[str, Deque[Tuple[str, Dict, float, float, asyncio.Future]]] = {}
+        self._workers: Dict[str, asyncio.Task] = {}
+        self.timings = TurnTimings()
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.max_depth_seen = 0
+
+    def bind(self, http_client: httpx.AsyncClient):
+        self.http = http_client
+
+    def _url(self, path: str) -> str:
+        return f"{self.base_url}/{path}/{self.instance}"
+
+    async def post(self, path: str, payload: Dict, timeout: float = 15) -> httpx.Response:
+        """POST con rate limit y reintentos. Lanza la última excepción si se agotan los intentos."""
+        headers = {"apikey": self.api_key, "Content-Type": "application/json"}
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.acquire()
+            try:
+                response = await self.http.post(self._url(path), json=payload, headers=headers, timeout=timeout)
+                if response.status_code not in RETRY_STATUS or attempt == self.max_retries:
+                    return response
+                delay = self._retry_after(response) or self._backoff(attempt)
+                logger.warning(f"🔁 Evolution {path} respondió {response.status_code}, reintento {attempt + 1} en {delay:.1f}s")
+            except (httpx.TimeoutException, httpx.TransportError) as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+                logger.warning(f"🔁 Evolution {path} falló ({type(e).__name__}), reintento {attempt + 1} en {delay:.1f}s")
+            self.retries += 1
+            await asyncio.sleep(delay)
+
+    def _backoff(self, attempt: int) -> float:
+        return self.backoff_base * (2 ** attempt) * (1 + random.random() * 0.25)
+
+    @staticmethod
+    def _retry_after(response: httpx.Response) -> Optional[float]:
+        try:
+            return min(30.0, float(response.headers.get("retry-after")))
+        except (TypeError, ValueError):
+            return None
+
+    # --- Cola FIFO por destinatario ---
+    async def enqueue(self, number: str, path: str, payload: Dict, timeout: float = 15) -> Dict:
+        """Encola un envío para `number` y espera su resultado (orden garantizado por número)."""
+        fut = asyncio.get_running_loop().create_future()
+        queue = self._queues.setdefault(number, deque())
+        queue.append((path, payload, timeout, time.perf_counter(), fut))
+        self.max_depth_seen = max(self.max_depth_seen, self.depth())
+        if number not in self._workers:
+            self._workers[number] = asyncio.create_task(self._drain(number))
+        return await asyncio.shield(fut)
+
+    async def _drain(self, number: str):
+        queue = self._queues[number]
+        try:
+            while queue:
+                path, payload, timeout, enqueued, fut = queue.popleft()
+                self.timings.record("queue_wait", (time.perf_counter() - enqueued) * 1000)
+                start = time.perf_counter()
+                result = await self._send(path, payload, timeout)
+                self.timings.record(path.rsplit("/", 1)[-1], (time.perf_counter() - start) * 1000,
+                                    "ok" if result["status"] == "success" else "error")
+                if not fut.done():
+                    fut.set_result(result)
+        finally:
+            self._workers.pop(number, None)
+            if not queue:
+                self._queues.pop(number, None)
+
+    async def _send(self, path: str, payload: Dict, timeout: float) -> Dict:
+        result: Dict[str, Any] = {"status": "unknown", "code": 0}
+        try:
+            response = await self.post(path, payload, timeout)
+            result["code"] = response.status_code
+            if response.status_code in (200, 201):
+                result["status"] = "success"
+                try:
+                    result["evolution_id"] = response.json().get("key", {}).get("id")
+                except ValueError:
+                    pass
+                self.sent += 1
+            else:
+                logger.error(f"❌ Error Evolution API ({response.status_code}): {response.text}")
+                result["status"] = "error"
+                result["response"] = response.text
+                self.failed += 1
+        except Exception as e:
+            logger.error(f"🔥 Error crítico envío WA: {e}")
+            result["status"] = "exception"
+            result["error"] = str(e)
+            self.failed += 1
+        return result
+
+    async def send_text(self, number: str, text: str) -> Dict:
+        return await self.enqueue(number, "message/sendText", {"number": number, "text": text}, timeout=15)
+
+    async def send_media(self, number: str, payload: Dict) -> Dict:
+        return await self.enqueue(number, "message/sendMedia", dict(payload, number=number), timeout=30)
+
+    async def fetch_profile_picture(self, number: str) -> Optional[str]:
+        """URL de la foto de perfil (no pasa por la cola: no es un envío)."""
+        response = await self.post("chat/fetchProfilePictureUrl", {"number": number}, timeout=10)
+        if response.status_code not in (200, 201):
+            logger.error(f"❌ Error Evolution API ({response.status_code}): {response.text}")
+            return None
+        data = response.json()
+        # La respuesta puede variar según versión, buscamos campos comunes
+        return data.get("profilePictureUrl") or data.get("url")
+
+    def depth(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.depth(),
+            "max_depth_seen": self.max_depth_seen,
+            "active_recipients": len(self._workers),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+            "latency": self.timings.stats(),
+        }
@@ -0,0 +1,213 @@
+"""
+Respuesta rápida (sin LLM) para turnos triviales: saludos, agradecimientos y
+preguntas de precio que `calculate_quote` puede contestar solo.
+
+Clasificador en dos capas:
+  1. Reglas (vocabulario cerrado + parser de cotización). Confianza 1.0.
+  2. Nearest-centroid sobre embeddings (los mismos de la caché de embeddings) de
+     frases semilla por intención, con umbral de similitud y de margen contra la
+     segunda intención.
+
+Las confirmaciones (*APROBADO*) se detectan pero SIEMPRE van al LLM, porque
+disparan `register_order` con todo el contexto del turno.
+
+Modos (FAST_PATH_MODE): off | shadow (clasifica y registra lo que habría respondido,
+pero responde el LLM) | on.
+"""
+import re
+import unicodedata
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import numpy as np
+
+GREETING_REPLY = "¡Hola! 👋 Soy *Richard*, tu asistente en Pitrón Beña Impresión. ¡Es un gusto saludarte! 😊 ¿En qué puedo ayudarte hoy? ✨"
+THANKS_REPLY = "¡Con gusto! 😊 Si necesitas algo más, aquí estoy para ayudarte. ✨"
+
+# Frases semilla para los centroides ("otro" es la clase negativa: turnos que necesitan al LLM)
+SEED_EXAMPLES: Dict[str, List[str]] = {
+    "saludo": ["hola", "hola buenas", "buenas tardes", "buenos días", "buenas noches", "hola qué tal",
+               "hola buenas tardes cómo está", "holi", "hola richard", "wenas"],
+    "agradecimiento": ["gracias", "muchas gracias", "mil gracias", "gracias por todo", "ok gracias",
+                       "perfecto gracias", "genial muchas gracias", "muy amable, gracias", "vale gracias"],
+    "confirmacion": ["aprobado", "confirmado", "dale", "procede", "apruebo", "ok aprobado",
+                     "de acuerdo, procedamos", "confirmo el pedido"],
+    "otro": ["quiero imprimir tarjetas", "necesito un diseño para mi negocio", "cuánto cuestan los pendones",
+             "te envío el archivo", "mi rut es 12.345.678-9", "cuándo está listo mi pedido",
+             "dónde están ubicados", "hacen envíos a regiones", "necesito flyers para un evento",
+             "tienen foam", "quiero cambiar el color del diseño", "cómo pago", "ya transferí"],
+}
+
+_GREETING_WORDS = {"hola", "holi", "ola", "alo", "buenas", "buenos", "buena", "buen", "dia", "dias", "tardes", "tarde",
+                   "noches", "noche", "que", "tal", "como", "estas", "esta", "estan", "richard", "hey", "saludos", "wenas", "wena"}
+_GREETING_ANCHORS = {"hola", "holi", "ola", "alo", "buenas", "buenos", "buen", "hey", "saludos", "wenas", "wena"}
+_THANKS_WORDS = {"gracias", "grax", "muchas", "mil", "muchisimas", "ok", "okey", "vale", "perfecto", "genial", "super",
+                 "buenisimo", "listo", "muy", "amable", "por", "todo", "te", "pasaste", "richard"}
+_THANKS_ANCHORS = {"gracias", "grax", "muchisimas"}
+_CONFIRM_WORDS = {"aprobado", "confirmado", "apruebo", "confirmo", "procede", "dale", "ok", "si", "listo"}
+_CONFIRM_ANCHORS = {"aprobado", "confirmado", "apruebo", "confirmo", "procede", "dale"}
+
+_PRODUCT_WORDS = {"tarjeta": "tarjetas", "flyer": "flyers", "volante": "flyers", "pendon": "pendon",
+                  "foam": "foam", "trovicel": "trovicel"}
+_PRICE_RE = re.compile(r"\b(precio|precios|cuanto|valor|valores|vale|valen|cuesta|cuestan|cotiza\w*|sale|salen)\b")
+_DESIGN_RE = re.compile(r"\b(disen\w*|logo\w*)\b")
+_SIZE_RE = re.compile(r"\b(\d{2,3})\s*x\s*(\d{2,3})\b")
+_NUMBER_RE = re.compile(r"\b(\d{1,3}(?:\.\d{3})+|\d+)\b")
+_TWO_SIDES_RE = re.compile(r"\b(2|dos|ambos) (lados|caras)\b|\bdoble (cara|faz)\b|\btiro y retiro\b")
+
+
+def normalize(text: str) -> str:
+    """Minúsculas, sin tildes ni signos/emojis, espacios colapsados."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r"[^a-z0-9.\s]", " ", text)
+    return " ".join(text.split())
+
+
+def _collapse(word: str) -> str:
+    # "holaaa" -> "hola", "graciass" -> "gracias"
+    return re.sub(r"(.)\1+", r"\1", word)
+
+
+_GREETING_WORDS, _GREETING_ANCHORS = {_collapse(w) for w in _GREETING_WORDS}, {_collapse(w) for w in _GREETING_ANCHORS}
+_THANKS_WORDS, _THANKS_ANCHORS = {_collapse(w) for w in _THANKS_WORDS}, {_collapse(w) for w in _THANKS_ANCHORS}
+_CONFIRM_WORDS, _CONFIRM_ANCHORS = {_collapse(w) for w in _CONFIRM_WORDS}, {_collapse(w) for w in _CONFIRM_ANCHORS}
+
+
+def _closed_vocabulary(words: List[str], vocabulary: set, anchors: set, max_words: int = 8) -> bool:
+    collapsed = [_collapse(w.strip(".")) for w in words if w.strip(".")]
+    if not collapsed or len(collapsed) > max_words:
+        return False
+    return all(w in vocabulary for w in collapsed) and any(w in anchors for w in collapsed)
+
+
+def parse_quote_request(norm: str) -> Optional[Dict]:
+    """Extrae (producto, cantidad, tamaño, lados, terminación) de una pregunta de precio simple.
+
+    Retorna None si falta algo o si hay ambigüedad (varios productos o cantidades, diseño).
+    """
+    if not _PRICE_RE.search(norm) or _DESIGN_RE.search(norm):
+        return None
+    products = {canon for word, canon in _PRODUCT_WORDS.items() if word in norm}
+    if len(products) != 1:
+        return None
+    sizes = _SIZE_RE.findall(norm)
+    if len(sizes) > 1:
+        return None
+    size = f"{sizes[0][0]}x{sizes[0][1]}" if sizes else ("media carta" if "media carta" in norm else "carta" if "carta" in norm else "estandar")
+    without_sizes = _SIZE_RE.sub(" ", norm)
+    without_sides = _TWO_SIDES_RE.sub(" ", without_sizes)
+    numbers = _NUMBER_RE.findall(without_sides)
+    if len(numbers) != 1:
+        return None
+    quantity = int(numbers[0].replace(".", ""))
+    if quantity <= 0:
+        return None
+    return {
+        "product_type": products.pop(),
+        "quantity": quantity,
+        "sides": 2 if _TWO_SIDES_RE.search(without_sizes) else 1,
+        "finish": "polilaminado" if "polilaminad" in norm else "normal",
+        "size": size,
+    }
+
+
+class FastPathClassifier:
+    def __init__(self, embed_fn: Callable[[str], Awaitable[List[float]]], min_confidence: float = 0.85, min_margin: float = 0.05):
+        self.embed_fn = embed_fn
+        self.min_confidence = min_confidence
+        self.min_margin = min_margin
+        self._labels: List[str] = []
+        self._centroids: Optional[np.ndarray] = None
+
+    @property
+    def ready(self) -> bool:
+        return self._centroids is not None
+
+    async def fit(self, examples: Dict[str, List[str]] = None):
+        """Embebe las semillas (pasan por la caché de embeddings) y calcula un centroide por intención."""
+        examples = examples or SEED_EXAMPLES
+        labels, centroids = [], []
+        for label, phrases in examples.items():
+            vectors = [v for v in [await self.embed_fn(p) for p in phrases] if v]
+            if not vectors:
+                continue
+            matrix = np.asarray(vectors, dtype=np.float32)
+            matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+            centroid = matrix.mean(axis=0)
+            centroids.append(centroid / np.linalg.norm(centroid))
+            labels.append(label)
+        if centroids:
+            self._labels = labels
+            self._centroids = np.vstack(centroids)
+
+    def classify_rules(self, text: str) -> Optional[Dict]:
+        norm = normalize(text)
+        quote = parse_quote_request(norm)
+        if quote:
+            return {"intent": "cotizacion", "confidence": 1.0, "source": "rules", "quote": quote}
+        words = norm.split()
+        if _closed_vocabulary(words, _CONFIRM_WORDS, _CONFIRM_ANCHORS):
+            return {"intent": "confirmacion", "confidence": 1.0, "source": "rules"}
+        if _closed_vocabulary(words, _THANKS_WORDS, _THANKS_ANCHORS):
+            return {"intent": "agradecimiento", "confidence": 1.0, "source": "rules"}
+        if _closed_vocabulary(words, _GREETING_WORDS, _GREETING_ANCHORS):
+            return {"intent": "saludo", "confidence": 1.0, "source": "rules"}
+        return None
+
+    def classify_vector(self, vector: List[float]) -> Dict:
+        if not self.ready or not vector:
+            return {"intent": "otro", "confidence": 0.0, "source": "centroid"}
+        query = np.asarray(vector, dtype=np.float32)
+        sims = self._centroids @ (query / (np.linalg.norm(query) or 1.0))
+        order = np.argsort(-sims)
+        best = float(sims[order[0]])
+        margin = best - float(sims[order[1]]) if len(order) > 1 else best
+        intent = self._labels[order[0]]
+        if best < self.min_confidence or margin < self.min_margin:
+            intent = "otro"
+        return {"intent": intent, "confidence": round(best, 4), "margin": round(margin, 4), "source": "centroid"}
+
+    async def classify(self, text: str) -> Dict:
+        # Marcadores de archivos ([DOCUMENTO...], [ARCHIVO_INVALIDO...]) siempre requieren al LLM
+        if "[" in text:
+            return {"intent": "otro", "confidence": 0.0, "source": "rules"}
+        decision = self.classify_rules(text)
+        if decision:
+            return decision
+        # Mensajes largos nunca son triviales; no gastamos un embedding en ellos
+        if len(text.split()) > 8:
+            return {"intent": "otro", "confidence": 0.0, "source": "rules"}
+        return self.classify_vector(await self.embed_fn(text))
+
+
+def build_reply(decision: Dict, quote_fn: Callable[..., str]) -> Optional[str]:
+    """Respuesta plantilla/herramienta para la decisión, o None si el turno debe ir al LLM."""
+    intent = decision["intent"]
+    if intent == "saludo":
+        return GREETING_REPLY
+    if intent == "agradecimiento":
+        return THANKS_REPLY
+    if intent == "cotizacion" and decision.get("quote"):
+        reply = quote_fn(**decision["quote"])
+        # Sin precio automático: que el LLM lo maneje con todo el contexto
+        return None if reply.startswith("⚠️") else reply
+    return None
+
+
+class FastPathStats:
+    def __init__(self):
+        self.by_intent: Dict[str, int] = {}
+        self.served = 0
+        self.shadowed = 0
+
+    def record(self, intent: str, served: bool, shadow: bool):
+        self.by_intent[intent] = self.by_intent.get(intent, 0) + 1
+        if served:
+            self.served += 1
+        if shadow:
+            self.shadowed += 1
+
+    def stats(self) -> dict:
+        total = sum(self.by_intent.values())
+        return {"classified": total, "by_intent": dict(self.by_intent), "served": self.served,
+                "shadow_candidates": self.shadowed, "fast_ratio": round((self.served + self.shadowed) / total, 3) if total else 0.0}
@@ -0,0 +1,187 @@
+"""
+Índice en memoria de carpetas de `file_metadata` (explorador de archivos del dashboard).
+
+Cada carpeta guarda sus subcarpetas, sus archivos y agregados de todo su subárbol
+(cantidad de archivos y bytes). Agregar, mover o borrar un archivo sólo toca las
+carpetas de su ruta (O(profundidad)), y cada una recibe un número de versión nuevo:
+ese número es el ETag del listado, así una carpeta que no cambió responde 304.
+
+`reconcile(rows)` compara con la tabla completa y aplica sólo las diferencias
+(cubre cambios hechos directo en la DB o desde otro worker) sin invalidar los ETag
+de las carpetas que siguen iguales.
+
+Los listados se paginan por cursor (keyset sobre (tipo, nombre, id)), con las
+carpetas antes que los archivos.
+
+Igual que el explorador original, el primer nivel `archivos/` (subidas desde el
+dashboard) se funde con la raíz, donde están las carpetas de los archivos que
+llegan por WhatsApp.
+"""
+import base64
+import bisect
+import itertools
+import json
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+SortKey = Tuple[int, str, str]
+
+
+class _Folder:
+    __slots__ = ("folders", "files", "file_count", "size_bytes", "version", "_sorted")
+
+    def __init__(self):
+        self.folders: Dict[str, "_Folder"] = {}
+        self.files: Dict[Any, Dict] = {} # id -> fila
+        self.file_count = 0
+        self.size_bytes = 0
+        self.version = 0
+        self._sorted: Optional[Tuple[int, List[SortKey], List[Tuple[str, Any]]]] = None
+
+
+def split_path(path: str) -> List[str]:
+    return [p for p in (path or "").strip("/").split("/") if p]
+
+
+def encode_cursor(key: SortKey) -> str:
+    return base64.urlsafe_b64encode(json.dumps(key).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> SortKey:
+    kind, name, file_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    return int(kind), str(name), str(file_id)
+
+
+class FolderIndex:
+    def __init__(self, merged_prefix: Optional[str] = "archivos"):
+        self.merged_prefix = merged_prefix
+        self.root = _Folder()
+        self._by_id: Dict[Any, Dict] = {}
+        self._versions = itertools.count(1)
+        self.epoch = uuid.uuid4().hex[:8] # Distingue ETags entre procesos/reinicios
+        self.ready = False
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    # --- Mantenimiento incremental ---
+    def _walk(self, parts: List[str], create: bool) -> List[_Folder]:
+        chain = [self.root]
+        for part in parts:
+            nxt = chain[-1].folders.get(part)
+            if nxt is None:
+                if not create:
+                    return []
+                nxt = chain[-1].folders[part] = _Folder()
+            chain.append(nxt)
+        return chain
+
+    def _parts(self, row: Dict) -> List[str]:
+        parts = split_path(row.get("file_path"))
+        if self.merged_prefix and len(parts) > 1 and parts[0] == self.merged_prefix:
+            parts = parts[1:]
+        return parts
+
+    def _touch(self, chain: List[_Folder], files: int, size: int):
+        version = next(self._versions)
+        for folder in chain:
+            folder.file_count += files
+            folder.size_bytes += size
+            folder.version = version
+
+    def _add(self, row: Dict):
+        parts = self._parts(row)
+        if not parts:
+            return
+        chain = self._walk(parts[:-1], create=True)
+        chain[-1].files[row["id"]] = row
+        self._by_id[row["id"]] = row
+        self._touch(chain, 1, row.get("size_bytes") or 0)
+
+    def remove(self, file_id: Any):
+        row = self._by_id.pop(file_id, None)
+        if row is None:
+            return
+        parts = self._parts(row)
+        chain = self._walk(parts[:-1], create=False)
+        if not chain:
+            return
+        chain[-1].files.pop(file_id, None)
+        self._touch(chain, -1, -(row.get("size_bytes") or 0))
+        # Podar carpetas que quedaron vacías (el padre ya tiene versión nueva)
+        for depth in range(len(chain) - 1, 0, -1):
+            if chain[depth].file_count > 0:
+                break
+            del chain[depth - 1].folders[parts[depth - 1]]
+
+    def upsert(self, row: Dict):
+        """Alta o cambio de un archivo (los borrados lógicos salen del índice)."""
+        current = self._by_id.get(row["id"])
+        if current is not None:
+            merged = dict(current, **row) # Los UPDATE parciales no traen el join con leads
+            if merged == current:
+                return
+            self.remove(row["id"])
+            row = merged
+        if not row.get("is_deleted"):
+            self._add(row)
+
+    def reconcile(self, rows: List[Dict]):
+        """Aplica las diferencias contra la tabla completa (filas no borradas)."""
+        fresh = {r["id"]: r for r in rows}
+        for file_id in [i for i in self._by_id if i not in fresh]:
+            self.remove(file_id)
+        for file_id, row in fresh.items():
+            if self._by_id.get(file_id) != row:
+                self.remove(file_id)
+                self._add(row)
+        self.ready = True
+
+    # --- Lectura ---
+    def rows(self) -> List[Dict]:
+        return list(self._by_id.values())
+
+    def folder(self, path: str) -> Optional[_Folder]:
+        chain = self._walk(split_path(path), create=False)
+        return chain[-1] if chain else None
+
+    def etag(self, folder: Optional[_Folder]) -> str:
+        return f'W/"{self.epoch}-{folder.version if folder else 0}"'
+
+    def _children(self, folder: _Folder) -> Tuple[List[SortKey], List[Tuple[str, Any]]]:
+        if folder._sorted is None or folder._sorted[0] != folder.version:
+            entries = [((0, name, ""), ("folder", name)) for name in folder.folders]
+            entries += [((1, split_path(row["file_path"])[-1], str(fid)), ("file", fid)) for fid, row in folder.files.items()]
+            entries.sort(key=lambda e: e[0])
+            folder._sorted = (folder.version, [e[0] for e in entries], [e[1] for e in entries])
+        return folder._sorted[1], folder._sorted[2]
+
+    def list(self, path: str, cursor: Optional[str] = None, limit: int = 100) -> Dict:
+        folder = self.folder(path)
+        clean = "/".join(split_path(path))
+        if folder is None:
+            return {"path": clean, "file_count": 0, "size_bytes": 0, "items": [], "next_cursor": None}
+        keys, refs = self._children(folder)
+        start = bisect.bisect_right(keys, decode_cursor(cursor)) if cursor else 0
+        page = refs[start:start + limit]
+        items = []
+        for kind, ref in page:
+            if kind == "folder":
+                sub = folder.folders[ref]
+                items.append({"type": "folder", "name": ref, "path": f"{clean}/{ref}" if clean else ref,
+                              "file_count": sub.file_count, "size_bytes": sub.size_bytes})
+            else:
+                row = folder.files[ref]
+                items.append({"type": "file", "name": split_path(row["file_path"])[-1], "metadata": row})
+        has_more = start + limit < len(keys)
+        return {
+            "path": clean,
+            "file_count": folder.file_count,
+            "size_bytes": folder.size_bytes,
+            "items": items,
+            "next_cursor": encode_cursor(keys[start + limit - 1]) if has_more else None,
+        }
+
+    def stats(self) -> dict:
+        return {"ready": self.ready, "files": len(self._by_id), "size_bytes": self.root.size_bytes,
+                "top_level_folders": len(self.root.folders)}
@@ -1,83 +1,92 @@
+"""
+Reporte de conversaciones recientes -> REPORTE_CONVERSACIONES.txt
+
+Cubre TODAS las conversaciones con mensajes en la ventana (por defecto, últimos 3
+días), leídas por páginas y agrupadas por teléfono (ver conversation_stream), con los
+10 mensajes más recientes de cada una. Antes mostraba sólo los últimos 100 mensajes
+sueltos; para acotar el reporte en días con mucho tráfico usa --max-conversations
+(se cortan las primeras N, en orden de teléfono).
+
+Uso: python generate_conversation_report.py [--days 3] [--max-conversations N]
+"""
 import os
+import argparse
 from dotenv import load_dotenv
 from supabase import create_client
+from conversation_stream import iter_conversations
 from datetime import datetime, timedelta
 import json
 
 load_dotenv()
 
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--days", type=int, default=3, help="Días hacia atrás a revisar")
+parser.add_argument("--max-conversations", type=int, default=0, help="Tope de conversaciones en el reporte (0 = todas)")
+args = parser.parse_args()
+
 supabase = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"))
 
-# Obtener conversaciones de los últimos 3 días
-three_days_ago = (datetime.now() - timedelta(days=3)).isoformat()
-
-response = supabase.table("message_logs")\
-    .select("*, leads(name, phone_number)")\
-    .gte("created_at", three_days_ago)\
-    .order("created_at", desc=True)\
-    .limit(100)\
-    .execute()
-
-messages = response.data
-
-# Agrupar por lead
-conversations = {}
-for msg in messages:
-    lead_id = msg.get('lead_id')
-    if lead_id not in conversations:
-        lead_info = msg.get('leads', {})
-        conversations[lead_id] = {
-            'name': lead_info.get('name', 'Desconocido') if lead_info else 'Desconocido',
-            'phone': lead_info.get('phone_number', 'Sin teléfono') if lead_info else 'Sin teléfono',
-            'messages': []
-        }
-    conversations[lead_id]['messages'].append(msg)
-
-# Crear reporte
-report = []
-report.append("=" * 100)
-report.append("ANÁLISIS DE CONVERSACIONES RECIENTES (Últimos 3 días)")
-report.append("=" * 100)
-report.append(f"\nTotal de mensajes: {len(messages)}")
-report.append(f"Conversaciones únicas: {len(conversations)}\n")
-
-for idx, (lead_id, conv) in enumerate(conversations.items(), 1):
-    report.append("\n" + "-" * 100)
-    report.append(f"CONVERSACIÓN #{idx}: {conv['name']} ({conv['phone']})")
-    report.append("-" * 100)
-    report.append(f"Total mensajes: {len(conv['messages'])}\n")
+# Obtener conversaciones de los últimos N días
+since = (datetime.now() - timedelta(days=args.days)).isoformat()
+
+# Conversaciones agrupadas por teléfono, leídas por páginas (ver conversation_stream)
+conversations = iter_conversations(supabase, since, columns="intent, tokens_used, leads(name)")
+
+# Crear reporte (las estadísticas se acumulan mientras se recorren las conversaciones)
+body = []
+conversation_count = total_messages = user_msgs = assistant_msgs = total_tokens = 0
+intent_counts = {}
+
+for idx, (phone, messages) in enumerate(conversations, 1):
+    if args.max_conversations and idx > args.max_conversations:
+        break
+    conversation_count = idx
+    lead_info = messages[-1].get('leads') or {}
+    name = lead_info.get('name') or 'Desconocido'
+    body.append("\n" + "-" * 100)
+    body.append(f"CONVERSACIÓN #{idx}: {name} ({phone})")
+    body.append("-" * 100)
+    body.append(f"Total mensajes: {len(messages)}\n")
     
     # Mostrar mensajes (más recientes primero)
-    for msg in conv['messages'][:10]:  # Limitar a 10 mensajes por conversación
+    for msg in messages[::-1][:10]:  # Limitar a 10 mensajes por conversación
         timestamp = datetime.fromisoformat(msg['created_at'].replace('Z', '+00:00'))
         role = "👤 CLIENTE" if msg['role'] == 'user' else "🤖 RICHARD"
         intent = f" [{msg['intent']}]" if msg.get('intent') else ""
         
-        report.append(f"\n{role}{intent} - {timestamp.strftime('%Y-%m-%d %H:%M')}")
-        report.append(f"{msg['content']}\n")
+        body.append(f"\n{role}{intent} - {timestamp.strftime('%Y-%m-%d %H:%M')}")
+        body.append(f"{msg['content']}\n")
     
-    if len(conv['messages']) > 10:
-        report.append(f"... y {len(conv['messages']) - 10} mensajes más\n")
+    if len(messages) > 10:
+        body.append(f"... y {len(messages) - 10} mensajes más\n")
+
+    for msg in messages:
+        total_messages += 1
+        user_msgs += msg['role'] == 'user'
+        assistant_msgs += msg['role'] == 'assistant'
+        total_tokens += msg.get('tokens_used') or 0
+        if msg.get('intent'):
+            intent_counts[msg['intent']] = intent_counts.get(msg['intent'], 0) + 1
+
+report = []
+report.append("=" * 100)
+report.append(f"ANÁLISIS DE CONVERSACIONES RECIENTES (Últimos {args.days} días"
+              f"{f', primeras {args.max_conversations} conversaciones' if args.max_conversations else ''})")
+report.append("=" * 100)
+report.append(f"\nTotal de mensajes: {total_messages}")
+report.append(f"Conversaciones únicas: {conversation_count}\n")
+report.extend(body)
 
 # Estadísticas
 report.append("\n" + "=" * 100)
 report.append("ESTADÍSTICAS")
 report.append("=" * 100)
 
-user_msgs = sum(1 for msg in messages if msg['role'] == 'user')
-assistant_msgs = sum(1 for msg in messages if msg['role'] == 'assistant')
-total_tokens = sum(msg.get('tokens_used') or 0 for msg in messages)
-
 report.append(f"\nMensajes de clientes: {user_msgs}")
 report.append(f"Mensajes de Richard: {assistant_msgs}")
 report.append(f"Total tokens: {total_tokens:,}")
 
 # Intents
-all_intents = [msg.get('intent') for msg in messages if msg.get('intent')]
-intent_counts = {}
-for intent in all_intents:
-    intent_counts[intent] = intent_counts.get(intent, 0) + 1
-
 if intent_counts:
     report.append("\nIntents más frecuentes:")
     for intent, count in sorted(intent_counts.items(), key=lambda x: x[1], reverse=True):
@@ -0,0 +1,92 @@
+"""
+Ventana de historial por presupuesto de tokens (en vez de "los últimos 10 mensajes").
+
+Se recorre el historial del más nuevo al más viejo sumando tokens (tiktoken, mismo
+encoding que el modelo) hasta llenar el presupuesto. Lo que queda fuera no se pierde:
+server.py lo va plegando en un resumen rodante guardado en el lead.
+
+Si el encoding de tiktoken no está disponible (p.ej. sin red para descargarlo la
+primera vez) se estima con ~4 caracteres por token.
+"""
+import logging
+from typing import Dict, List, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+TOKENIZER_MODEL = "gpt-4o-mini"
+MESSAGE_OVERHEAD = 4 # Tokens de formato que la API de chat agrega por mensaje (rol, separadores)
+LEGACY_WINDOW = 10 # Ventana fija anterior, sólo para medir el ahorro
+
+_encoding = None
+_encoding_failed = False
+
+
+def _get_encoding():
+    global _encoding, _encoding_failed
+    if _encoding is None and not _encoding_failed:
+        try:
+            import tiktoken
+            _encoding = tiktoken.encoding_for_model(TOKENIZER_MODEL)
+        except Exception as e:
+            _encoding_failed = True
+            logger.warning(f"⚠️ tiktoken no disponible ({e}); se estimarán los tokens por largo de texto")
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    enc = _get_encoding()
+    if enc is None:
+        return max(1, len(text) // 4)
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def message_tokens(row: Dict) -> int:
+    return count_tokens(row.get("content") or "") + MESSAGE_OVERHEAD
+
+
+def select_window(rows: Sequence[Dict], budget: int, min_messages: int = 1) -> Tuple[List[Dict], List[Dict]]:
+    """Parte `rows` (orden cronológico) en (ventana, descartados) según el presupuesto.
+
+    Siempre conserva al menos `min_messages` de los más recientes aunque excedan el presupuesto.
+    """
+    used = 0
+    start = len(rows)
+    for i in range(len(rows) - 1, -1, -1):
+        cost = message_tokens(rows[i])
+        if used + cost > budget and len(rows) - i > min_messages:
+            break
+        used += cost
+        start = i
+    return list(rows[start:]), list(rows[:start])
+
+
+class HistoryStats:
+    """Tokens de historial por turno: ventana fija de 10 vs ventana por presupuesto + resumen."""
+
+    def __init__(self):
+        self.turns = 0
+        self.legacy_tokens = 0
+        self.window_tokens = 0
+        self.summary_tokens = 0
+        self.summaries_refreshed = 0
+
+    def record(self, legacy_tokens: int, window_tokens: int, summary_tokens: int) -> int:
+        self.turns += 1
+        self.legacy_tokens += legacy_tokens
+        self.window_tokens += window_tokens
+        self.summary_tokens += summary_tokens
+        return legacy_tokens - window_tokens - summary_tokens
+
+    def stats(self) -> dict:
+        saved = self.legacy_tokens - self.window_tokens - self.summary_tokens
+        return {
+            "turns": self.turns,
+            "legacy_tokens": self.legacy_tokens,
+            "window_tokens": self.window_tokens,
+            "summary_tokens": self.summary_tokens,
+            "tokens_saved": saved,
+            "tokens_saved_per_turn": round(saved / self.turns, 1) if self.turns else 0.0,
+            "summaries_refreshed": self.summaries_refreshed,
+        }
@@ -0,0 +1,152 @@
+"""
+Resolución de IDs cortos (prefijos de UUID) usados en las carpetas de archivos.
+
+Las carpetas siguen el formato `{Cliente}_{lead_id[:5]}/{order_id[:8]}`. Antes, para
+volver de la carpeta al registro se hacía `ilike("id::text", "fe5d0%")`, que castea y
+recorre toda la tabla y puede devolver varias filas sin avisar.
+
+`PrefixIndex` mantiene los IDs ordenados en memoria: resolver un prefijo es un
+bisect (O(log n)) más el recorrido de los que comparten el prefijo. Si hay más de
+uno, se desempata con la etiqueta de cada ID (nombre limpio del cliente para leads,
+lead_id para órdenes) y, si aun así quedan varios, se lanza `AmbiguousPrefix`.
+
+Los prefijos que no existen (carpetas que no siguen el formato, como
+`archivos/Mis_Documentos`) se recuerdan un rato como fallos conocidos para no
+consultar la DB en cada subida; `uuid_bounds` convierte un prefijo en un rango de
+UUIDs para que la consulta puntual use el índice de `id` en vez de castear a texto.
+
+Las funciones de rutas son las únicas que arman esos nombres de carpeta, así la
+escritura (ingesta, register_order) y la lectura (subidas) no se desalinean.
+"""
+import bisect
+import string
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+LEAD_PREFIX_LEN = 5
+ORDER_PREFIX_LEN = 8
+
+
+class AmbiguousPrefix(Exception):
+    def __init__(self, prefix: str, candidates: List[str]):
+        super().__init__(f"Prefijo '{prefix}' ambiguo: {len(candidates)} coincidencias")
+        self.prefix = prefix
+        self.candidates = candidates
+
+
+# --- Rutas ---
+def clean_name(name: Optional[str]) -> str:
+    return "".join(x for x in (name or "") if x.isalnum()) or "cliente"
+
+
+def customer_folder(name: Optional[str], lead_id: str) -> str:
+    return f"{clean_name(name)}_{str(lead_id)[:LEAD_PREFIX_LEN]}"
+
+
+def order_folder(name: Optional[str], lead_id: str, order_id: Optional[str] = None) -> str:
+    """Carpeta de la orden, o `general` si el archivo aún no tiene orden."""
+    return f"{customer_folder(name, lead_id)}/{str(order_id)[:ORDER_PREFIX_LEN] if order_id else 'general'}"
+
+
+def parse_folder(path: str) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """`[archivos/]Cliente_fe5d0/1a2b3c4d[/...]` -> (nombre_limpio, prefijo_lead, prefijo_orden)."""
+    parts = [p for p in (path or "").strip("/").split("/") if p]
+    if parts and parts[0] == "archivos":
+        parts = parts[1:]
+    if not parts or "_" not in parts[0]:
+        return None, None, None
+    name, lead_prefix = parts[0].rsplit("_", 1)
+    order_prefix = parts[1] if len(parts) >= 2 and parts[1] != "general" else None
+    return name, lead_prefix.lower() or None, order_prefix.lower() if order_prefix else None
+
+
+def uuid_bounds(prefix: str) -> Optional[Tuple[str, str]]:
+    """Prefijo hex -> (menor, mayor) UUID que empiezan con él. None si no puede ser un prefijo de UUID."""
+    digits = (prefix or "").lower().replace("-", "")
+    if not digits or len(digits) > 32 or any(c not in string.hexdigits for c in digits):
+        return None
+
+    def as_uuid(hex32: str) -> str:
+        return f"{hex32[:8]}-{hex32[8:12]}-{hex32[12:16]}-{hex32[16:20]}-{hex32[20:]}"
+    return as_uuid(digits.ljust(32, "0")), as_uuid(digits.ljust(32, "f"))
+
+
+# --- Índice ---
+class PrefixIndex:
+    def __init__(self, name: str, warn_len: int):
+        self.name = name
+        self.warn_len = warn_len # Largo de prefijo usado en las rutas: colisiones a este largo se cuentan
+        self._ids: List[str] = []
+        self._tags: Dict[str, Optional[str]] = {}
+        self._misses: Dict[str, float] = {} # prefijo -> vencimiento (monotonic) de un fallo conocido
+        self.ready = False
+        self.collisions = 0
+        self.ambiguous = 0
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def load(self, rows: Iterable[Tuple[str, Optional[str]]]):
+        """Reemplaza el índice con pares (id, etiqueta)."""
+        tags = {str(i).lower(): tag for i, tag in rows}
+        ids = sorted(tags)
+        self.collisions = sum(1 for a, b in zip(ids, ids[1:]) if a[:self.warn_len] == b[:self.warn_len])
+        self._ids, self._tags = ids, tags
+        self._misses = {} # La carga trae los IDs creados por otros workers
+        self.ready = True
+
+    def add(self, item_id: str, tag: Optional[str] = None) -> bool:
+        """Agrega (o re-etiqueta) un ID. Retorna True si choca con otro al largo de las rutas."""
+        item_id = str(item_id).lower()
+        for prefix in [p for p in self._misses if item_id.startswith(p)]:
+            del self._misses[prefix]
+        if item_id in self._tags:
+            self._tags[item_id] = tag
+            return False
+        pos = bisect.bisect_left(self._ids, item_id)
+        self._ids.insert(pos, item_id)
+        self._tags[item_id] = tag
+        short = item_id[:self.warn_len]
+        collides = any(0 <= j < len(self._ids) and self._ids[j][:self.warn_len] == short for j in (pos - 1, pos + 1))
+        if collides:
+            self.collisions += 1
+        return collides
+
+    def matches(self, prefix: str, limit: int = 10) -> List[str]:
+        prefix = prefix.lower()
+        out = []
+        i = bisect.bisect_left(self._ids, prefix)
+        while i < len(self._ids) and self._ids[i].startswith(prefix) and len(out) < limit:
+            out.append(self._ids[i])
+            i += 1
+        return out
+
+    def resolve(self, prefix: str, tag: Optional[str] = None) -> Optional[str]:
+        """ID único que empieza con `prefix` (None si no hay). Desempata por etiqueta; si no alcanza, AmbiguousPrefix."""
+        if not prefix:
+            return None
+        candidates = self.matches(prefix)
+        if len(candidates) > 1 and tag is not None:
+            candidates = [c for c in candidates if self._tags.get(c) == tag] or candidates
+        if len(candidates) > 1:
+            self.ambiguous += 1
+            raise AmbiguousPrefix(prefix, candidates)
+        return candidates[0] if candidates else None
+
+    def known_miss(self, prefix: str) -> bool:
+        expires = self._misses.get(prefix.lower())
+        if expires is None:
+            return False
+        if expires < time.monotonic():
+            del self._misses[prefix.lower()]
+            return False
+        return True
+
+    def add_miss(self, prefix: str, ttl: float, max_items: int = 10000):
+        if len(self._misses) >= max_items:
+            self._misses.clear()
+        self._misses[prefix.lower()] = time.monotonic() + ttl
+
+    def stats(self) -> dict:
+        return {"ready": self.ready, "ids": len(self._ids), "collisions": self.collisions, "ambiguous_lookups": self.ambiguous,
+                "known_misses": len(self._misses)}
@@ -0,0 +1,89 @@
+"""
+Deduplicación de webhooks por id de mensaje de WhatsApp (`key.id`).
+
+Evolution reintenta entregas y a veces manda el mismo `messages.upsert` dos veces;
+sin esto el texto entra dos veces al buffer y el archivo se descarga/sube dos veces.
+
+`claim(id)` retorna True sólo la primera vez que ve el id dentro del TTL. Primero
+mira la caché en memoria (sin I/O); si hay backend durable (SQLite) el claim se
+hace con un upsert atómico, así varios workers del mismo host no procesan el mismo
+mensaje y la deduplicación sobrevive a un reinicio.
+"""
+import asyncio
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+
+class _SQLiteKeys:
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS idempotency_keys (key TEXT PRIMARY KEY, expires_at REAL NOT NULL)")
+        self._claims = 0
+
+    def claim(self, key: str, ttl: float) -> bool:
+        now = time.time()
+        with self._lock:
+            # Inserta si no existe, o "revive" la llave si ya expiró; rowcount 0 = duplicado vigente
+            cur = self._conn.execute("""
+                INSERT INTO idempotency_keys (key, expires_at) VALUES (?, ?)
+                ON CONFLICT(key) DO UPDATE SET expires_at = excluded.expires_at
+                WHERE idempotency_keys.expires_at < ?
+            """, (key, now + ttl, now))
+            self._claims += 1
+            if self._claims % 1000 == 0:
+                self._conn.execute("DELETE FROM idempotency_keys WHERE expires_at < ?", (now,))
+            return cur.rowcount == 1
+
+    def release(self, key: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM idempotency_keys WHERE key = ?", (key,))
+
+
+class IdempotencyCache:
+    def __init__(self, ttl: float = 86400.0, max_items: int = 50000, db_path: Optional[str] = None):
+        self.ttl = ttl
+        self.max_items = max_items
+        self._seen: "OrderedDict[str, float]" = OrderedDict() # id -> expira (orden de inserción = orden de expiración)
+        self._db = _SQLiteKeys(db_path) if db_path else None
+        self.claimed = 0
+        self.duplicates: Dict[str, int] = {}
+
+    def _purge(self, now: float):
+        while self._seen:
+            key, expires = next(iter(self._seen.items()))
+            if expires > now and len(self._seen) <= self.max_items:
+                break
+            self._seen.popitem(last=False)
+
+    async def claim(self, key: str, kind: str = "text") -> bool:
+        """True si es la primera vez que llega `key`; False (y cuenta el duplicado) si no."""
+        now = time.time()
+        self._purge(now)
+        expires = self._seen.get(key)
+        if expires is not None and expires > now:
+            self.duplicates[kind] = self.duplicates.get(kind, 0) + 1
+            return False
+        self._seen[key] = now + self.ttl
+        if self._db is not None and not await asyncio.to_thread(self._db.claim, key, self.ttl):
+            # Lo reclamó otro worker (o llegó antes de un reinicio)
+            self.duplicates[kind] = self.duplicates.get(kind, 0) + 1
+            return False
+        self.claimed += 1
+        return True
+
+    async def release(self, key: str):
+        """Libera la llave si el procesamiento falló, para que un reintento sí se procese."""
+        self._seen.pop(key, None)
+        if self._db is not None:
+            await asyncio.to_thread(self._db.release, key)
+
+    def stats(self) -> dict:
+        return {"claimed": self.claimed, "duplicates_suppressed": sum(self.duplicates.values()),
+                "duplicates_by_kind": dict(self.duplicates), "size": len(self._seen),
+                "backend": "sqlite" if self._db is not None else "memory"}
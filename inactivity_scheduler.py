@@ -0,0 +1,177 @@
+"""
+Scheduler único de timers de inactividad (reemplaza una Task dormida por teléfono).
+
+- Un min-heap de entradas compactas (deadline, seq, phone) + un dict phone -> entrada
+  vigente. Re-armar es O(log n) (push al heap); cancelar es O(1) y "perezoso": la
+  entrada vieja queda en el heap y se descarta al salir porque su seq ya no coincide.
+  Cuando las entradas muertas superan a las vivas, el heap se reconstruye.
+- Una sola Task duerme hasta el deadline más próximo (o hasta que un arm lo adelante).
+- Persistencia opcional en SQLite (escrituras en un único thread, en orden). Al
+  arrancar se recargan los timers pendientes, así sobreviven a un redeploy.
+- A lo más una vez: antes de disparar se "reclama" la fila en SQLite (DELETE con el
+  mismo deadline/etapa). Si otro worker ya la disparó, o el cliente respondió y se
+  re-armó/canceló desde otro worker, el reclamo falla y no se envía nada.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# handler(phone, lead_id, stage) -> (siguiente_etapa, delay) o None
+Handler = Callable[[str, str, str], Awaitable[Optional[Tuple[str, float]]]]
+
+
+class _TimerStore:
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS inactivity_timers (
+                phone TEXT PRIMARY KEY,
+                lead_id TEXT,
+                stage TEXT NOT NULL,
+                deadline REAL NOT NULL
+            )""")
+
+    def save(self, phone: str, lead_id: str, stage: str, deadline: float):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO inactivity_timers (phone, lead_id, stage, deadline) VALUES (?, ?, ?, ?)",
+                               (phone, lead_id, stage, deadline))
+
+    def delete(self, phone: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM inactivity_timers WHERE phone = ?", (phone,))
+
+    def claim(self, phone: str, stage: str, deadline: float) -> bool:
+        with self._lock:
+            cur = self._conn.execute("DELETE FROM inactivity_timers WHERE phone = ? AND stage = ? AND deadline = ?",
+                                     (phone, stage, deadline))
+            return cur.rowcount == 1
+
+    def load(self) -> List[Tuple[str, str, str, float]]:
+        with self._lock:
+            return [tuple(r) for r in self._conn.execute("SELECT phone, lead_id, stage, deadline FROM inactivity_timers")]
+
+
+class InactivityScheduler:
+    def __init__(self, handler: Handler, db_path: Optional[str] = None, max_lateness: float = 900.0):
+        self.handler = handler
+        self.max_lateness = max_lateness
+        self._store = _TimerStore(db_path) if db_path else None
+        self._store_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="timers-db") if db_path else None
+        self._heap: List[Tuple[float, int, str]] = []
+        self._entries: Dict[str, Tuple[int, str, str, float]] = {} # phone -> (seq, lead_id, stage, deadline)
+        self._seq = itertools.count()
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._firing = set()
+        self.fired: Dict[str, int] = {}
+        self.cancelled = 0
+        self.lost_claims = 0
+
+    def _persist(self, op: str, *args):
+        """Operación sobre SQLite en orden (un solo thread); retorna el future sin bloquear al llamador."""
+        if self._store is None:
+            return None
+        return asyncio.get_running_loop().run_in_executor(self._store_pool, getattr(self._store, op), *args)
+
+    def _push(self, phone: str, lead_id: str, stage: str, deadline: float):
+        seq = next(self._seq)
+        self._entries[phone] = (seq, lead_id, stage, deadline)
+        heapq.heappush(self._heap, (deadline, seq, phone))
+        if len(self._heap) > 64 and len(self._heap) > 2 * len(self._entries):
+            # Compactar: sacar las entradas canceladas/re-armadas acumuladas
+            self._heap = [(d, s, p) for p, (s, _, _, d) in self._entries.items()]
+            heapq.heapify(self._heap)
+        if self._wake is not None and self._heap[0][1] == seq:
+            self._wake.set() # El nuevo deadline es el más próximo: despertar al loop
+
+    def arm(self, phone: str, lead_id: str, delay: float, stage: str):
+        """Programa (o re-programa) el timer del teléfono."""
+        deadline = time.time() + delay
+        self._push(phone, lead_id, stage, deadline)
+        self._persist("save", phone, lead_id, stage, deadline)
+
+    def cancel(self, phone: str) -> bool:
+        if self._entries.pop(phone, None) is None:
+            return False
+        self.cancelled += 1
+        self._persist("delete", phone)
+        return True
+
+    async def start(self):
+        self._wake = asyncio.Event()
+        if self._store is not None:
+            now = time.time()
+            rows = await self._persist("load")
+            for phone, lead_id, stage, deadline in rows:
+                if now - deadline > self.max_lateness:
+                    # Demasiado tarde para avisar (p.ej. caída larga): se descarta
+                    await self._persist("delete", phone)
+                    continue
+                self._push(phone, lead_id, stage, deadline)
+            if self._entries:
+                logger.info(f"♻️ Timers de inactividad recuperados: {len(self._entries)}")
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Lo que no alcanzó a dispararse queda en SQLite y se recupera al volver a arrancar
+        pending = [t for t in [self._task, *self._firing] if t]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if self._store_pool:
+            self._store_pool.shutdown(wait=True)
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                deadline, seq, phone = heapq.heappop(self._heap)
+                entry = self._entries.get(phone)
+                if entry is None or entry[0] != seq:
+                    continue # Cancelado o re-armado
+                del self._entries[phone]
+                task = asyncio.create_task(self._fire(phone, entry[1], entry[2], deadline))
+                self._firing.add(task)
+                task.add_done_callback(self._firing.discard)
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fire(self, phone: str, lead_id: str, stage: str, deadline: float):
+        if self._store is not None and not await self._persist("claim", phone, stage, deadline):
+            self.lost_claims += 1
+            return
+        self.fired[stage] = self.fired.get(stage, 0) + 1
+        try:
+            nxt = await self.handler(phone, lead_id, stage)
+        except Exception as e:
+            logger.error(f"⚠️ Error disparando timer de inactividad ({stage}) para {phone}: {e}")
+            return
+        # Si el cliente respondió mientras enviábamos, ya hay otro timer: no lo pisamos
+        if nxt and phone not in self._entries:
+            self.arm(phone, lead_id, nxt[1], nxt[0])
+
+    def stats(self) -> dict:
+        return {
+            "scheduled": len(self._entries),
+            "heap_size": len(self._heap),
+            "next_in_s": round(self._heap[0][0] - time.time(), 1) if self._heap else None,
+            "fired": dict(self.fired),
+            "cancelled": self.cancelled,
+            "lost_claims": self.lost_claims,
+            "backend": "sqlite" if self._store is not None else "memory",
+        }
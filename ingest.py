@@ -93,6 +93,23 @@ def ingest_data():
     )
 
     print("✅ Ingesta completada con éxito. ¡Tu IA ya tiene memoria!")
+    notificar_servidor()
+
+def notificar_servidor():
+    """Pide al servidor que recargue su índice local de conocimiento (si SERVER_URL está configurado)."""
+    server_url = os.getenv("SERVER_URL")
+    if not server_url:
+        print("ℹ️  SERVER_URL no configurado: reinicia el servidor o llama POST /knowledge/reload para usar los nuevos chunks.")
+        return
+    try:
+        import requests
+        admin_key = os.getenv("ADMIN_API_KEY")
+        headers = {"x-admin-key": admin_key} if admin_key else {}
+        resp = requests.post(f"{server_url.rstrip('/')}/knowledge/reload", headers=headers, timeout=30)
+        resp.raise_for_status()
+        print(f"🔄 Índice del servidor recargado: {resp.json()}")
+    except Exception as e:
+        print(f"⚠️  No se pudo notificar al servidor ({e}). Llama POST /knowledge/reload manualmente.")
 
 if __name__ == "__main__":
     setup_database()
@@ -0,0 +1,160 @@
+"""
+Render de facturas proforma fuera del event loop.
+
+- El canvas de reportlab se dibuja en un ProcessPoolExecutor (CPU puro: no bloquea
+  al webhook aunque el dashboard pida muchas facturas seguidas).
+- Los PDFs quedan en una caché LRU por (order_id, versión). La versión es un hash de
+  todos los campos que se imprimen (incluido `updated_at`), así reenviar la misma
+  factura no cuesta CPU y cualquier cambio en la orden o el cliente la invalida.
+"""
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from typing import Dict, Optional, Tuple
+
+from reportlab.lib.pagesizes import LETTER
+from reportlab.lib.units import cm
+from reportlab.pdfgen import canvas
+
+from turn_metrics import TurnTimings
+
+WIDTH, HEIGHT = LETTER
+
+def invoice_fields(order: Dict, lead: Dict) -> Dict:
+    """Sólo lo que se imprime (dict chico y serializable para mandarlo al proceso worker)."""
+    return {
+        "order_id": order["id"],
+        "created_at": order.get("created_at") or "",
+        "updated_at": order.get("updated_at") or "",
+        "description": order.get("description", "Servicio de Impresión"),
+        "total_amount": order.get("total_amount", 0),
+        "name": lead.get("name", "Cliente"),
+        "rut": lead.get("rut", "No informado"),
+        "email": lead.get("email", "--"),
+    }
+
+
+def invoice_version(fields: Dict) -> str:
+    return hashlib.sha1(json.dumps(fields, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+
+def render_invoice(fields: Dict) -> bytes:
+    """Dibuja la factura (corre en el proceso worker)."""
+    buffer = BytesIO()
+    p = canvas.Canvas(buffer, pagesize=LETTER)
+
+    # Logo / Encabezado
+    p.setFont("Helvetica-Bold", 16)
+    p.drawString(2*cm, HEIGHT-2*cm, "PITRÓN BEÑA IMPRESIÓN")
+    p.setFont("Helvetica", 10)
+    p.drawString(2*cm, HEIGHT-2.5*cm, "Arturo Prat 230, Local 117, Santiago")
+    p.drawString(2*cm, HEIGHT-3*cm, "RUT: 15.355.843-4")
+
+    p.setFont("Helvetica-Bold", 14)
+    p.drawRightString(WIDTH-2*cm, HEIGHT-2*cm, "FACTURA PROFORMA")
+    p.setFont("Helvetica", 10)
+    p.drawRightString(WIDTH-2*cm, HEIGHT-2.5*cm, f"Orden: #{fields['order_id'][:8]}")
+    p.drawRightString(WIDTH-2*cm, HEIGHT-3*cm, f"Fecha: {fields['created_at'][:10]}")
+
+    # Datos Cliente
+    p.line(2*cm, HEIGHT-4*cm, WIDTH-2*cm, HEIGHT-4*cm)
+    p.setFont("Helvetica-Bold", 11)
+    p.drawString(2*cm, HEIGHT-4.8*cm, "DATOS DEL CLIENTE:")
+    p.setFont("Helvetica", 10)
+    p.drawString(2*cm, HEIGHT-5.4*cm, f"Nombre: {fields['name']}")
+    p.drawString(2*cm, HEIGHT-6*cm, f"RUT: {fields['rut']}")
+    p.drawString(2*cm, HEIGHT-6.6*cm, f"Email: {fields['email']}")
+
+    # Detalle
+    p.line(2*cm, HEIGHT-7.5*cm, WIDTH-2*cm, HEIGHT-7.5*cm)
+    p.setFont("Helvetica-Bold", 11)
+    p.drawString(2*cm, HEIGHT-8.2*cm, "DESCRIPCIÓN")
+    p.drawRightString(WIDTH-2*cm, HEIGHT-8.2*cm, "TOTAL (IVA INC.)")
+
+    p.setFont("Helvetica", 10)
+    p.drawString(2*cm, HEIGHT-9.2*cm, fields["description"])
+    p.drawRightString(WIDTH-2*cm, HEIGHT-9.2*cm, f"${fields['total_amount']:,}")
+
+    # Pie de página / Transferencia
+    p.line(2*cm, 4*cm, WIDTH-2*cm, 4*cm)
+    p.setFont("Helvetica-Bold", 10)
+    p.drawString(2*cm, 3.4*cm, "DATOS DE TRANSFERENCIA:")
+    p.setFont("Helvetica", 9)
+    p.drawString(2*cm, 2.9*cm, "Banco Santander - Cta Corriente 79-63175-2")
+    p.drawString(2*cm, 2.4*cm, "Luis Pitron - RUT 15.355.843-4 - contacto@pitron.cl")
+
+    p.showPage()
+    p.save()
+    pdf_bytes = buffer.getvalue()
+    buffer.close()
+    return pdf_bytes
+
+
+class InvoiceRenderer:
+    def __init__(self, workers: int = 2, cache_items: int = 256):
+        self.workers = workers
+        self.cache_items = cache_items
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._cache: "OrderedDict[Tuple[str, str], bytes]" = OrderedDict()
+        self._inflight: Dict[Tuple[str, str], asyncio.Future] = {}
+        self.timings = TurnTimings()
+        self.hits = 0
+        self.misses = 0
+
+    def start(self):
+        if self.workers > 0 and self._pool is None:
+            # spawn: el worker no hereda el event loop ni los sockets del servidor
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def render(self, fields: Dict) -> Tuple[bytes, bool]:
+        """PDF de la factura y si salió de la caché. Pedidos simultáneos de la misma versión se renderizan una vez."""
+        key = (fields["order_id"], invoice_version(fields))
+        pdf = self._cache.get(key)
+        if pdf is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return pdf, True
+        if key in self._inflight:
+            self.hits += 1
+            return await asyncio.shield(self._inflight[key]), True
+
+        self.misses += 1
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._inflight[key] = fut
+        start = time.perf_counter()
+        try:
+            self.start()
+            pdf = await loop.run_in_executor(self._pool, render_invoice, fields)
+            self.timings.record("render", (time.perf_counter() - start) * 1000)
+            fut.set_result(pdf)
+        except BaseException as e:
+            self.timings.record("render", (time.perf_counter() - start) * 1000, "error")
+            fut.set_exception(e)
+            fut.exception() # Marcada como leída aunque nadie más la espere
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+        self._cache[key] = pdf
+        # Una sola versión por orden: la anterior ya no sirve
+        for old in [k for k in self._cache if k[0] == key[0] and k != key]:
+            del self._cache[old]
+        while len(self._cache) > self.cache_items:
+            self._cache.popitem(last=False)
+        return pdf, False
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"workers": self.workers, "cached": len(self._cache), "hits": self.hits, "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 3) if total else 0.0, "latency": self.timings.stats()}
@@ -0,0 +1,92 @@
+"""
+Caché en memoria de la "sesión" de cada lead para el turno del agente.
+
+Un turno en frío lee el lead (una sola select con todas las columnas que usa el
+agente) y sus archivos pendientes; en caliente ambas cosas salen de aquí y la
+única lectura a la DB es el historial. Las escrituras propias del bot se reflejan
+con write-through (`update`) y los endpoints del dashboard invalidan explícitamente.
+El TTL acota lo desactualizado que puede quedar un worker que no vio la invalidación.
+"""
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+LEAD_COLUMNS = "id, name, rut, email, address, ai_enabled, profile_picture_url"
+
+
+class LeadSession:
+    __slots__ = ("lead_id", "phone", "row", "loaded_at", "pending_files", "last_touch", "summary")
+
+    def __init__(self, phone: str, row: Dict):
+        self.lead_id = row["id"]
+        self.phone = phone
+        self.row = row
+        self.loaded_at = time.monotonic()
+        self.pending_files: Optional[List[Dict]] = None # None = no cargado aún
+        self.last_touch = 0.0 # Última escritura de last_interaction
+        self.summary: Optional[Tuple[str, Optional[str]]] = None # (resumen, summary_until); None = no cargado aún
+
+
+class LeadSessionCache:
+    def __init__(self, ttl: float = 120.0, max_items: int = 10000):
+        self.ttl = ttl
+        self.max_items = max_items
+        self._by_phone: "OrderedDict[str, LeadSession]" = OrderedDict()
+        self._phone_by_lead: Dict[str, str] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, phone: str) -> Optional[LeadSession]:
+        session = self._by_phone.get(phone)
+        if session is None or time.monotonic() - session.loaded_at > self.ttl:
+            if session is not None:
+                self._drop(phone)
+            self.misses += 1
+            return None
+        self._by_phone.move_to_end(phone)
+        self.hits += 1
+        return session
+
+    def put(self, session: LeadSession):
+        self._drop(session.phone)
+        self._by_phone[session.phone] = session
+        self._phone_by_lead[session.lead_id] = session.phone
+        while len(self._by_phone) > self.max_items:
+            old_phone, old = self._by_phone.popitem(last=False)
+            self._phone_by_lead.pop(old.lead_id, None)
+
+    def by_lead(self, lead_id: str) -> Optional[LeadSession]:
+        phone = self._phone_by_lead.get(lead_id)
+        return self._by_phone.get(phone) if phone else None
+
+    def update(self, lead_id: str, fields: Dict):
+        """Write-through: refleja en caché un update que ya se hizo en la DB."""
+        session = self.by_lead(lead_id)
+        if session:
+            session.row.update(fields)
+
+    def invalidate(self, lead_id: str = None, phone: str = None):
+        if lead_id and not phone:
+            phone = self._phone_by_lead.get(lead_id)
+        if phone:
+            self._drop(phone)
+
+    def invalidate_pending_files(self, lead_id: str = None):
+        """Olvida los archivos pendientes de un lead (o de todos si lead_id es None)."""
+        if lead_id is None:
+            for session in self._by_phone.values():
+                session.pending_files = None
+            return
+        session = self.by_lead(lead_id)
+        if session:
+            session.pending_files = None
+
+    def _drop(self, phone: str):
+        session = self._by_phone.pop(phone, None)
+        if session:
+            self._phone_by_lead.pop(session.lead_id, None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._by_phone),
+                "hit_rate": round(self.hits / total, 3) if total else 0.0}
@@ -0,0 +1,138 @@
+"""
+Cola acotada + pool de workers para ingerir medios (descarga, decode, upload, metadata)
+fuera del request del webhook.
+
+El webhook encola el trabajo y mete en el buffer de conversación un placeholder
+`[MEDIA_PENDIENTE:<id>]`. Antes del turno del LLM, `resolve()` reemplaza cada
+placeholder por el texto final que produjo el worker (URL en Supabase, aviso de
+archivo inválido, etc.). Si el buffer es compartido entre workers, el resultado
+también se publica en el backend para que otro proceso pueda resolverlo.
+"""
+import asyncio
+import logging
+import re
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+PLACEHOLDER_RE = re.compile(r"\[MEDIA_PENDIENTE:([0-9a-f]{32})\]")
+UNRESOLVED_TEXT = "[ARCHIVO EN PROCESAMIENTO: el cliente envió un archivo que aún no termina de subirse]"
+
+
+class MediaIngestQueue:
+    """Pool de N workers consumiendo una asyncio.Queue acotada."""
+
+    def __init__(self, handler: Callable[[dict], Awaitable[str]], workers: int = 4, maxsize: int = 100, results_backend=None,
+                 result_ttl: float = 3600.0):
+        self.handler = handler
+        self.result_ttl = result_ttl
+        self.workers = workers
+        self.results_backend = results_backend
+        self.maxsize = maxsize
+        self._queue: Optional[asyncio.Queue] = None # Se crea en start(), dentro del event loop
+        self._futures: Dict[str, asyncio.Future] = {}
+        self._tasks: List[asyncio.Task] = []
+        self.processed = 0
+        self.failed = 0
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.info(f"📥 Media workers iniciados: {self.workers}")
+
+    async def stop(self):
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def submit(self, job: dict) -> str:
+        """Encola el trabajo y retorna el placeholder que viaja por el buffer."""
+        job_id = uuid.uuid4().hex
+        loop = asyncio.get_running_loop()
+        fut = self._futures[job_id] = loop.create_future()
+        # Si el turno lo resuelve otro proceso (buffer compartido), nadie consume este future:
+        # se descarta pasado result_ttl, igual que los media_results sin reclamar
+        fut.add_done_callback(lambda _: loop.call_later(self.result_ttl, self._futures.pop, job_id, None))
+        # Si la cola está llena esperamos (backpressure) en vez de descartar el archivo
+        await self._queue.put((job_id, job))
+        return f"[MEDIA_PENDIENTE:{job_id}]"
+
+    async def _worker(self, n: int):
+        while True:
+            job_id, job = await self._queue.get()
+            try:
+                text = await self.handler(job)
+                self.processed += 1
+            except Exception as e:
+                logger.error(f"❌ Media worker {n}: fallo procesando {job.get('kind')}: {e}")
+                text = "[ERROR INTERNO PROCESANDO ARCHIVO - EL USUARIO ENVIÓ UN ARCHIVO PERO FALLÓ EL PROCESO]"
+                self.failed += 1
+            finally:
+                self._queue.task_done()
+            fut = self._futures.get(job_id)
+            if fut is None:
+                continue # El turno ya se resolvió sin este medio (timeout): nadie espera el resultado
+            if not fut.done():
+                fut.set_result(text)
+            if self.results_backend is not None:
+                try:
+                    await self.results_backend.put_result(job_id, text)
+                except Exception as e:
+                    logger.error(f"⚠️ No se pudo publicar resultado de media {job_id}: {e}")
+
+    async def _poll_result(self, job_id: str, deadline: float) -> Optional[str]:
+        """El trabajo lo encoló otro worker: esperamos su resultado en el backend compartido."""
+        loop = asyncio.get_running_loop()
+        while loop.time() < deadline:
+            text = await self.results_backend.pop_result(job_id)
+            if text is not None:
+                return text
+            await asyncio.sleep(min(0.25, max(0.0, deadline - loop.time())))
+        return None
+
+    async def _wait_all(self, job_ids: List[str], timeout: float) -> Dict[str, Optional[str]]:
+        """Espera todos los medios del turno a la vez, con UN solo plazo compartido."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        local = {job_id: self._futures[job_id] for job_id in job_ids if job_id in self._futures}
+        remote = {}
+        if self.results_backend is not None:
+            remote = {job_id: asyncio.ensure_future(self._poll_result(job_id, deadline)) for job_id in job_ids if job_id not in local}
+        waiters = [*local.values(), *remote.values()]
+        if waiters:
+            await asyncio.wait(waiters, timeout=timeout)
+
+        results: Dict[str, Optional[str]] = {}
+        for job_id in job_ids:
+            fut = local.get(job_id) or remote.get(job_id)
+            results[job_id] = fut.result() if fut is not None and fut.done() and not fut.cancelled() else None
+        for task in remote.values():
+            task.cancel()
+        for job_id in local:
+            # Consumido o abandonado por timeout: si el worker termina después, ya nadie lo espera
+            self._futures.pop(job_id, None)
+            if self.results_backend is not None:
+                await self.results_backend.pop_result(job_id)
+        return results
+
+    async def resolve(self, texts: List[str], timeout: float = 30.0) -> List[str]:
+        """Reemplaza los placeholders por el texto final (o un aviso si no alcanzó a terminar)."""
+        job_ids = [job_id for text in texts for job_id in PLACEHOLDER_RE.findall(text)]
+        if not job_ids:
+            return list(texts)
+        results = await self._wait_all(job_ids, timeout)
+        resolved = []
+        for text in texts:
+            for job_id in PLACEHOLDER_RE.findall(text):
+                final = results.get(job_id)
+                if final is None:
+                    logger.warning(f"⏳ Media {job_id} no terminó a tiempo para el turno")
+                    final = UNRESOLVED_TEXT
+                text = text.replace(f"[MEDIA_PENDIENTE:{job_id}]", final)
+            resolved.append(text)
+        return resolved
+
+    def stats(self) -> dict:
+        return {"queued": self._queue.qsize() if self._queue else 0, "workers": self.workers, "in_flight": len(self._futures),
+                "processed": self.processed, "failed": self.failed}
@@ -0,0 +1,6 @@
+-- Marca de agua del auditor nocturno: último mensaje ya auditado por teléfono
+CREATE TABLE IF NOT EXISTS audit_watermarks (
+    phone_number TEXT PRIMARY KEY,
+    last_message_at TIMESTAMPTZ NOT NULL,
+    audited_at TIMESTAMPTZ DEFAULT NOW()
+);
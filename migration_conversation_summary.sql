@@ -0,0 +1,5 @@
+
+-- Resumen rodante de la conversación (historial antiguo que ya no entra en la ventana de tokens)
+ALTER TABLE leads
+ADD COLUMN IF NOT EXISTS conversation_summary TEXT,
+ADD COLUMN IF NOT EXISTS summary_until TIMESTAMPTZ; -- created_at del último mensaje incluido en el resumen
@@ -0,0 +1,5 @@
+
+-- Blobs direccionados por contenido: file_path es la ruta lógica (carpeta del explorador)
+-- y blob_path el objeto físico compartido en el bucket (blobs/ab/<sha256>.<ext>)
+ALTER TABLE file_metadata
+ADD COLUMN IF NOT EXISTS blob_path TEXT;
@@ -0,0 +1,6 @@
+
+-- Hash de contenido de los archivos (sha256 hex calculado al vuelo durante la subida)
+ALTER TABLE file_metadata
+ADD COLUMN IF NOT EXISTS content_hash TEXT;
+
+CREATE INDEX IF NOT EXISTS idx_file_metadata_content_hash ON file_metadata (content_hash);
@@ -0,0 +1,13 @@
+
+-- Catálogo de precios editable sin redeploy (si no hay fila activa, el servidor usa price_catalog.json)
+CREATE TABLE IF NOT EXISTS price_catalog (
+  id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+  catalog JSONB NOT NULL, -- Mismo formato que price_catalog.json
+  active BOOLEAN DEFAULT FALSE,
+  updated_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+ALTER TABLE price_catalog ENABLE ROW LEVEL SECURITY;
+CREATE POLICY "Enable read/write for all" ON price_catalog FOR ALL USING (true) WITH CHECK (true);
+
+-- Tras editar: POST /quotes/reload para que el servidor tome los nuevos precios
@@ -0,0 +1,94 @@
+"""
+Ring buffer en memoria de los últimos payloads del webhook (para depuración).
+
+Reemplaza el volcado de cada request a `last_payload.json`: el payload se muestrea
+(PAYLOAD_SAMPLE_RATE), se redacta el base64 de los medios y se guarda en un deque
+acotado. Opcionalmente se copia a un archivo rotativo desde un hilo en segundo
+plano (QueueHandler/QueueListener), nunca desde el event loop.
+"""
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import re
+import time
+from collections import deque
+from typing import Any, List, Optional
+
+# Claves que en Evolution API traen binarios en base64
+REDACTED_KEYS = {"base64", "evolution_base64", "jpegThumbnail", "thumbnail", "media"}
+MAX_STRING_LEN = 512
+_BASE64_RE = re.compile(r"^(data:[\w/+.-]+;base64,)?[A-Za-z0-9+/=\s]+$")
+
+
+def redact(value: Any) -> Any:
+    """Copia el payload reemplazando base64 y strings gigantes por un resumen."""
+    if isinstance(value, dict):
+        out = {}
+        for k, v in value.items():
+            if k in REDACTED_KEYS and isinstance(v, str) and v:
+                out[k] = f"<base64 redactado: {len(v)} chars>"
+            else:
+                out[k] = redact(v)
+        return out
+    if isinstance(value, list):
+        return [redact(v) for v in value]
+    if isinstance(value, str) and len(value) > MAX_STRING_LEN:
+        if _BASE64_RE.match(value[:MAX_STRING_LEN]):
+            return f"<base64 redactado: {len(value)} chars>"
+        return value[:MAX_STRING_LEN] + f"... <truncado: {len(value)} chars>"
+    return value
+
+
+class PayloadRing:
+    """Últimos N payloads redactados, con muestreo y spool opcional a archivo rotativo."""
+
+    def __init__(self, size: int = 200, sample_rate: float = 1.0, spool_path: Optional[str] = None,
+                 spool_max_bytes: int = 5 * 1024 * 1024, spool_backups: int = 3):
+        self._ring = deque(maxlen=size)
+        self.sample_rate = sample_rate
+        self.seen = 0
+        self.sampled = 0
+        self._spool_logger = None
+        self._listener = None
+        if spool_path:
+            file_handler = logging.handlers.RotatingFileHandler(
+                spool_path, maxBytes=spool_max_bytes, backupCount=spool_backups, encoding="utf-8"
+            )
+            file_handler.setFormatter(logging.Formatter("%(message)s"))
+            spool_queue = queue.SimpleQueue()
+            self._listener = logging.handlers.QueueListener(spool_queue, file_handler)
+            self._spool_logger = logging.getLogger("payload_spool")
+            self._spool_logger.propagate = False
+            self._spool_logger.setLevel(logging.INFO)
+            self._spool_logger.addHandler(logging.handlers.QueueHandler(spool_queue))
+
+    def start(self):
+        if self._listener:
+            self._listener.start()
+
+    def stop(self):
+        if self._listener:
+            self._listener.stop()
+
+    def record(self, payload: Any) -> bool:
+        """Registra el payload si cae en la muestra. Retorna True si se guardó."""
+        self.seen += 1
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return False
+        entry = {"received_at": time.time(), "payload": redact(payload)}
+        self._ring.append(entry)
+        self.sampled += 1
+        if self._spool_logger:
+            self._spool_logger.info(json.dumps(entry, ensure_ascii=False))
+        return True
+
+    def last(self, n: int = 20) -> List[dict]:
+        """Los N payloads más recientes (el más nuevo primero)."""
+        items = list(self._ring)[-n:] if n > 0 else []
+        return items[::-1]
+
+    def stats(self) -> dict:
+        return {"seen": self.seen, "sampled": self.sampled, "buffered": len(self._ring),
+                "capacity": self._ring.maxlen, "sample_rate": self.sample_rate}
@@ -0,0 +1,185 @@
+"""
+Motor de cotizaciones a partir de un catálogo de precios (price_catalog.json o tabla).
+
+El catálogo se compila una vez en estructuras de búsqueda:
+producto (por substring, en orden) -> reglas (cantidad / tamaño) -> tabla de precios
+indexada por (lados, terminación). Cotizar es sólo recorrer esas estructuras, así que
+cientos de ítems se resuelven en milisegundos y cambiar un precio no requiere deploy.
+
+La semántica replica exactamente al `calculate_quote` original (matching por
+substring, orden de evaluación, redondeos y texto de salida); scripts/verify_quote_engine.py
+lo comprueba contra la implementación anterior.
+"""
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+WILDCARD = "*"
+
+
+def _compile_prices(spec: Any) -> Dict[Tuple[str, str], int]:
+    """`12800` o `{"1/normal": 8330, "2/*": 47600}` -> {(lados, terminación): precio}."""
+    if isinstance(spec, (int, float)):
+        return {(WILDCARD, WILDCARD): spec}
+    table = {}
+    for key, value in spec.items():
+        sides, _, finish = key.partition("/")
+        table[(sides or WILDCARD, finish or WILDCARD)] = value
+    return table
+
+
+def _lookup(table: Dict[Tuple[str, str], int], sides_key: str, finish: str) -> Optional[int]:
+    for key in ((sides_key, finish), (sides_key, WILDCARD), (WILDCARD, finish), (WILDCARD, WILDCARD)):
+        if key in table:
+            return table[key]
+    # Terminación desconocida: cae al precio "normal" (igual que el if/else original)
+    for key in ((sides_key, "normal"), (WILDCARD, "normal")):
+        if key in table:
+            return table[key]
+    return None
+
+
+class _Rule:
+    __slots__ = ("qty_eq", "qty_min", "sizes", "lead_time", "fixed", "per", "prices", "size_tiers", "default_prices", "quantity_tiers")
+
+    def __init__(self, spec: Dict):
+        quantity = spec.get("quantity") or {}
+        self.qty_eq = quantity.get("eq")
+        self.qty_min = quantity.get("min")
+        self.sizes = tuple(s.lower() for s in spec.get("sizes", ()))
+        self.lead_time = spec.get("lead_time")
+        self.fixed = bool(spec.get("fixed"))
+        self.per = spec.get("per", 1)
+        self.prices = _compile_prices(spec["price"]) if "price" in spec else None
+        self.size_tiers = [(tuple(s.lower() for s in t["sizes"]), _compile_prices(t["price"])) for t in spec.get("size_tiers", ())]
+        self.default_prices = _compile_prices(spec["default_price"]) if "default_price" in spec else None
+        self.quantity_tiers = [(t.get("below"), _compile_prices(t["price"])) for t in spec.get("quantity_tiers", ())]
+        if self.prices is None and not self.size_tiers and not self.quantity_tiers:
+            raise ValueError("Regla de precio sin 'price', 'size_tiers' ni 'quantity_tiers'")
+
+    def matches(self, quantity: int, size_key: str) -> bool:
+        if self.qty_eq is not None and quantity != self.qty_eq:
+            return False
+        if self.qty_min is not None and quantity < self.qty_min:
+            return False
+        if self.sizes and not any(s in size_key for s in self.sizes):
+            return False
+        return True
+
+    def unit_price(self, quantity: int, size_key: str, sides_key: str, finish: str) -> Optional[int]:
+        if self.prices is not None:
+            return _lookup(self.prices, sides_key, finish)
+        if self.size_tiers:
+            for sizes, table in self.size_tiers:
+                if any(s in size_key for s in sizes):
+                    return _lookup(table, sides_key, finish)
+            return _lookup(self.default_prices, sides_key, finish) if self.default_prices else None
+        for below, table in self.quantity_tiers:
+            if below is None or quantity < below:
+                return _lookup(table, sides_key, finish)
+        return None
+
+    def neto(self, price: int, quantity: int) -> int:
+        if self.fixed:
+            return price
+        if self.per == 1:
+            return price * quantity
+        return int(price / self.per * quantity)
+
+
+class _Product:
+    __slots__ = ("key", "match", "lead_time", "strip_spaces", "rules")
+
+    def __init__(self, spec: Dict):
+        self.key = spec["key"]
+        self.match = tuple(m.lower() for m in spec["match"])
+        self.lead_time = spec.get("lead_time", "Consultar")
+        self.strip_spaces = spec.get("size_normalize") == "strip_spaces"
+        self.rules = [_Rule(r) for r in spec["rules"]]
+
+
+class PriceCatalog:
+    def __init__(self, data: Dict):
+        self.version = data.get("version")
+        self.products = [_Product(p) for p in data["products"]]
+        design = data.get("design") or {}
+        self.design_tiers = [(t["match"], t["price"]) for t in design.get("tiers", ())]
+        self.design_bonus = design.get("bonus")
+
+    @classmethod
+    def from_file(cls, path: str) -> "PriceCatalog":
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def _find_product(self, product_type: str) -> Optional[_Product]:
+        p_lower = product_type.lower()
+        for product in self.products:
+            if any(m in p_lower for m in product.match):
+                return product
+        return None
+
+    def quote(self, product_type: str, quantity: int, sides: int = 1, finish: str = "normal",
+              design_service: str = "none", size: str = "estandar") -> Dict:
+        """Cotización estructurada. `ok` es False cuando no hay precio automático."""
+        neto = 0
+        plazo = "Consultar"
+        product = self._find_product(product_type)
+        if product is not None:
+            plazo = product.lead_time
+            size_key = size.lower()
+            if product.strip_spaces:
+                size_key = size_key.replace(" ", "")
+            sides_key = "2" if sides == 2 else "1"
+            for rule in product.rules:
+                if not rule.matches(quantity, size_key):
+                    continue
+                plazo = rule.lead_time or plazo
+                price = rule.unit_price(quantity, size_key, sides_key, finish)
+                if price is not None:
+                    neto = rule.neto(price, quantity)
+                break
+
+        result = {"product": product.key if product else None, "ok": neto != 0, "neto": neto,
+                  "costo_diseno": 0, "bonificacion": False, "total": neto, "plazo": plazo}
+        if neto == 0:
+            return result
+
+        ds_lower = design_service.lower()
+        costo_diseno = 0
+        for match, price in self.design_tiers:
+            if match in ds_lower:
+                costo_diseno = price
+                break
+        bonus = self.design_bonus
+        if bonus and neto >= bonus["min_neto"] and bonus["match"] in ds_lower:
+            costo_diseno = 0
+            result["bonificacion"] = True
+        result["costo_diseno"] = costo_diseno
+        result["total"] = neto + costo_diseno
+        return result
+
+    def format_quote(self, result: Dict, product_type: str, quantity: int, size: str = "estandar") -> str:
+        if not result["ok"]:
+            return f"⚠️ No tengo precio automático para {product_type} {size}. Por favor, consulta manualmente."
+        neto = result["neto"]
+        costo_diseno = result["costo_diseno"]
+        total = result["total"]
+        plazo = result["plazo"]
+        bono_txt = self.design_bonus["text"] if result["bonificacion"] else ""
+        detalle = f"Valor Base (IVA Inc): ${neto:,} + Diseño (IVA Inc): ${costo_diseno:,}{bono_txt}"
+        return f"""
+✨ *COTIZACIÓN OFICIAL* ✨
+──────────────────
+📦 *Producto:* {product_type} ({size}) x {quantity} u.
+💵 *{detalle}*
+⏳ *Plazo de entrega:* {plazo}
+──────────────────
+💰 *TOTAL FINAL: ${total:,} (IVA Incluido)* ✅
+    """
+
+    def quote_text(self, product_type: str, quantity: int, sides: int = 1, finish: str = "normal",
+                   design_service: str = "none", size: str = "estandar") -> str:
+        result = self.quote(product_type, quantity, sides, finish, design_service, size)
+        return self.format_quote(result, product_type, quantity, size)
+
+    def quote_many(self, items: List[Dict]) -> List[Dict]:
+        return [self.quote(**item) for item in items]
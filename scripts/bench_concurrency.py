@@ -0,0 +1,235 @@
+"""
+Benchmark de concurrencia: ¿cuántas conversaciones simultáneas aguanta UN worker?
+
+Corre el `procesar_y_responder` real de server.py (sesión del lead, ensamblado de
+contexto, bucle del agente con una tool, envío por EvolutionClient y guardado) con
+los clientes externos reemplazados por stubs que sólo agregan latencia:
+  - Supabase (tablas, RPC y storage), embeddings de OpenAI, el LLM (2 llamadas por
+    turno: una pide `calculate_quote`, la otra responde) y la API de Evolution
+    (httpx.MockTransport sobre el mismo pool que usa el servidor).
+
+Se mide de dos formas, con el mismo código del handler:
+  - ANTES: los stubs bloquean el hilo (time.sleep), como los clientes síncronos /
+    requests / invoke que había dentro del event loop.
+  - DESPUÉS: los stubs ceden el control (asyncio.sleep), como AsyncClient / httpx / ainvoke.
+
+Cada conversación usa un teléfono distinto (sesión en frío) y NO se llama a ningún
+servicio real.
+Uso:
+    python scripts/bench_concurrency.py --max 256 --scale 0.1
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Configuración mínima para importar server.py sin servicios reales
+for key, value in {
+    "SUPABASE_URL": "https://bench.supabase.co", "SUPABASE_KEY": "bench", "OPENAI_API_KEY": "sk-bench",
+    "EVOLUTION_API_URL": "http://evolution.bench", "EVOLUTION_API_KEY": "bench", "WHATSAPP_INSTANCE_NAME": "bench",
+    "INACTIVITY_BACKEND": "memory", "BUFFER_BACKEND": "memory", "IDEMPOTENCY_BACKEND": "memory",
+    "FAST_PATH_MODE": "off", "EMBED_CACHE_PATH": "",
+    "EVOLUTION_RATE_PER_SEC": "100000", "EVOLUTION_BURST": "100000", # Se mide el worker, no el rate limit de Evolution
+}.items():
+    os.environ.setdefault(key, value)
+
+import httpx
+from langchain_core.messages import AIMessage
+
+import server
+
+# Latencias típicas por dependencia (segundos), medidas en producción a ojo de log
+LATENCY = {
+    "supabase:leads:select": 0.060,
+    "supabase:leads:update": 0.040,
+    "supabase:message_logs:insert": 0.040,
+    "supabase:message_logs:select": 0.050,
+    "supabase:file_metadata:select": 0.040,
+    "supabase:rpc": 0.060,
+    "supabase": 0.040,
+    "openai:embedding": 0.150,
+    "openai:llm": 1.300,
+    "evolution:send": 0.250,
+}
+
+MODE = {"blocking": False, "scale": 0.1}
+
+
+async def io(kind: str):
+    """Latencia simulada de una dependencia: bloqueante (ANTES) o awaitable (DESPUÉS)."""
+    seconds = LATENCY[kind] * MODE["scale"]
+    if MODE["blocking"]:
+        time.sleep(seconds)
+    else:
+        await asyncio.sleep(seconds)
+
+
+class _Result:
+    def __init__(self, data):
+        self.data = data
+
+
+class StubQuery:
+    _ids = itertools.count(1)
+
+    def __init__(self, table: str):
+        self.table = table
+        self.op = "select"
+        self.payload = None
+
+    def insert(self, payload, **_):
+        self.op, self.payload = "insert", payload
+        return self
+
+    def update(self, payload, **_):
+        self.op, self.payload = "update", payload
+        return self
+
+    def __getattr__(self, _name):
+        # eq / order / limit / select / is_ / gt ... sólo encadenan
+        return lambda *a, **k: self
+
+    async def execute(self):
+        kind = f"supabase:{self.table}:{self.op}"
+        await io(kind if kind in LATENCY else "supabase")
+        if self.op == "insert":
+            rows = self.payload if isinstance(self.payload, list) else [self.payload]
+            return _Result([dict(r, id=f"{self.table}-{next(self._ids)}") for r in rows])
+        if self.table == "leads" and self.op == "select":
+            return _Result([{"id": f"lead-{next(self._ids)}", "name": "Cliente Bench", "ai_enabled": True,
+                             "profile_picture_url": "https://bench/pic.jpg"}])
+        return _Result([])
+
+
+class StubRPC:
+    async def execute(self):
+        await io("supabase:rpc")
+        return _Result([])
+
+
+class StubBucket:
+    async def get_public_url(self, path, *a, **k):
+        return f"https://bench/{path}"
+
+
+class StubStorage:
+    def from_(self, _bucket):
+        return StubBucket()
+
+
+class StubSupabase:
+    storage = StubStorage()
+
+    def table(self, name: str):
+        return StubQuery(name)
+
+    def rpc(self, *_a, **_k):
+        return StubRPC()
+
+
+class StubLLM:
+    """Paso 1 pide calculate_quote (corre en el pool de tools); paso 2 responde."""
+
+    async def ainvoke(self, messages):
+        await io("openai:llm")
+        usage = {"token_usage": {"prompt_tokens": 1200, "completion_tokens": 60, "total_tokens": 1260}}
+        if not any(getattr(m, "type", "") == "tool" for m in messages):
+            return AIMessage(content="", response_metadata=usage, tool_calls=[
+                {"name": "calculate_quote", "args": {"product_type": "tarjetas", "quantity": 1000}, "id": "bench"}])
+        return AIMessage(content="Listo, tu cotización va arriba 😊", response_metadata=usage)
+
+
+async def stub_embedding(_text: str):
+    await io("openai:embedding")
+    return [0.1] * 1536
+
+
+async def evolution_handler(_request: httpx.Request) -> httpx.Response:
+    await io("evolution:send")
+    return httpx.Response(200, json={"key": {"id": "bench"}, "status": "PENDING"})
+
+
+def install_stubs():
+    server.supabase = StubSupabase()
+    server.embedding_cache.embed_fn = stub_embedding
+    server.agent_executor.llm_with_tools = StubLLM()
+    server.agent_executor.llm_final = StubLLM()
+    server.http_client = httpx.AsyncClient(transport=httpx.MockTransport(evolution_handler))
+    server.evolution.bind(server.http_client)
+
+
+_turns = itertools.count(1)
+
+
+async def run_batch(n: int):
+    """Lanza N conversaciones a la vez por el handler real y retorna la latencia de cada una (desde que llegó)."""
+    latencies = []
+    wall_start = time.perf_counter()
+
+    async def one():
+        k = next(_turns)
+        # Teléfono y texto únicos: sesión en frío y embedding sin caché, como un cliente nuevo
+        await server.procesar_y_responder(f"56900{k:06d}", [f"hola, cuánto cuestan 1000 tarjetas? ({k})"], "Bench")
+        latencies.append(time.perf_counter() - wall_start)
+
+    await asyncio.gather(*[one() for _ in range(n)])
+    return latencies, time.perf_counter() - wall_start
+
+
+def p95(values):
+    ordered = sorted(values)
+    return ordered[max(0, int(len(ordered) * 0.95) - 1)]
+
+
+async def capacity(blocking: bool, label: str, max_n: int, slo_factor: float):
+    """Duplica N hasta que el p95 supera el SLO (slo_factor x turno aislado)."""
+    MODE["blocking"] = blocking
+    base = p95((await run_batch(1))[0])
+    slo = base * slo_factor
+    best, mejor_tps = 0, 0.0
+    print(f"\n▶ {label} (turno aislado: {base:.2f}s, SLO p95: {slo:.2f}s)")
+    print(f"  {'N':>5} | {'p50':>7} | {'p95':>7} | {'wall':>7} | {'turnos/s':>8}")
+    n = 1
+    while n <= max_n:
+        lat, wall = await run_batch(n)
+        ok = p95(lat) <= slo
+        print(f"  {n:>5} | {statistics.median(lat):>6.2f}s | {p95(lat):>6.2f}s | {wall:>6.2f}s | {n / wall:>8.1f} {'✅' if ok else '❌'}")
+        if not ok:
+            break
+        best, mejor_tps = n, max(mejor_tps, n / wall)
+        n *= 2
+    return best, mejor_tps
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--max", type=int, default=256, help="N máximo de conversaciones simultáneas a probar")
+    parser.add_argument("--scale", type=float, default=0.1, help="Factor de escala de latencias (1.0 = tiempo real)")
+    parser.add_argument("--slo", type=float, default=2.0, help="SLO p95 como múltiplo del turno aislado")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING) # Los logs por turno del servidor ensucian la tabla
+    MODE["scale"] = args.scale
+    install_stubs()
+
+    antes, tps_antes = await capacity(True, "ANTES (I/O bloqueante)", args.max, args.slo)
+    despues, tps_despues = await capacity(False, "DESPUÉS (I/O async)", args.max, args.slo)
+    server.tool_pool.shutdown(wait=False)
+    await server.http_client.aclose()
+
+    print("\n" + "=" * 60)
+    print("Conversaciones simultáneas por worker dentro del SLO (procesar_y_responder):")
+    print(f"  ANTES:   {antes} ({tps_antes:.1f} turnos/s)")
+    print(f"  DESPUÉS: {despues}{'+' if despues >= args.max else ''} ({tps_despues:.1f} turnos/s)")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,27 +1,42 @@
+"""
+Vista rápida de las conversaciones recientes del agente, agrupadas por teléfono.
+
+Muestra los últimos 5 mensajes de cada conversación con actividad en la ventana
+(por defecto, últimas 24 horas). Antes listaba los últimos 30 mensajes sueltos de
+todas las conversaciones mezcladas.
+
+Uso: python scripts/quick_chat_view.py [horas]   (por defecto, últimas 24 horas)
+"""
 import os
+import sys
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 from supabase import create_client
 
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from conversation_stream import iter_conversations
+
 load_dotenv()
 
 supabase = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"))
 
-# Obtener últimos 30 mensajes
-response = supabase.table("message_logs")\
-    .select("*, leads(name, phone_number)")\
-    .order("created_at", desc=True)\
-    .limit(30)\
-    .execute()
+hours = int(sys.argv[1]) if len(sys.argv) > 1 else 24
+since = (datetime.now(timezone.utc) - timedelta(hours=hours)).isoformat()
 
-print("ÚLTIMAS CONVERSACIONES DEL AGENTE")
+print(f"ÚLTIMAS CONVERSACIONES DEL AGENTE ({hours}h)")
 print("=" * 100)
 
-for msg in response.data:
-    lead_name = msg.get('leads', {}).get('name', 'Desconocido') if msg.get('leads') else 'Desconocido'
-    role = "CLIENTE" if msg['role'] == 'user' else "RICHARD"
-    content = msg['content'][:150] + "..." if len(msg['content']) > 150 else msg['content']
-    intent = f" [{msg['intent']}]" if msg.get('intent') else ""
-    
-    print(f"\n{role} ({lead_name}){intent}:")
-    print(f"  {content}")
-    print(f"  Fecha: {msg['created_at']}")
+for phone, messages in iter_conversations(supabase, since, columns="intent, leads(name)"):
+    lead_name = (messages[-1].get('leads') or {}).get('name') or 'Desconocido'
+    print(f"\n📱 {lead_name} ({phone}) - {len(messages)} mensajes")
+    for msg in messages[-5:]:  # Últimos 5 de cada conversación
+        role = "CLIENTE" if msg['role'] == 'user' else "RICHARD"
+        content = msg['content'] or ""
+        content = content[:150] + "..." if len(content) > 150 else content
+        intent = f" [{msg['intent']}]" if msg.get('intent') else ""
+        
+        print(f"\n{role}{intent}:")
+        print(f"  {content}")
+        print(f"  Fecha: {msg['created_at']}")
@@ -0,0 +1,164 @@
+"""
+Verificación de los blobs por contenido de `chat-media` contra register_order.
+
+Corre el código real de server.py (guardar_blob, buscar_blob, register_order) sobre
+una base y un bucket en memoria, sin servicios reales:
+  1. Un archivo anterior a los blobs (fila con content_hash pero sin blob_path) NO se
+     reutiliza como blob: el mismo contenido se sube a blobs/ab/<sha>.<ext>.
+  2. register_order mueve el objeto legado a la carpeta de la orden y el blob que
+     comparten las filas nuevas sigue existiendo (y no se mueve).
+
+Uso: python scripts/verify_blob_store.py
+"""
+import asyncio
+import itertools
+import os
+import sys
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+for key, value in {
+    "SUPABASE_URL": "https://verify.supabase.co", "SUPABASE_KEY": "verify", "OPENAI_API_KEY": "sk-verify",
+    "EVOLUTION_API_URL": "http://evolution.verify", "EVOLUTION_API_KEY": "verify", "WHATSAPP_INSTANCE_NAME": "verify",
+    "INACTIVITY_BACKEND": "memory",
+}.items():
+    os.environ.setdefault(key, value)
+
+import server
+from blob_store import sha256_hex
+
+
+class _Result:
+    def __init__(self, data):
+        self.data = data
+
+
+class MemoryQuery:
+    _ids = itertools.count(1)
+
+    def __init__(self, db, table):
+        self.db, self.table = db, table
+        self.op, self.payload, self.filters, self.max_rows = "select", None, [], None
+
+    @property
+    def not_(self):
+        query = self
+
+        class _Not:
+            def is_(self, col, _null):
+                query.filters.append(lambda r: r.get(col) is not None)
+                return query
+        return _Not()
+
+    def select(self, *_a, **_k):
+        return self
+
+    def insert(self, payload):
+        self.op, self.payload = "insert", payload
+        return self
+
+    def update(self, payload):
+        self.op, self.payload = "update", payload
+        return self
+
+    def eq(self, col, val):
+        self.filters.append(lambda r: r.get(col) == val)
+        return self
+
+    def is_(self, col, _null):
+        self.filters.append(lambda r: r.get(col) is None)
+        return self
+
+    def gt(self, col, val):
+        self.filters.append(lambda r: str(r.get(col)) > str(val))
+        return self
+
+    def limit(self, n):
+        self.max_rows = n
+        return self
+
+    async def execute(self):
+        rows = self.db.setdefault(self.table, [])
+        if self.op == "insert":
+            row = dict(self.payload, id=f"{self.table[:2]}{next(self._ids):06d}-0000-0000-0000-000000000000",
+                       created_at=datetime.now(timezone.utc).isoformat())
+            rows.append(row)
+            return _Result([dict(row)])
+        matched = [r for r in rows if all(f(r) for f in self.filters)]
+        if self.op == "update":
+            for r in matched:
+                r.update(self.payload)
+        return _Result([dict(r) for r in matched[:self.max_rows]])
+
+
+class MemoryBucket:
+    def __init__(self, objects):
+        self.objects = objects
+
+    async def upload(self, path, data, options=None):
+        if path in self.objects and str((options or {}).get("upsert")).lower() != "true":
+            raise Exception("The resource already exists (Duplicate)")
+        self.objects[path] = data
+
+    async def move(self, src, dst):
+        self.objects[dst] = self.objects.pop(src)
+
+    async def get_public_url(self, path, *_a, **_k):
+        return f"https://cdn/{path}"
+
+
+class MemorySupabase:
+    def __init__(self):
+        self.db = {}
+        self.objects = {}
+        self.storage = self
+
+    def from_(self, _bucket):
+        return MemoryBucket(self.objects)
+
+    def table(self, name):
+        return MemoryQuery(self.db, name)
+
+
+async def main():
+    sb = server.supabase = MemorySupabase()
+    lead = (await sb.table("leads").insert({"name": "Ana", "phone_number": "569000"}).execute()).data[0]
+    pdf = b"%PDF-1.4 verify" * 100
+    content_hash = sha256_hex(pdf)
+
+    # Fila legada (user-021): objeto en su ruta lógica, content_hash sin blob_path
+    legacy_path = "inbox/569000/legacy.pdf"
+    sb.objects[legacy_path] = pdf
+    await sb.table("file_metadata").insert({"file_path": legacy_path, "file_name": "legacy.pdf", "lead_id": lead["id"],
+                                            "content_hash": content_hash, "blob_path": None, "order_id": None}).execute()
+
+    # 1. El mismo contenido llega de nuevo: se sube como blob propio
+    blob = await server.guardar_blob(pdf, "application/pdf", "pdf")
+    assert not blob["reused"], "un objeto legado no debe reutilizarse como blob"
+    assert blob["blob_path"] != legacy_path and blob["blob_path"] in sb.objects
+    for name in ("a.pdf", "b.pdf"):
+        await sb.table("file_metadata").insert({"file_path": f"inbox/569000/{name}", "file_name": name, "lead_id": lead["id"],
+                                                "content_hash": content_hash, "blob_path": blob["blob_path"], "order_id": None}).execute()
+    again = await server.guardar_blob(pdf, "application/pdf", "pdf")
+    assert again["reused"] and again["blob_path"] == blob["blob_path"]
+    print(f"✅ Legado no reutilizado; blob compartido: {blob['blob_path']}")
+
+    # 2. register_order mueve el legado y deja el blob en su lugar
+    res = await server.register_order.ainvoke({
+        "description": "1000 tarjetas", "amount": 20000, "rut": "12.345.678-9", "address": "Calle Falsa 123",
+        "email": "ana@example.com", "has_file": True, "lead_id": lead["id"],
+    })
+    assert "✅" in res, res
+    assert legacy_path not in sb.objects, "el objeto legado debía moverse a la carpeta de la orden"
+    assert blob["blob_path"] in sb.objects, "el blob compartido desapareció tras register_order"
+    assert server.blob_registry.get(content_hash) == blob["blob_path"]
+    rows = sb.db["file_metadata"]
+    assert all(r["order_id"] for r in rows)
+    assert all(r["blob_path"] in sb.objects for r in rows if r["blob_path"])
+    print(f"✅ register_order: legado movido, {sum(1 for r in rows if r['blob_path'])} filas siguen apuntando a un blob existente")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -7,9 +7,11 @@ print("=" * 100)
 print("ANÁLISIS DE CORRECCIONES IMPLEMENTADAS EN SERVER.PY")
 print("=" * 100)
 
-# Leer el archivo server.py
-with open('server.py', 'r', encoding='utf-8') as f:
-    content = f.read()
+# Leer server.py y prompts.py (el prompt de sistema vive en prompts.py)
+content = ""
+for path in ('server.py', 'prompts.py'):
+    with open(path, 'r', encoding='utf-8') as f:
+        content += f.read()
 
 # Verificaciones
 checks = []
@@ -0,0 +1,166 @@
+"""
+Regresión del motor de cotizaciones (quote_engine + price_catalog.json)
+Compara el motor compilado contra la implementación original de calculate_quote
+para todas las combinaciones de producto, tamaño, cantidad, lados, terminación y diseño.
+
+Uso: python scripts/verify_quote_engine.py
+"""
+import itertools
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from quote_engine import PriceCatalog
+
+
+def legacy_calculate_quote(product_type: str, quantity: int, sides: int = 1, finish: str = "normal", design_service: str = "none", size: str = "estandar") -> str:
+    """`calculate_quote` tal como estaba en server.py antes del catálogo de precios."""
+    neto = 0
+    iva_incluido = False 
+    plazo = "Consultar"
+    
+    p_lower = product_type.lower()
+    s_lower = size.lower()
+    
+    # 1. TARJETAS
+    if "tarjeta" in p_lower:
+        plazo = "1 a 3 días hábiles (Entrega al día siguiente si envías el diseño listo)"
+        precio_100_1lado = 8330 # Antes 7000 neto
+        precio_100_2lados = 13090 # Antes 11000 neto
+        if finish == "polilaminado":
+            precio_100_1lado = 14280 # Antes 12000 neto
+            precio_100_2lados = 19040 # Antes 16000 neto
+        
+        # Escala unitaria basada en 100u ($ / 100u)
+        base = precio_100_2lados if sides == 2 else precio_100_1lado
+        unit_price = base / 100
+        neto = int(unit_price * quantity)
+        iva_incluido = True
+
+    # 2. FLYERS
+    elif "flyer" in p_lower:
+        if quantity == 100 and ("10x15" in s_lower or "10x14" in s_lower):
+            neto = 12800 # Antes 10756 neto
+            iva_incluido = True
+            plazo = "1 hora (Express)"
+        elif quantity >= 1000:
+            iva_incluido = True
+            plazo = "3 a 4 días hábiles"
+            if "10x14" in s_lower or "estandar" in s_lower:
+                neto = 47600 if sides == 2 else 23800
+            elif "20x14" in s_lower or "media carta" in s_lower:
+                neto = 95200 if sides == 2 else 47600
+            elif "20x28" in s_lower or "carta" in s_lower:
+                neto = 190400 if sides == 2 else 95200
+            else:
+                neto = 23800 # Fallback 10x14
+            
+            # Ajuste por cantidad si es múltiplo de 1000
+            neto = int((neto / 1000) * quantity)
+
+    # 3. PENDONES ROLLER
+    elif "pendon" in p_lower:
+        plazo = "24-48 horas"
+        precios_pendon = {
+            "80x200": 55930, "90x200": 67830, "100x200": 80920,
+            "120x200": 116620, "150x200": 159650, "200x200": 309400,
+            "250x200": 362404, "300x200": 553486
+        }
+        neto = 0
+        for k, v in precios_pendon.items():
+            if k in s_lower.replace(" ", ""):
+                neto = v * quantity
+                break
+        if neto == 0: neto = 55930 * quantity
+        iva_incluido = True
+
+    # 4. FOAM / TROVICEL
+    elif "foam" in p_lower or "trovicel" in p_lower:
+        plazo = "2 a 3 días"
+        if "33x48" in s_lower:
+            neto = 7140 * quantity
+        else: # Tamaño carta o menor
+            if quantity < 10: unit = 3570
+            elif quantity < 20: unit = 2975
+            elif quantity < 30: unit = 2737
+            else: unit = 2380
+            neto = unit * quantity
+        iva_incluido = True
+
+    if neto == 0:
+        return f"⚠️ No tengo precio automático para {product_type} {size}. Por favor, consulta manualmente."
+
+    # Costo Diseño (Valores con IVA Incluido)
+    # Tiers: basico ($7.140), medio ($35.700), avanzado ($71.400), premium ($214.200)
+    costo_diseno = 0
+    ds_lower = design_service.lower()
+    
+    if "basico" in ds_lower: costo_diseno = 7140
+    elif "medio" in ds_lower: costo_diseno = 35700
+    elif "avanzado" in ds_lower: costo_diseno = 71400
+    elif "premium" in ds_lower: costo_diseno = 214200
+    
+    # Aplicar Diseño Gratuito si la compra supera los $60.000 (Aplica al nivel básico)
+    bono_txt = ""
+    if neto >= 60000 and "basico" in ds_lower:
+        costo_diseno = 0
+        bono_txt = " (Bonificación por compra > $60k)"
+    
+    # Cálculo Final (Todo ya tiene IVA)
+    total = neto + costo_diseno
+    detalle = f"Valor Base (IVA Inc): ${neto:,} + Diseño (IVA Inc): ${costo_diseno:,}{bono_txt}"
+
+    return f"""
+✨ *COTIZACIÓN OFICIAL* ✨
+──────────────────
+📦 *Producto:* {product_type} ({size}) x {quantity} u.
+💵 *{detalle}*
+⏳ *Plazo de entrega:* {plazo}
+──────────────────
+💰 *TOTAL FINAL: ${total:,} (IVA Incluido)* ✅
+    """
+
+
+PRODUCTS = ["tarjetas", "Tarjeta de presentación", "TARJETAS", "flyers", "Flyer", "pendon", "Pendón", "pendon roller",
+            "foam", "Foam board", "trovicel", "sticker", ""]
+SIZES = ["estandar", "10x14", "10x15", "10X15", "20x14", "media carta", "20x28", "carta", "Carta",
+         "80x200", "80 x 200", "90x200", "100x200", "120x200", "150x200", "200x200", "250x200", "300x200",
+         "33x48", "A4", ""]
+QUANTITIES = [-5, 0, 1, 7, 9, 10, 19, 20, 29, 30, 50, 99, 100, 101, 250, 500, 999, 1000, 1500, 2000, 5000]
+SIDES = [1, 2, 3]
+FINISHES = ["normal", "polilaminado", "Polilaminado", "mate"]
+DESIGNS = ["none", "basico", "Básico", "BASICO", "medio", "avanzado", "premium", "basico medio", "complejo"]
+
+
+def main():
+    catalog = PriceCatalog.from_file(os.path.join(ROOT, "price_catalog.json"))
+    print("=" * 100)
+    print(f"REGRESIÓN MOTOR DE COTIZACIONES (catálogo versión {catalog.version})")
+    print("=" * 100)
+
+    total = 0
+    fallos = []
+    cubiertos = set()
+    for product, size, qty, sides, finish, design in itertools.product(PRODUCTS, SIZES, QUANTITIES, SIDES, FINISHES, DESIGNS):
+        total += 1
+        esperado = legacy_calculate_quote(product, qty, sides, finish, design, size)
+        obtenido = catalog.quote_text(product, qty, sides, finish, design, size)
+        if esperado != obtenido:
+            fallos.append((product, size, qty, sides, finish, design, esperado, obtenido))
+        else:
+            cubiertos.add(catalog.quote(product, qty, sides, finish, design, size)["product"])
+
+    print(f"\nCombinaciones comparadas: {total:,}")
+    print(f"Productos cubiertos: {sorted(p for p in cubiertos if p)}")
+    if fallos:
+        print(f"\n❌ {len(fallos)} diferencias. Primeras 10:")
+        for f in fallos[:10]:
+            print(f"\n  {f[:6]}\n  esperado: {f[6]!r}\n  obtenido: {f[7]!r}")
+        sys.exit(1)
+    print("\n✅ El motor compilado coincide exactamente con calculate_quote en todas las combinaciones.")
+
+
+if __name__ == "__main__":
+    main()
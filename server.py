@@ -1,22 +1,42 @@
 import os
-import requests
+import httpx
 import json
 import logging
 import asyncio
-from typing import List, Optional, Any, Dict
+import time
+import gzip
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Any, Dict, Tuple
+from urllib.parse import quote
 from fastapi import FastAPI, Request, BackgroundTasks, UploadFile, File, Form, HTTPException, Response
 from pydantic import BaseModel
 from dotenv import load_dotenv
 from langchain_openai import OpenAIEmbeddings, ChatOpenAI
-from langchain_core.messages import HumanMessage, SystemMessage, AIMessage, ToolMessage
+from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
 from langchain_core.tools import tool
-from supabase import create_client, Client
-from io import BytesIO
-from reportlab.lib.pagesizes import LETTER
-from reportlab.pdfgen import canvas
-from reportlab.lib import colors
-from reportlab.lib.units import cm
+from supabase import acreate_client, AsyncClient
 from datetime import datetime
+from buffer_backends import create_buffer_backend
+from idempotency import IdempotencyCache
+from inactivity_scheduler import InactivityScheduler
+from invoice_renderer import InvoiceRenderer, invoice_fields
+from payload_sampler import PayloadRing
+from media_ingest import MediaIngestQueue
+from embedding_cache import EmbeddingCache
+from vector_index import VectorIndex, parse_vector
+from blob_store import BlobRegistry, blob_path_for, is_duplicate_error, sha256_hex
+from folder_index import FolderIndex
+from id_resolver import AmbiguousPrefix, PrefixIndex, LEAD_PREFIX_LEN, ORDER_PREFIX_LEN, clean_name, order_folder, parse_folder, uuid_bounds
+from lead_sessions import LeadSession, LeadSessionCache, LEAD_COLUMNS
+from turn_metrics import TurnTimings
+from prompts import build_system_prompt, PromptCacheStats
+from quote_engine import PriceCatalog
+from agent_executor import AgentExecutor
+from evolution_client import EvolutionClient
+from fast_path import FastPathClassifier, FastPathStats, build_reply
+from conversation_stream import parse_ts
+from history_window import HistoryStats, LEGACY_WINDOW, count_tokens, message_tokens, select_window
 
 # Logging
 logging.basicConfig(level=logging.INFO)
@@ -38,6 +58,7 @@ app = FastAPI(title="WhatsApp RAG Bot Enterprise V2")
 
 # Configurar CORS para permitir peticiones del Dashboard
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -46,127 +67,281 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# Clientes asíncronos (se inicializan en el evento startup para no bloquear el event loop)
+supabase: AsyncClient = None
+http_client: httpx.AsyncClient = None # Pool keep-alive compartido (Evolution API + descargas de media)
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "50"))
+
+# Cliente Evolution: reintentos, rate limit global y cola FIFO por destinatario (usa el pool http_client)
+evolution = EvolutionClient(
+    EVOLUTION_API_URL, EVOLUTION_API_KEY, INSTANCE_NAME,
+    rate_per_sec=float(os.getenv("EVOLUTION_RATE_PER_SEC", "20")),
+    burst=int(os.getenv("EVOLUTION_BURST", "20")),
+    max_retries=int(os.getenv("EVOLUTION_MAX_RETRIES", "3"))
+)
+
 embeddings = OpenAIEmbeddings(openai_api_key=OPENAI_API_KEY)
 llm = ChatOpenAI(model_name="gpt-4o-mini", temperature=0.1, openai_api_key=OPENAI_API_KEY) # Temp baja para matemáticas
+prompt_cache_stats = PromptCacheStats() # cached_tokens reportados por OpenAI (prefijo estático del prompt)
 
-# --- BUFFER DE MENSAJES (Memoria Volátil) ---
-# Diccionario para agrupar mensajes: { "569...": {"timer": Task, "messages": ["Hola", "precio"]} }
-message_buffer: Dict[str, Any] = {}
+@app.on_event("startup")
+async def init_clients():
+    """Crea los clientes asíncronos compartidos (Supabase/PostgREST y pool HTTP)."""
+    global supabase, http_client
+    supabase = await acreate_client(SUPABASE_URL, SUPABASE_KEY)
+    http_client = httpx.AsyncClient(
+        timeout=15,
+        limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_CONNECTIONS // 2)
+    )
+    evolution.bind(http_client)
+    payload_ring.start()
+    logger.info(f"🔌 Clientes async listos (pool HTTP: {HTTP_MAX_CONNECTIONS} conexiones).")
+
+@app.on_event("shutdown")
+async def close_clients():
+    """Cierra el pool HTTP limpiamente al apagar el worker."""
+    if http_client:
+        await http_client.aclose()
+    payload_ring.stop()
+    tool_pool.shutdown(wait=False)
+
+# --- BUFFER DE MENSAJES ---
+# Los mensajes viven en un backend compartible entre workers (ver buffer_backends.py);
+# aquí sólo guardamos el timer local de cada teléfono: { "569...": Task }
 BUFFER_DELAY = 4.0 # Segundos a esperar por más mensajes
+BUFFER_BACKEND = os.getenv("BUFFER_BACKEND", "memory") # memory | sqlite
+BUFFER_DB_PATH = os.getenv("BUFFER_DB_PATH", "buffer.db")
+buffer_backend = create_buffer_backend(BUFFER_BACKEND, BUFFER_DB_PATH)
+buffer_timers: Dict[str, asyncio.Task] = {}
+
+# --- IDEMPOTENCIA DEL WEBHOOK (dedupe por key.id) ---
+IDEMPOTENCY_BACKEND = os.getenv("IDEMPOTENCY_BACKEND", "memory") # memory | sqlite
+webhook_dedupe = IdempotencyCache(
+    ttl=float(os.getenv("IDEMPOTENCY_TTL", "86400")),
+    db_path=os.getenv("IDEMPOTENCY_DB_PATH", "idempotency.db") if IDEMPOTENCY_BACKEND == "sqlite" else None
+)
 
-# --- GESTIÓN DE INACTIVIDAD ---
-inactivity_timers: Dict[str, asyncio.Task] = {}
+# --- MUESTREO DE PAYLOADS (Depuración) ---
+ADMIN_API_KEY = os.getenv("ADMIN_API_KEY") # Protege los endpoints de admin; sin ella /debug/* no se expone
+payload_ring = PayloadRing(
+    size=int(os.getenv("PAYLOAD_RING_SIZE", "200")),
+    sample_rate=float(os.getenv("PAYLOAD_SAMPLE_RATE", "1.0")),
+    spool_path=os.getenv("PAYLOAD_SPOOL_PATH") or None,
+    spool_max_bytes=int(os.getenv("PAYLOAD_SPOOL_MAX_MB", "5")) * 1024 * 1024
+)
 
-async def inactivity_manager(phone: str, lead_id: str):
-    """Maneja los tiempos de inactividad: 5min alerta, +10min cierre."""
-    try:
-        # 1. Espera de 5 minutos para la ALERTA
-        await asyncio.sleep(300) 
-        
+# --- GESTIÓN DE INACTIVIDAD ---
+# Un solo scheduler (heap de deadlines) para todos los teléfonos, persistido en SQLite
+INACTIVITY_BACKEND = os.getenv("INACTIVITY_BACKEND", "sqlite") # memory | sqlite
+INACTIVITY_ALERT_SECONDS = float(os.getenv("INACTIVITY_ALERT_SECONDS", "300"))
+INACTIVITY_CLOSE_SECONDS = float(os.getenv("INACTIVITY_CLOSE_SECONDS", "600"))
+
+async def disparar_inactividad(phone: str, lead_id: str, etapa: str):
+    """Maneja los tiempos de inactividad: 5min alerta, +10min cierre. Retorna la siguiente etapa (o None)."""
+    if etapa == "alert":
         alerta = "Te comento que nuestra conversación debería ser continua para poder agendar tu trabajo con éxito; de lo contrario, tendríamos que reagendar todo desde cero."
-        enviar_whatsapp(phone, alerta)
-        save_message_pro(lead_id, phone, "assistant", alerta, metadata={"type": "inactivity_alert"})
+        await enviar_whatsapp(phone, alerta)
+        await save_message_pro(lead_id, phone, "assistant", alerta, metadata={"type": "inactivity_alert"})
         logger.info(f"⏰ Alerta de inactividad enviada a {phone}")
+        return ("close", INACTIVITY_CLOSE_SECONDS)
+
+    cierre_msg = "La sesión ha expirado por inactividad. Si deseas continuar, por favor envíanos un nuevo mensaje para iniciar de nuevo."
+    await enviar_whatsapp(phone, cierre_msg)
+    await save_message_pro(lead_id, phone, "assistant", cierre_msg, metadata={"type": "session_closed"})
+    logger.info(f"🚫 Sesión cerrada por inactividad para {phone}")
+    return None
+
+inactivity = InactivityScheduler(
+    disparar_inactividad,
+    db_path=os.getenv("INACTIVITY_DB_PATH", "inactivity.db") if INACTIVITY_BACKEND == "sqlite" else None,
+    max_lateness=float(os.getenv("INACTIVITY_MAX_LATENESS", "900"))
+)
 
-        # 2. Espera de 10 minutos adicionales para el CIERRE
-        await asyncio.sleep(600)
-        
-        cierre_msg = "La sesión ha expirado por inactividad. Si deseas continuar, por favor envíanos un nuevo mensaje para iniciar de nuevo."
-        enviar_whatsapp(phone, cierre_msg)
-        save_message_pro(lead_id, phone, "assistant", cierre_msg, metadata={"type": "session_closed"})
-        logger.info(f"🚫 Sesión cerrada por inactividad para {phone}")
-
-    except asyncio.CancelledError:
-        logger.info(f"✅ Inactividad cancelada para {phone} (Usuario respondió)")
+def iniciar_inactividad(phone: str, lead_id: str):
+    inactivity.arm(phone, lead_id, INACTIVITY_ALERT_SECONDS, "alert")
 
 
 # --- GESTIÓN DE LEADS ---
-def get_whatsapp_profile_picture(phone: str) -> Optional[str]:
+async def get_whatsapp_profile_picture(phone: str) -> Optional[str]:
     """Obtiene la URL de la foto de perfil desde Evolution API."""
     try:
-        from urllib.parse import quote
         # Limpiar el número (solo dígitos)
         clean_phone = "".join(filter(str.isdigit, phone))
-        instance_encoded = quote(INSTANCE_NAME)
-        # IMPORTANTE: Evolution API usa POST para este endpoint
-        url = f"{EVOLUTION_API_URL}/chat/fetchProfilePictureUrl/{instance_encoded}"
-        headers = {
-            "apikey": EVOLUTION_API_KEY,
-            "Content-Type": "application/json"
-        }
-        payload = {"number": clean_phone}
-        
         logger.info(f"📸 Consultando foto para {clean_phone} en Evolution API (POST)...")
-        response = requests.post(url, headers=headers, json=payload, timeout=10)
-        
-        if response.status_code == 200 or response.status_code == 201:
-            data = response.json()
-            # La respuesta puede variar según versión, buscamos campos comunes
-            pic_url = data.get("profilePictureUrl") or data.get("url")
-            if pic_url:
-                logger.info(f"✅ Foto encontrada para {clean_phone}")
-                return pic_url
-            else:
-                logger.warning(f"⚠️ Evolution API respondió {response.status_code} pero sin URL")
-        else:
-            logger.error(f"❌ Error Evolution API ({response.status_code}): {response.text}")
-            
-        return None
+        pic_url = await evolution.fetch_profile_picture(clean_phone)
+        if pic_url:
+            logger.info(f"✅ Foto encontrada para {clean_phone}")
+        return pic_url
     except Exception as e:
         logger.error(f"⚠️ Error recuperando foto de WhatsApp para {phone}: {e}")
         return None
 
-def get_or_create_lead(phone: str, push_name: str = None) -> str:
-    try:
-        response = supabase.table("leads").select("id, name, profile_picture_url").eq("phone_number", phone).execute()
-        if response.data:
-            lead = response.data[0]
-            # Si no tiene foto, intentamos buscarla
-            if not lead.get("profile_picture_url"):
-                pic_url = get_whatsapp_profile_picture(phone)
-                if pic_url:
-                    supabase.table("leads").update({"profile_picture_url": pic_url, "last_interaction": "now()"}).eq("id", lead['id']).execute()
-                else:
-                    supabase.table("leads").update({"last_interaction": "now()"}).eq("id", lead['id']).execute()
+# --- SESIONES DE LEADS (Caché por conversación) ---
+lead_sessions = LeadSessionCache(ttl=float(os.getenv("LEAD_SESSION_TTL", "120")))
+LEAD_TOUCH_INTERVAL = 60 # Segundos mínimos entre escrituras de last_interaction
+
+# Referencias a tareas fire-and-forget (evita que el GC las cancele a medio camino)
+_tareas_fondo = set()
+
+def en_segundo_plano(coro, descripcion: str):
+    """Lanza una corrutina sin bloquear el turno; los errores sólo se registran."""
+    async def runner():
+        try:
+            await coro
+        except Exception as e:
+            logger.error(f"⚠️ Error en tarea de fondo ({descripcion}): {e}")
+    task = asyncio.create_task(runner())
+    _tareas_fondo.add(task)
+    task.add_done_callback(_tareas_fondo.discard)
+
+async def actualizar_foto_perfil(lead_id: str, phone: str):
+    """Busca la foto de WhatsApp y la guarda (se llama en segundo plano)."""
+    pic_url = await get_whatsapp_profile_picture(phone)
+    if pic_url:
+        await supabase.table("leads").update({"profile_picture_url": pic_url}).eq("id", lead_id).execute()
+        lead_sessions.update(lead_id, {"profile_picture_url": pic_url})
+
+async def cargar_sesion_lead(phone: str, push_name: str = None) -> Optional[LeadSession]:
+    """Sesión del lead desde caché; en frío hace UNA select (o el insert si es nuevo)."""
+    session = lead_sessions.get(phone)
+    if session is None:
+        try:
+            response = await supabase.table("leads").select(LEAD_COLUMNS).eq("phone_number", phone).execute()
+            if response.data:
+                row = response.data[0]
             else:
-                supabase.table("leads").update({"last_interaction": "now()"}).eq("id", lead['id']).execute()
-                
-            return lead['id']
-        else:
-            pic_url = get_whatsapp_profile_picture(phone)
-            new_lead = {
-                "phone_number": phone, 
-                "name": push_name, 
-                "status": "new",
-                "profile_picture_url": pic_url
-            }
-            response = supabase.table("leads").insert(new_lead).execute()
-            return response.data[0]['id']
-    except Exception as e:
-        logger.error(f"❌ Error crítico en get_or_create_lead para {phone}: {e}")
-        return None
+                new_lead = {
+                    "phone_number": phone, 
+                    "name": push_name, 
+                    "status": "new"
+                }
+                response = await supabase.table("leads").insert(new_lead).execute()
+                row = response.data[0]
+                lead_ids.add(row["id"], clean_name(row.get("name")))
+            session = LeadSession(phone, row)
+            lead_sessions.put(session)
+            # Si no tiene foto, la buscamos sin frenar la respuesta
+            if not row.get("profile_picture_url"):
+                en_segundo_plano(actualizar_foto_perfil(row["id"], phone), "foto de perfil")
+        except Exception as e:
+            logger.error(f"❌ Error crítico en cargar_sesion_lead para {phone}: {e}")
+            return None
+
+    # last_interaction: escritura throttled y fuera del camino crítico
+    if time.monotonic() - session.last_touch > LEAD_TOUCH_INTERVAL:
+        session.last_touch = time.monotonic()
+        en_segundo_plano(
+            supabase.table("leads").update({"last_interaction": "now()"}).eq("id", session.lead_id).execute(),
+            "last_interaction"
+        )
+    return session
+
+async def get_or_create_lead(phone: str, push_name: str = None) -> str:
+    session = await cargar_sesion_lead(phone, push_name)
+    return session.lead_id if session else None
+
+async def obtener_archivos_pendientes(session: LeadSession) -> List[dict]:
+    """Archivos del lead sin orden de los últimos 120 min (cacheados en la sesión)."""
+    from datetime import timedelta, timezone
+    hace_120_min = datetime.now(timezone.utc) - timedelta(minutes=120)
+    if session.pending_files is None:
+        res = await supabase.table("file_metadata")\
+            .select("id, file_path, blob_path, created_at")\
+            .eq("lead_id", session.lead_id)\
+            .is_("order_id", "null")\
+            .gt("created_at", hace_120_min.isoformat())\
+            .order("created_at")\
+            .execute()
+        session.pending_files = res.data or []
+    # La caché puede sobrevivir a la ventana: re-filtramos por fecha
+    return [f for f in session.pending_files if parse_ts(f["created_at"]) > hace_120_min]
 
 # --- HISTORIAL Y LOGS ---
-def get_chat_history_pro(lead_id: str, limit: int = 10):
-    if not lead_id or lead_id == "None": 
-        logger.warning(f"⚠️ get_chat_history_pro: lead_id es nulo")
-        return []
+# Ventana por presupuesto de tokens + resumen rodante del historial más antiguo
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1500"))
+HISTORY_FETCH_LIMIT = int(os.getenv("HISTORY_FETCH_LIMIT", "40"))
+SUMMARY_MIN_MESSAGES = int(os.getenv("SUMMARY_MIN_MESSAGES", "6")) # Mensajes fuera de ventana antes de re-resumir
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "300"))
+SUMMARY_BATCH_LIMIT = 200 # Tope de mensajes plegados por refresco
+history_stats = HistoryStats()
+_resumenes_en_curso = set()
+
+async def cargar_resumen(session: LeadSession):
+    """Resumen guardado en el lead (cacheado en la sesión). Sin la migración aplicada queda vacío."""
+    if session.summary is None:
+        try:
+            res = await supabase.table("leads").select("conversation_summary, summary_until").eq("id", session.lead_id).execute()
+            row = res.data[0] if res.data else {}
+            session.summary = (row.get("conversation_summary") or "", row.get("summary_until"))
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudo leer el resumen de conversación ({session.lead_id}): {e}")
+            session.summary = ("", None)
+    return session.summary
+
+async def cargar_historial(session: LeadSession):
+    """Historial que cabe en HISTORY_TOKEN_BUDGET + resumen de lo anterior. Retorna (mensajes, resumen)."""
+    response, (resumen, resumen_hasta) = await asyncio.gather(
+        supabase.table("message_logs").select("role, content, created_at").eq("lead_id", session.lead_id)
+            .order("created_at", desc=True).limit(HISTORY_FETCH_LIMIT).execute(),
+        cargar_resumen(session)
+    )
+    rows = (response.data or [])[::-1]
+    legacy_tokens = sum(message_tokens(r) for r in rows[-LEGACY_WINDOW:])
+
+    # Lo que ya está en el resumen no se repite en la ventana
+    if resumen_hasta:
+        corte = parse_ts(resumen_hasta)
+        rows = [r for r in rows if parse_ts(r["created_at"]) > corte]
+    ventana, fuera = select_window(rows, HISTORY_TOKEN_BUDGET)
+
+    window_tokens = sum(message_tokens(r) for r in ventana)
+    summary_tokens = count_tokens(resumen)
+    ahorro = history_stats.record(legacy_tokens, window_tokens, summary_tokens)
+    logger.info(f"📜 Historial: {len(ventana)} msgs ({window_tokens} tk) + resumen ({summary_tokens} tk), ahorro vs ventana fija: {ahorro} tk")
+
+    if len(fuera) >= SUMMARY_MIN_MESSAGES and session.lead_id not in _resumenes_en_curso:
+        _resumenes_en_curso.add(session.lead_id)
+        en_segundo_plano(refrescar_resumen(session, resumen, resumen_hasta, ventana[0]["created_at"]), "resumen de conversación")
+
+    mensajes = []
+    for msg in ventana:
+        if msg['role'] == 'user': mensajes.append(HumanMessage(content=msg['content']))
+        else: mensajes.append(AIMessage(content=msg['content']))
+    return mensajes, resumen
+
+async def refrescar_resumen(session: LeadSession, resumen_previo: str, desde: Optional[str], hasta: str):
+    """Pliega en el resumen los mensajes entre `desde` y el inicio de la ventana (fuera del turno)."""
     try:
-        response = supabase.table("message_logs").select("role, content").eq("lead_id", lead_id).order("created_at", desc=True).limit(limit).execute()
-        mensajes = []
-        for msg in response.data[::-1]:
-            if msg['role'] == 'user': mensajes.append(HumanMessage(content=msg['content']))
-            else: mensajes.append(AIMessage(content=msg['content']))
-        return mensajes
-    except Exception as e: 
-        logger.error(f"❌ Error recuperando historial: {e}")
-        return []
-
-def save_message_pro(lead_id: str, phone: str, role: str, content: str, intent: str = None, tokens: int = None, metadata: dict = None):
+        query = supabase.table("message_logs").select("role, content, created_at").eq("lead_id", session.lead_id).lt("created_at", hasta)
+        if desde:
+            query = query.gt("created_at", desde)
+        res = await query.order("created_at").limit(SUMMARY_BATCH_LIMIT).execute()
+        rows = res.data or []
+        if not rows:
+            return
+        transcript = "\n".join(f"{'Cliente' if r['role'] == 'user' else 'Richard'}: {(r['content'] or '')[:1500]}" for r in rows)
+        instrucciones = (
+            "Resume la conversación entre un cliente y Richard (asistente de Pitrón Beña Impresión) en máximo 8 viñetas. "
+            "Conserva productos, cantidades, precios cotizados, nivel de diseño, datos del cliente (RUT, email, dirección), "
+            "archivos enviados, órdenes creadas y lo que quedó pendiente. Si hay un resumen previo, intégralo."
+        )
+        contenido = (f"RESUMEN PREVIO:\n{resumen_previo}\n\n" if resumen_previo else "") + f"MENSAJES NUEVOS:\n{transcript}"
+        respuesta = await llm.bind(max_tokens=SUMMARY_MAX_TOKENS).ainvoke([SystemMessage(content=instrucciones), HumanMessage(content=contenido)])
+        nuevo = (respuesta.content or "").strip()
+        if not nuevo:
+            return
+        hasta_resumido = rows[-1]["created_at"]
+        await supabase.table("leads").update({"conversation_summary": nuevo, "summary_until": hasta_resumido}).eq("id", session.lead_id).execute()
+        session.summary = (nuevo, hasta_resumido)
+        history_stats.summaries_refreshed += 1
+        logger.info(f"🗂️ Resumen actualizado para {session.phone}: {len(rows)} mensajes plegados")
+    finally:
+        _resumenes_en_curso.discard(session.lead_id)
+
+async def save_message_pro(lead_id: str, phone: str, role: str, content: str, intent: str = None, tokens: int = None, metadata: dict = None):
     if not lead_id: return
     try:
-        supabase.table("message_logs").insert({
+        await supabase.table("message_logs").insert({
             "lead_id": lead_id, 
             "phone_number": phone, 
             "role": role, 
@@ -177,23 +352,207 @@ def save_message_pro(lead_id: str, phone: str, role: str, content: str, intent:
         }).execute()
     except Exception as e: logger.error(f"Error save logs: {e}")
 
+async def save_messages_bulk(rows: List[dict]):
+    """Inserta varias filas de message_logs en un solo request."""
+    try:
+        await supabase.table("message_logs").insert(rows).execute()
+    except Exception as e: logger.error(f"Error save logs (lote de {len(rows)}): {e}")
+
 # --- INTELIGENCIA ---
-def get_embedding(text: str) -> List[float]:
+# Caché de embeddings (LRU + disco opcional): misma llave para textos iguales tras normalizar
+embedding_cache = EmbeddingCache(
+    lambda text: embeddings.aembed_query(text.replace("\n", " ")),
+    max_items=int(os.getenv("EMBED_CACHE_SIZE", "5000")),
+    disk_path=os.getenv("EMBED_CACHE_PATH") or None
+)
+
+async def get_embedding(text: str) -> List[float]:
     try:
-        text = text.replace("\n", " ")
-        return embeddings.embed_query(text)
+        return await embedding_cache.get(text)
     except Exception as e:
         logger.error(f"Error generating embedding: {e}")
         return []
 
-def buscar_contexto(pregunta: str) -> str:
+# Índice local de la base de conocimiento (tabla `documents` generada por ingest.py)
+knowledge_index = VectorIndex("documents")
+
+async def fetch_all_rows(table: str, columns: str, page_size: int = 1000, **filters) -> List[dict]:
+    """Lee una tabla completa paginando con .range() (PostgREST corta en ~1000 filas)."""
+    rows, start = [], 0
+    while True:
+        query = supabase.table(table).select(columns)
+        for col, val in filters.items():
+            query = query.eq(col, val)
+        res = await query.order("id").range(start, start + page_size - 1).execute()
+        rows.extend(res.data or [])
+        if not res.data or len(res.data) < page_size:
+            return rows
+        start += page_size
+
+async def cargar_indice_conocimiento():
+    """Carga chunks + embeddings de `documents` en memoria y publica el índice de forma atómica."""
+    try:
+        docs = await fetch_all_rows("documents", "id, content, embedding")
+        rows = [(d["id"], parse_vector(d.get("embedding")), {"content": d["content"]}) for d in docs]
+        await asyncio.to_thread(knowledge_index.load, rows)
+        logger.info(f"📚 Índice de conocimiento cargado: {len(knowledge_index)} chunks")
+    except Exception as e:
+        logger.error(f"⚠️ No se pudo cargar el índice local de conocimiento (se usará la RPC): {e}")
+
+# Índice local de reglas aprobadas (`agent_learnings`), actualizado por /learnings/approve|reject
+learnings_index = VectorIndex("agent_learnings")
+
+async def cargar_indice_reglas():
+    """Reconstruye el índice de reglas aprobadas (también reconcilia cambios hechos directo en la DB)."""
+    try:
+        rules = await fetch_all_rows("agent_learnings", "id, proposed_rule, error_description, embedding", status="approved")
+        rows = [(r["id"], parse_vector(r.get("embedding")), {"proposed_rule": r["proposed_rule"], "error_description": r.get("error_description")}) for r in rules]
+        await asyncio.to_thread(learnings_index.load, rows)
+        logger.info(f"🧠 Índice de reglas aprendidas cargado: {len(learnings_index)} reglas")
+    except Exception as e:
+        logger.error(f"⚠️ No se pudo cargar el índice local de reglas (se usará la RPC): {e}")
+
+async def buscar_reglas(vector: List[float]) -> List[dict]:
+    """Reglas aprobadas relevantes para el turno (local; RPC si el índice no está listo)."""
+    if learnings_index.ready:
+        return learnings_index.search(vector, match_threshold=0.70, match_count=3)
+    rpc_res = await supabase.rpc("match_learnings", {
+        "query_embedding": vector, 
+        "match_threshold": 0.70, 
+        "match_count": 3
+    }).execute()
+    return rpc_res.data or []
+
+async def buscar_contexto(pregunta: str, vector: List[float] = None) -> str:
     try:
-        vector = embeddings.embed_query(pregunta)
-        response = supabase.rpc("match_documents", {"query_embedding": vector, "match_threshold": 0.5, "match_count": 4}).execute()
-        if not response.data: return ""
-        return "\n\n---\n\n".join([item['content'] for item in response.data])
+        if vector is None:
+            vector = await get_embedding(pregunta)
+        if not vector: return ""
+        if knowledge_index.ready:
+            data = knowledge_index.search(vector, match_threshold=0.5, match_count=4)
+        else:
+            # Fallback: índice local no disponible, vamos a la RPC
+            response = await supabase.rpc("match_documents", {"query_embedding": vector, "match_threshold": 0.5, "match_count": 4}).execute()
+            data = response.data
+        if not data: return ""
+        return "\n\n---\n\n".join([item['content'] for item in data])
     except: return ""
 
+# --- ENSAMBLADO DE CONTEXTO (fuentes en paralelo con presupuesto de latencia) ---
+# Segundos máximos por fuente; si una no llega, el turno sigue con esa fuente vacía
+CONTEXT_BUDGETS = {
+    "historial": float(os.getenv("CONTEXT_TIMEOUT_HISTORY", "2.0")),
+    "conocimiento": float(os.getenv("CONTEXT_TIMEOUT_RAG", "3.0")),
+    "reglas": float(os.getenv("CONTEXT_TIMEOUT_RULES", "3.0")),
+    "archivos": float(os.getenv("CONTEXT_TIMEOUT_FILES", "2.0")),
+}
+context_timings = TurnTimings()
+
+async def _fuente_con_presupuesto(nombre: str, coro, vacio, tiempos: Dict[str, float]):
+    """Corre una fuente con su timeout; ante timeout o error retorna `vacio`."""
+    inicio = time.perf_counter()
+    outcome = "ok"
+    try:
+        return await asyncio.wait_for(coro, CONTEXT_BUDGETS[nombre])
+    except asyncio.TimeoutError:
+        outcome = "timeout"
+        logger.warning(f"⏱️ Fuente '{nombre}' excedió {CONTEXT_BUDGETS[nombre]}s, se continúa sin ella")
+        return vacio
+    except Exception as e:
+        outcome = "error"
+        logger.error(f"⚠️ Fuente '{nombre}' falló, se continúa sin ella: {e}")
+        return vacio
+    finally:
+        ms = round((time.perf_counter() - inicio) * 1000, 1)
+        tiempos[nombre] = ms
+        context_timings.record(nombre, ms, outcome)
+
+async def ensamblar_contexto(sesion: LeadSession, texto: str) -> dict:
+    """Historial, RAG, reglas aprendidas y archivos pendientes, todo a la vez.
+
+    El embedding del turno se calcula una sola vez y lo comparten conocimiento y
+    reglas; su tiempo cuenta dentro del presupuesto de ambas fuentes.
+    """
+    tiempos: Dict[str, float] = {}
+
+    async def embedding_medido():
+        inicio = time.perf_counter()
+        try:
+            return await get_embedding(texto)
+        finally:
+            ms = round((time.perf_counter() - inicio) * 1000, 1)
+            tiempos["embedding"] = ms
+            context_timings.record("embedding", ms)
+
+    tarea_vector = asyncio.ensure_future(embedding_medido())
+
+    async def conocimiento():
+        # shield: si esta fuente expira no debe cancelar el embedding que usa la otra
+        vector = await asyncio.shield(tarea_vector)
+        return await buscar_contexto(texto, vector=vector)
+
+    async def reglas():
+        vector = await asyncio.shield(tarea_vector)
+        return await buscar_reglas(vector) if vector else []
+
+    inicio = time.perf_counter()
+    historial, contexto, reglas_encontradas, archivos = await asyncio.gather(
+        _fuente_con_presupuesto("historial", cargar_historial(sesion), ([], ""), tiempos),
+        _fuente_con_presupuesto("conocimiento", conocimiento(), "", tiempos),
+        _fuente_con_presupuesto("reglas", reglas(), [], tiempos),
+        _fuente_con_presupuesto("archivos", obtener_archivos_pendientes(sesion), [], tiempos),
+    )
+    tiempos["total"] = round((time.perf_counter() - inicio) * 1000, 1)
+    context_timings.record("total", tiempos["total"])
+    # Si ambas fuentes expiraron, el embedding termina igual y queda en la caché
+    logger.info(f"⏱️ Contexto ensamblado en {tiempos['total']}ms: {tiempos}")
+    historial, resumen = historial
+    return {"historial": historial, "resumen": resumen, "contexto": contexto, "reglas": reglas_encontradas,
+            "archivos": archivos, "tiempos_ms": tiempos}
+
+# --- CATÁLOGO DE PRECIOS ---
+PRICE_CATALOG_PATH = os.getenv("PRICE_CATALOG_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "price_catalog.json"))
+QUOTE_BATCH_MAX = int(os.getenv("QUOTE_BATCH_MAX", "1000"))
+price_catalog = PriceCatalog.from_file(PRICE_CATALOG_PATH)
+
+async def cargar_catalogo_precios():
+    """Si existe un catálogo activo en la tabla `price_catalog` lo usa; si no, queda el del archivo."""
+    global price_catalog
+    try:
+        res = await supabase.table("price_catalog").select("catalog, updated_at").eq("active", True).order("updated_at", desc=True).limit(1).execute()
+        if res.data:
+            price_catalog = PriceCatalog(res.data[0]["catalog"])
+            logger.info(f"💲 Catálogo de precios cargado desde la DB (versión {price_catalog.version})")
+            return
+    except Exception as e:
+        logger.warning(f"⚠️ No se pudo leer price_catalog de la DB, se usa {PRICE_CATALOG_PATH}: {e}")
+    price_catalog = PriceCatalog.from_file(PRICE_CATALOG_PATH)
+    logger.info(f"💲 Catálogo de precios cargado desde archivo (versión {price_catalog.version})")
+
+# --- FAST PATH (turnos triviales sin LLM) ---
+FAST_PATH_MODE = os.getenv("FAST_PATH_MODE", "shadow").lower() # off | shadow | on
+fast_path = FastPathClassifier(
+    get_embedding,
+    min_confidence=float(os.getenv("FAST_PATH_MIN_CONFIDENCE", "0.85")),
+    min_margin=float(os.getenv("FAST_PATH_MIN_MARGIN", "0.05"))
+)
+fast_path_stats = FastPathStats()
+fast_path_timings = TurnTimings()
+
+async def resolver_fast_path(texto: str):
+    """Clasifica el turno y arma la respuesta sin LLM si corresponde. Retorna (respuesta|None, decisión)."""
+    inicio = time.perf_counter()
+    decision = await fast_path.classify(texto)
+    respuesta = build_reply(decision, price_catalog.quote_text)
+    ms = round((time.perf_counter() - inicio) * 1000, 1)
+    decision["elapsed_ms"] = ms
+    decision["route"] = "fast" if respuesta else "llm"
+    fast_path_stats.record(decision["intent"], served=bool(respuesta) and FAST_PATH_MODE == "on",
+                           shadow=bool(respuesta) and FAST_PATH_MODE == "shadow")
+    fast_path_timings.record(decision["intent"], ms)
+    logger.info(f"⚡ Fast path ({FAST_PATH_MODE}): {decision['intent']} conf={decision['confidence']} -> {decision['route']} en {ms}ms")
+    return respuesta, decision
+
 # --- TOOLS PARA EL AGENTE ---
 @tool
 def calculate_quote(product_type: str, quantity: int, sides: int = 1, finish: str = "normal", design_service: str = "none", size: str = "estandar") -> str:
@@ -208,115 +567,13 @@ def calculate_quote(product_type: str, quantity: int, sides: int = 1, finish: st
         size: '10x14', '20x14' (media carta), '20x28' (carta), '80x200', '90x200', etc.
     Returns: Texto con el desglose, Total con IVA y Tiempo de Entrega.
     """
-    neto = 0
-    iva_incluido = False 
-    plazo = "Consultar"
-    
-    p_lower = product_type.lower()
-    s_lower = size.lower()
-    
-    # 1. TARJETAS
-    if "tarjeta" in p_lower:
-        plazo = "1 a 3 días hábiles (Entrega al día siguiente si envías el diseño listo)"
-        precio_100_1lado = 8330 # Antes 7000 neto
-        precio_100_2lados = 13090 # Antes 11000 neto
-        if finish == "polilaminado":
-            precio_100_1lado = 14280 # Antes 12000 neto
-            precio_100_2lados = 19040 # Antes 16000 neto
-        
-        # Escala unitaria basada en 100u ($ / 100u)
-        base = precio_100_2lados if sides == 2 else precio_100_1lado
-        unit_price = base / 100
-        neto = int(unit_price * quantity)
-        iva_incluido = True
-
-    # 2. FLYERS
-    elif "flyer" in p_lower:
-        if quantity == 100 and ("10x15" in s_lower or "10x14" in s_lower):
-            neto = 12800 # Antes 10756 neto
-            iva_incluido = True
-            plazo = "1 hora (Express)"
-        elif quantity >= 1000:
-            iva_incluido = True
-            plazo = "3 a 4 días hábiles"
-            if "10x14" in s_lower or "estandar" in s_lower:
-                neto = 47600 if sides == 2 else 23800
-            elif "20x14" in s_lower or "media carta" in s_lower:
-                neto = 95200 if sides == 2 else 47600
-            elif "20x28" in s_lower or "carta" in s_lower:
-                neto = 190400 if sides == 2 else 95200
-            else:
-                neto = 23800 # Fallback 10x14
-            
-            # Ajuste por cantidad si es múltiplo de 1000
-            neto = int((neto / 1000) * quantity)
-
-    # 3. PENDONES ROLLER
-    elif "pendon" in p_lower:
-        plazo = "24-48 horas"
-        precios_pendon = {
-            "80x200": 55930, "90x200": 67830, "100x200": 80920,
-            "120x200": 116620, "150x200": 159650, "200x200": 309400,
-            "250x200": 362404, "300x200": 553486
-        }
-        neto = 0
-        for k, v in precios_pendon.items():
-            if k in s_lower.replace(" ", ""):
-                neto = v * quantity
-                break
-        if neto == 0: neto = 55930 * quantity
-        iva_incluido = True
-
-    # 4. FOAM / TROVICEL
-    elif "foam" in p_lower or "trovicel" in p_lower:
-        plazo = "2 a 3 días"
-        if "33x48" in s_lower:
-            neto = 7140 * quantity
-        else: # Tamaño carta o menor
-            if quantity < 10: unit = 3570
-            elif quantity < 20: unit = 2975
-            elif quantity < 30: unit = 2737
-            else: unit = 2380
-            neto = unit * quantity
-        iva_incluido = True
-
-    if neto == 0:
-        return f"⚠️ No tengo precio automático para {product_type} {size}. Por favor, consulta manualmente."
-
-    # Costo Diseño (Valores con IVA Incluido)
-    # Tiers: basico ($7.140), medio ($35.700), avanzado ($71.400), premium ($214.200)
-    costo_diseno = 0
-    ds_lower = design_service.lower()
-    
-    if "basico" in ds_lower: costo_diseno = 7140
-    elif "medio" in ds_lower: costo_diseno = 35700
-    elif "avanzado" in ds_lower: costo_diseno = 71400
-    elif "premium" in ds_lower: costo_diseno = 214200
-    
-    # Aplicar Diseño Gratuito si la compra supera los $60.000 (Aplica al nivel básico)
-    bono_txt = ""
-    if neto >= 60000 and "basico" in ds_lower:
-        costo_diseno = 0
-        bono_txt = " (Bonificación por compra > $60k)"
-    
-    # Cálculo Final (Todo ya tiene IVA)
-    total = neto + costo_diseno
-    detalle = f"Valor Base (IVA Inc): ${neto:,} + Diseño (IVA Inc): ${costo_diseno:,}{bono_txt}"
-
-    return f"""
-✨ *COTIZACIÓN OFICIAL* ✨
-──────────────────
-📦 *Producto:* {product_type} ({size}) x {quantity} u.
-💵 *{detalle}*
-⏳ *Plazo de entrega:* {plazo}
-──────────────────
-💰 *TOTAL FINAL: ${total:,} (IVA Incluido)* ✅
-    """
+    # Precios en price_catalog.json (o tabla price_catalog), compilados por quote_engine
+    return price_catalog.quote_text(product_type, quantity, sides, finish, design_service, size)
 
 
 
 @tool
-def register_order(description: str, amount: int, rut: str, address: str, email: str, has_file: bool, name: str = None, address_custom: str = None, files: List[str] = None, lead_id: str = "inject_me", phone: str = None, quantity: int = None, material: str = None, dimensions: str = None, print_sides: str = "1 Tiro") -> str:
+async def register_order(description: str, amount: int, rut: str, address: str, email: str, has_file: bool, name: str = None, address_custom: str = None, files: List[str] = None, lead_id: str = "inject_me", phone: str = None, quantity: int = None, material: str = None, dimensions: str = None, print_sides: str = "1 Tiro") -> str:
     """
     Registra la orden y actualiza datos del cliente (RUT, Nombre, Email, Dirección).
     """
@@ -355,9 +612,12 @@ def register_order(description: str, amount: int, rut: str, address: str, email:
         
         if update_data:
             if phone:
-                res_upd = supabase.table("leads").update(update_data).eq("phone_number", phone).execute()
+                res_upd = await supabase.table("leads").update(update_data).eq("phone_number", phone).execute()
             else:
-                supabase.table("leads").update(update_data).eq("id", lead_id).execute()
+                await supabase.table("leads").update(update_data).eq("id", lead_id).execute()
+            lead_sessions.update(lead_id, update_data) # Write-through a la sesión cacheada
+            if update_data.get("name"):
+                lead_ids.add(lead_id, clean_name(update_data["name"])) # La carpeta nueva usará este nombre
 
         # 2. INTELIGENT DATA EXTRACTION (Strict Regex Fallback)
         # Solo extraemos si estamos 100% seguros. Ante la duda, None.
@@ -399,8 +659,9 @@ def register_order(description: str, amount: int, rut: str, address: str, email:
             "dimensions": dimensions,
             "print_sides": print_sides
         }
-        res = supabase.table("orders").insert(new_order).execute()
+        res = await supabase.table("orders").insert(new_order).execute()
         order_id = res.data[0]['id']
+        order_ids.add(order_id, lead_id)
 
         # NOVEDAD: Vinculación Automática de Archivos Recientes
         try:
@@ -409,8 +670,8 @@ def register_order(description: str, amount: int, rut: str, address: str, email:
             ahora = datetime.now(timezone.utc)
             hace_120_min = (ahora - timedelta(minutes=120)).isoformat()
             
-            recent_files = supabase.table("file_metadata")\
-                .select("id, file_path, file_name")\
+            recent_files = await supabase.table("file_metadata")\
+                .select("id, file_path, file_name, blob_path")\
                 .eq("lead_id", lead_id)\
                 .is_("order_id", "null")\
                 .gt("created_at", hace_120_min)\
@@ -418,17 +679,15 @@ def register_order(description: str, amount: int, rut: str, address: str, email:
             
             if recent_files.data:
                 # Obtener nombre para el path
-                lead_resp = supabase.table("leads").select("name").eq("id", lead_id).execute()
-                cust_prefix = "cliente"
-                if lead_resp.data:
-                    cust_prefix = "".join(x for x in lead_resp.data[0]["name"] if x.isalnum()) or "cliente"
+                lead_resp = await supabase.table("leads").select("name").eq("id", lead_id).execute()
+                cust_name = lead_resp.data[0]["name"] if lead_resp.data else None
                 
                 for file_rec in recent_files.data:
                     old_path = file_rec["file_path"]
                     # Reutilizar el timestamp del nombre de archivo si es posible o usar el original
                     fname = file_rec["file_name"]
                     # Nuevo path estructurado
-                    new_path = f"{cust_prefix}_{lead_id[:5]}/{str(order_id)[:8]}/{fname}"
+                    new_path = f"{order_folder(cust_name, lead_id, order_id)}/{fname}"
                     
                     try:
                         # Ensure paths are clean and valid
@@ -443,29 +702,36 @@ def register_order(description: str, amount: int, rut: str, address: str, email:
                         # found = any(f['name'] == os.path.basename(old_path_clean) for f in list_check)
                         # if not found: logger.warning(f"⚠️ Archivo origen no encontrado en lista: {old_path_clean}")
 
-                        move_res = supabase.storage.from_("chat-media").move(old_path_clean, new_path_clean)
-                        # Verificar si move retorna error explícito (algunas libs lanzan excepción, otras retornan error)
-                        if isinstance(move_res, dict) and 'error' in move_res:
-                             raise Exception(f"Storage Error: {move_res['error']}")
+                        if file_rec.get("blob_path"):
+                            # Direccionado por contenido: el blob no se mueve (puede compartirlo otra fila), sólo la ruta lógica
+                            physical_path = file_rec["blob_path"]
+                        else:
+                            move_res = await supabase.storage.from_("chat-media").move(old_path_clean, new_path_clean)
+                            # Verificar si move retorna error explícito (algunas libs lanzan excepción, otras retornan error)
+                            if isinstance(move_res, dict) and 'error' in move_res:
+                                 raise Exception(f"Storage Error: {move_res['error']}")
+                            physical_path = new_path
                         
                         # 2. Actualizar DB con el nuevo path y el order_id
-                        supabase.table("file_metadata").update({
+                        moved = await supabase.table("file_metadata").update({
                             "order_id": order_id,
                             "file_path": new_path_clean
                         }).eq("id", file_rec["id"]).execute()
+                        for row in moved.data or []:
+                            folder_index.upsert(row)
                         
                         # 3. Vincular también a la ficha de la orden (files_url)
-                        public_url = supabase.storage.from_("chat-media").get_public_url(new_path)
-                        current_order = supabase.table("orders").select("files_url").eq("id", order_id).execute()
+                        public_url = await supabase.storage.from_("chat-media").get_public_url(physical_path)
+                        current_order = await supabase.table("orders").select("files_url").eq("id", order_id).execute()
                         current_files = current_order.data[0].get("files_url") or []
                         if public_url not in current_files:
                             current_files.append(public_url)
-                            supabase.table("orders").update({"files_url": current_files}).eq("id", order_id).execute()
+                            await supabase.table("orders").update({"files_url": current_files}).eq("id", order_id).execute()
                         
                         logger.info(f"📎 Archivo vinculado y movido a la orden: {new_path}")
                     except Exception as move_err:
                         # Si el movido falla, intentamos al menos vincular por ID
-                        supabase.table("file_metadata").update({"order_id": order_id}).eq("id", file_rec["id"]).execute()
+                        await supabase.table("file_metadata").update({"order_id": order_id}).eq("id", file_rec["id"]).execute()
                         logger.warning(f"⚠️ No se pudo mover el archivo físico, pero se vinculó por metadata: {move_err}")
                 
                 # Opcional: Actualizar también el campo 'files_url' de la orden si queremos
@@ -473,36 +739,49 @@ def register_order(description: str, amount: int, rut: str, address: str, email:
 
         except Exception as e_bind:
             logger.error(f"❌ Error en vinculación automática: {e_bind}")
+        finally:
+            # Los archivos pendientes pasaron (o intentaron pasar) a la orden
+            lead_sessions.invalidate_pending_files(lead_id)
 
         return f"✅ Orden #{str(order_id)[:8]} Creada Exitosamente."
     except Exception as e:
         return f"Error DB: {str(e)}"
 
+# --- EJECUTOR DEL AGENTE ---
+tool_pool = ThreadPoolExecutor(max_workers=int(os.getenv("AGENT_TOOL_WORKERS", "8")), thread_name_prefix="agent-tool")
+agent_executor = AgentExecutor(
+    llm, [calculate_quote, register_order], tool_pool,
+    max_steps=int(os.getenv("AGENT_MAX_STEPS", "4")),
+    max_seconds=float(os.getenv("AGENT_MAX_SECONDS", "40")),
+    once_per_turn={"register_order"}, # Nunca dos órdenes en el mismo turno
+    on_response=prompt_cache_stats.record
+)
+
 async def procesar_y_responder(phone: str, mensajes_acumulados: List[str], push_name: str):
     """Procesa el bloque completo de mensajes usando Agentic Workflow."""
     # CANCELAR timer de inactividad previo si el usuario respondió
-    if phone in inactivity_timers:
-        inactivity_timers[phone].cancel()
-        del inactivity_timers[phone]
+    if inactivity.cancel(phone):
+        logger.info(f"✅ Inactividad cancelada para {phone} (Usuario respondió)")
 
     try:
+        # Esperar a que los medios encolados terminen de subirse (placeholders -> texto final)
+        mensajes_acumulados = await media_queue.resolve(mensajes_acumulados, timeout=MEDIA_RESOLVE_TIMEOUT)
         texto_completo = " ".join(mensajes_acumulados)
 
         logger.info(f"🤖 Procesando bloque para {phone}: {texto_completo}")
         
-        lead_id = get_or_create_lead(phone, push_name)
-        if not lead_id:
+        sesion = await cargar_sesion_lead(phone, push_name)
+        if not sesion:
             logger.error(f"🚫 No se pudo cargar/crear el lead para {phone}. Abortando respuesta.")
             return
+        lead_id = sesion.lead_id
 
-        # 🟢 HUMANO AL MANDO: Verificar si la IA está activa para este lead
-        lead_data = supabase.table("leads").select("name, rut, email, address, ai_enabled").eq("id", lead_id).execute()
-        
         # Siempre guardar el mensaje del usuario en el historial (aunque la IA esté apagada)
-        save_message_pro(lead_id, phone, "user", texto_completo)
+        await save_message_pro(lead_id, phone, "user", texto_completo)
 
-        if lead_data.data:
-            lead_row = lead_data.data[0]
+        # 🟢 HUMANO AL MANDO: Verificar si la IA está activa para este lead
+        if sesion.row:
+            lead_row = sesion.row
             
             # Si ai_enabled es False, abortamos la respuesta automática
             if lead_row.get("ai_enabled") is False:
@@ -529,26 +808,33 @@ async def procesar_y_responder(phone: str, mensajes_acumulados: List[str], push_
              datos_guardados_txt = ""
 
         
-        # 1. Detectar archivos PENDIENTES (sin orden) de este cliente en los últimos 120 min
-        from datetime import datetime, timedelta, timezone
-        ahora = datetime.now(timezone.utc)
-        hace_120_min = (ahora - timedelta(minutes=120)).isoformat()
-        
-        pending_files = supabase.table("file_metadata")\
-            .select("id, file_path")\
-            .eq("lead_id", lead_id)\
-            .is_("order_id", "null")\
-            .gt("created_at", hace_120_min)\
-            .execute()
+        # ⚡ FAST PATH: saludo, gracias o precio directo se responden sin LLM (APROBADO siempre va al LLM)
+        decision_rapida = None
+        if FAST_PATH_MODE != "off":
+            respuesta_rapida, decision_rapida = await resolver_fast_path(texto_completo)
+            if respuesta_rapida and FAST_PATH_MODE == "on":
+                status_envio = await enviar_whatsapp(phone, respuesta_rapida)
+                await save_message_pro(lead_id, phone, "assistant", respuesta_rapida, intent=decision_rapida["intent"], tokens=0,
+                                       metadata={"fast_path": decision_rapida, "whatsapp_delivery": status_envio})
+                iniciar_inactividad(phone, lead_id)
+                return
+            # Modo shadow: guardamos lo que habría respondido para comparar con el LLM
+            decision_rapida["reply"] = respuesta_rapida
+
+        # Historial, RAG, reglas y archivos pendientes se piden en paralelo (cada uno con su presupuesto)
+        ctx = await ensamblar_contexto(sesion, texto_completo)
+
+        # 1. Archivos PENDIENTES (sin orden) de este cliente en los últimos 120 min
+        pending_files = ctx["archivos"]
         
-        has_file_context = len(pending_files.data) > 0 or "[DOCUMENTO RECIBIDO (PDF VÁLIDO):" in texto_completo
+        has_file_context = len(pending_files) > 0 or "[DOCUMENTO RECIBIDO (PDF VÁLIDO):" in texto_completo
         
         extracted_url = None
         if has_file_context:
-            if pending_files.data:
+            if pending_files:
                 # Obtener la URL pública del más reciente
-                last_f = pending_files.data[-1]
-                extracted_url = supabase.storage.from_("chat-media").get_public_url(last_f["file_path"])
+                last_f = pending_files[-1]
+                extracted_url = await supabase.storage.from_("chat-media").get_public_url(last_f.get("blob_path") or last_f["file_path"])
             else:
                 import re
                 url_match = re.search(r"URL: ((?:https?://|www\.)[^\s\]]+)", texto_completo)
@@ -574,131 +860,28 @@ async def procesar_y_responder(phone: str, mensajes_acumulados: List[str], push_
              # [DEBUG]
              logger.info(f"🕵️‍♂️ DATOS DETECTADOS POR REGEX: RUT={rut_val}, EMAIL={email_val}")
 
-        historial = get_chat_history_pro(lead_id)
-        contexto = buscar_contexto(texto_completo)
+        historial = ctx["historial"]
+        contexto = ctx["contexto"]
+        resumen_conversacion = f"\n🗂️ *RESUMEN DE LA CONVERSACIÓN ANTERIOR:*\n{ctx['resumen']}\n" if ctx["resumen"] else ""
 
-        # NUEVO: Recuperar reglas dinámicas (RAG de Aprendizaje)
+        # NUEVO: Reglas dinámicas (RAG de Aprendizaje)
         reglas_aprendidas = ""
-        try:
-            # Usamos el último mensaje del usuario para buscar reglas relevantes
-            vector_usuario = get_embedding(texto_completo[-800:]) 
-            if vector_usuario:
-                 rpc_res = supabase.rpc("match_learnings", {
-                     "query_embedding": vector_usuario, 
-                     "match_threshold": 0.70, 
-                     "match_count": 3
-                 }).execute()
-                 
-                 if rpc_res.data:
-                     reglas_txt = "\n".join([f"- {r['proposed_rule']}" for r in rpc_res.data])
-                     reglas_aprendidas = f"\n🧠 *REGLAS APRENDIDAS (PRIORIDAD ALTA):*\n{reglas_txt}\n"
-                     logger.info(f"🧠 Reglas inyectadas: {len(rpc_res.data)}")
-        except Exception as e:
-            logger.error(f"Error recuperando reglas: {e}")
-
-        system_prompt = f"""
-Eres *Richard*, el Asistente Virtual Oficial de *Pitrón Beña Impresión*. 🤵‍♂️✨
-
-⚠️ *IMPORTANTE (REGLA DE FORMATO CRÍTICA):*
-- *NUNCA* uses doble asterisco (`**`). ¡Está estrictamente prohibido! 🚫
-- Para poner texto en negrita, usa *ÚNICAMENTE* un asterisco simple: `*texto*`.
-- Si usas `**`, el mensaje se verá mal en WhatsApp. ¡Usa siempre solo uno!
-
-"¡Hola! 👋 Soy *Richard*, tu asistente en Pitrón Beña Impresión. ¡Es un gusto saludarte! 😊 ¿En qué puedo ayudarte hoy? ✨"
-
-{reglas_aprendidas}
-
-🚫 *REGLA ANTI-ALUCINACIÓN (CRÍTICA):*
-- Al usar `register_order`, NO inventes información.
-- Si el cliente NO especifica "Couché" o "Bond", deja el campo `material` vacío (None).
-- Si NO dice la cantidad exacta, deja `quantity` vacío (None).
-- Solo rellena los datos que estén explícitos. Si faltan datos críticos (RUT, Email), ¡PÍDELOS!
-- 🚫 PROHIBIDO dejar RUT o Email en blanco si vas a registrar una orden.
-
-👤 *INFORMACIÓN DEL CLIENTE:*
-- Cliente: *{cliente_nombre}*.
-- Archivo detectado: {"✅ SÍ" if has_file_context else "❌ NO"}.
-{datos_detectados}
-{datos_guardados_txt}
-
-🧠 *PROCESO DE ATENCIÓN:*
-1. *BÚSQUEDA:* Usa la base de conocimiento para explicar servicios usando emojis (🪪 Tarjetas, 🚀 Flyers, 🚩 Pendones).
-2. *DISEÑO:* Aclara siempre el disclaimer:
-   - *Básico/Gratis*: 3 cambios máx. No se entrega archivo. 🚫
-   - *Medio*: Entrega JPG. 🖼️
-   - *Avanzado*: Entrega PDF. 📄
-   - *Premium*: Entrega Editable (.AI). 🎨
-3. *PRECIOS:* Usa obligatoriamente `calculate_quote`.
-
-📚 *CONOCIMIENTO RECUPERADO:*
-{contexto}
-
-⛔ *REGLA DE REGISTRO DE ORDEN (CRÍTICA):*
-- *NUNCA* llames a `register_order` automáticamente al recibir un archivo o cotizar.
-- *PASOS OBLIGATORIOS ANTES DE REGISTRAR:*
-  1. Brinda la cotización oficial usando `calculate_quote`.
-  2. Verifica que el cliente envió el archivo (PDF) o contrató diseño.
-  3. Asegúrate de tener los datos (RUT, Nombre, Dirección, Email).
-  4. *PIDE CONFIRMACIÓN:* Di: "Para generar tu orden formal en el sistema, por favor escribe la palabra *APROBADO*."
-- *EJECUCIÓN:* Solo llama a `register_order` cuando el cliente responda formalmente (*APROBADO*, *CONFIRMADO*, *DALE*, *PROCEDE*, etc.).
-- *EVITA DUPLICADOS:* Si en el historial ves que ya confirmaste la creación de una orden (ej: "✅ Orden #... Creada"), *NO* vuelvas a llamar a `register_order` bajo ninguna circunstancia.
-
-⛔ *REGLA DE DISEÑO CONTRATADO (CRÍTICA):*
-- Si el cliente dice frases como "hazme", "necesito que diseñes", "no tengo diseño", está solicitando servicio de diseño.
-- **OBLIGATORIO - PASO 1:** Antes de cotizar, DEBES ofrecer los 4 niveles explicando qué entrega cada uno y que todos incluyen **máximo 3 rondas de cambios**:
-   - *Básico ($7.140)*: 3 cambios máx. No se entrega archivo. 🚫
-   - *Medio ($35.700)*: 3 cambios máx. Entrega JPG. 🖼️
-   - *Avanzado ($71.400)*: 3 cambios máx. Entrega PDF. 📄
-   - *Premium ($214.200)*: 3 cambios máx. Entrega Editable (.AI). 🎨
-- **OBLIGATORIO - PASO 2:** Usa `calculate_quote` especificando el `design_service` elegido. **NO calcules el total tú mismo**, usa el resultado de la herramienta exactamente.
-- **OBLIGATORIO - PASO 3 (DATOS DE DISEÑO):** Una vez que el cliente elija un nivel, DEBES pedirle la información para el diseño:
-   - "Para que nuestro equipo comience, por favor dime: ¿Qué texto debe llevar?, ¿Qué colores prefieres?, ¿Tienes algún logo? (puedes enviarlo aquí mismo o describirlo)".
-- **OBLIGATORIO - PASO 4 (DESCRIPCIÓN DETALLADA):** En la descripción de la orden (`register_order`), DEBES incluir la frase "con Servicio de Diseño [Nivel]" seguido de **TODOS los detalles recopilados** (Texto, colores, logos, estilo). 
-  *Ejemplo:* "100 Tarjetas con Servicio de Diseño Básico. Texto: Juan Perez Cel: 91234567, Logo: Un gato bailando, Colores: Azul marino".
-- Cuando cotices CON diseño, *NO pidas archivo PDF* como requisito para imprimir.
-
-📝 *FLUJO DE TRABAJO ACTUALIZADO:*
-1. **Detectar necesidad** (Diseño vs Archivo Listo).
-2. **Ofrecer Niveles** de Diseño (Básico a Premium, 3 cambios máx).
-3. **Cotizar Oficialmente** usando `calculate_quote` (Herramienta obligatoria).
-4. **Pedir Datos Fiscales** (RUT, Nombre, Dirección, Email).
-5. **Pedir Información de Diseño** (Texto, Colores, Idea, Logo).
-6. **Confirmación** (*APROBADO*).
-7. **Registrar Orden** en `register_order`.
-8. **Entregar Datos Banco Estado** 🏦.
-
-⛔ *REGLA DE ARCHIVOS (PDF OBLIGATORIO):*
-- Si en el historial aparece `[ARCHIVO_INVALIDO]`, informa de inmediato.
-- *EXCEPCIÓN:* Si el cliente contrató diseño, NO pidas PDF para proceder.
-
-💰 *ESTILO DE COTIZACIÓN:*
-Usa el formato exacto que entrega `calculate_quote`.
-──────────────────
-💰 *TOTAL FINAL: $[Total] (IVA Incluido)* ✅
-──────────────────
-
-🧠 *REGLA DE ARCHIVOS (ESTRICTA):*
-- Si el cliente dice "Tengo el diseño" o similar, pero `Archivo detectado` es ❌ NO, **NO PUEDES** registrar la orden ni pedir el "APROBADO".
-- Debes decir: "Excelente que tengas el diseño. Por favor, **envíalo ahora mismo** por este medio (en formato PDF de preferencia) para que yo pueda validarlo y registrar tu orden".
-- Solo procede si `Archivo detectado` cambia a ✅ SÍ.
-- *EXCEPCIÓN:* Si contrató servicio de diseño pagado, no es necesario el archivo.
-
-📝 *FLUJO DE TRABAJO COMPLETO:*
-1. **Detectar necesidad** (¿Tiene diseño o necesita que le hagamos uno?).
-2. **Ofrecer Niveles de Diseño** (Si no tiene).
-3. **Validar Archivo** (Si dice que tiene, pídelo antes de seguir).
-4. **Cotizar Oficialmente** usando `calculate_quote`.
-5. **Pedir Datos Fiscales** (RUT, Nombre, Dirección, Email).
-6. **Confirmación del Cliente** (Pide que escriba *APROBADO*).
-7. **Registrar Orden** en `register_order`.
-8. **Brindar Datos de Pago (Banco Estado)** 🏦:
-   - *Titular*: PB IMPRENTA SPA
-   - *RUT*: 77.108.007-3
-   - *Banco*: Banco Estado
-   - *Tipo de Cuenta*: Chequera Electrónica (Cuenta Vista)
-   - *Número de Cuenta*: 29170808833
-   - *Email*: pitronbena@gmail.com
-"""
+        reglas = ctx["reglas"]
+        if reglas:
+            reglas_txt = "\n".join([f"- {r['proposed_rule']}" for r in reglas])
+            reglas_aprendidas = f"\n🧠 *REGLAS APRENDIDAS (PRIORIDAD ALTA):*\n{reglas_txt}\n"
+            logger.info(f"🧠 Reglas inyectadas: {len(reglas)}")
+
+        # Prefijo estático primero (cacheable por OpenAI), secciones del turno al final
+        system_prompt = build_system_prompt(
+            cliente_nombre=cliente_nombre,
+            has_file_context=has_file_context,
+            datos_detectados=datos_detectados,
+            datos_guardados_txt=datos_guardados_txt,
+            contexto=contexto,
+            resumen_conversacion=resumen_conversacion,
+            reglas_aprendidas=reglas_aprendidas,
+        )
 
         
         # --- LIMPIEZA DE HISTORIAL PREVENTIVA (Cero ** y Cero #) ---
@@ -711,83 +894,63 @@ Usa el formato exacto que entrega `calculate_quote`.
 
         messages_to_ai = [SystemMessage(content=system_prompt)] + historial_limpio + [HumanMessage(content=texto_completo)]
         
-        # --- BIND TOOLS ---
-        llm_with_tools = llm.bind_tools([calculate_quote, register_order])
+        # --- TOOLS DEL TURNO ---
+        estado_turno = {"orden_creada": False}
 
-        # 313. BUCLE DE AGENTE (REACT LOOP)
-        total_tokens = 0
-        
-        # 1. Primera llamada al LLM
-        response = llm_with_tools.invoke(messages_to_ai)
-        messages_to_ai.append(response)
-        
-        # Acumular tokens primera llamada
-        if hasattr(response, 'response_metadata'):
-             usage = response.response_metadata.get('token_usage', {})
-             total_tokens += usage.get('total_tokens', 0)
-        
-        resp_content = response.content
-
-        # 2. Ejecutar Tools si las pide
-        order_created_this_turn = False
-        if response.tool_calls:
-            for tool_call in response.tool_calls:
-                fn_name = tool_call["name"]
-                args = tool_call["args"]
-                logger.info(f"🛠️ Tool Call: {fn_name} {args}")
-                
-                res = "Error"
-                if fn_name == "calculate_quote":
-                    res = calculate_quote.invoke(args)
-                elif fn_name == "register_order":
-                    args["lead_id"] = lead_id
-                    args["phone"] = phone # SAFETY INJECTION
-                    # 1. Inyección de Archivos
-                    args["has_file"] = has_file_context
-                    if has_file_context and extracted_url:
-                         args["files"] = [extracted_url]
-                    
-                    # 2. Inyección de Datos Fiscales (Recuperación de Memoria)
-                    if (not args.get("rut") or args["rut"] == "") and found_rut:
-                        args["rut"] = found_rut.group(1)
-                        logger.info(f"💉 Inyectando RUT recuperado: {args['rut']}")
-                    
-                    if (not args.get("email") or args["email"] == "") and found_email:
-                        args["email"] = found_email.group(0)
-                        logger.info(f"💉 Inyectando Email recuperado: {args['email']}")
-
-                    res = register_order.invoke(args)
-                    if "✅" in str(res):
-                        order_created_this_turn = True
-                
-                # Añadir resultado al historial de la conversación actual
-                messages_to_ai.append(ToolMessage(tool_call_id=tool_call["id"], content=str(res)))
+        async def tool_register_order(args: dict) -> str:
+            args["lead_id"] = lead_id
+            args["phone"] = phone # SAFETY INJECTION
+            # 1. Inyección de Archivos
+            args["has_file"] = has_file_context
+            if has_file_context and extracted_url:
+                 args["files"] = [extracted_url]
             
-            # 3. Segunda llamada al LLM (Respuesta Final interpretando la tool)
-            final_response = llm_with_tools.invoke(messages_to_ai)
-            resp_content = final_response.content
+            # 2. Inyección de Datos Fiscales (Recuperación de Memoria)
+            if (not args.get("rut") or args["rut"] == "") and found_rut:
+                args["rut"] = found_rut.group(1)
+                logger.info(f"💉 Inyectando RUT recuperado: {args['rut']}")
             
-            # Acumular tokens segunda llamada
-            if hasattr(final_response, 'response_metadata'):
-                 usage = final_response.response_metadata.get('token_usage', {})
-                 total_tokens += usage.get('total_tokens', 0)
-        
+            if (not args.get("email") or args["email"] == "") and found_email:
+                args["email"] = found_email.group(0)
+                logger.info(f"💉 Inyectando Email recuperado: {args['email']}")
+
+            res = await register_order.ainvoke(args)
+            if "✅" in str(res):
+                estado_turno["orden_creada"] = True
+            return res
+
+        handlers = {
+            "calculate_quote": calculate_quote.invoke, # Síncrona: corre en el pool de tools
+            "register_order": tool_register_order,
+        }
+
+        # BUCLE DE AGENTE (varias rondas de tools con presupuesto de pasos y latencia)
+        resultado = await agent_executor.run(messages_to_ai, handlers)
+        resp_content = resultado["content"]
+        total_tokens = resultado["total_tokens"]
+        uso_prompt = {"prompt_tokens": resultado["prompt_tokens"], "cached_tokens": resultado["cached_tokens"]}
+        order_created_this_turn = estado_turno["orden_creada"]
+        logger.info(f"🤖 Agente: {len(resultado['steps'])} pasos, {total_tokens} tokens, {resultado['elapsed_ms']}ms ({resultado['stop_reason']})")
+
         # --- LIMPIEZA FINAL DE SALIDA (Asegurar formato WhatsApp) ---
         if resp_content:
             # Eliminar ** y # de raíz para que nunca lleguen al cliente
             resp_content = resp_content.replace("**", "*").replace("#", "")
 
         # Guardar y Enviar
-        meta_envio = {}
+        meta_envio = {"context_timings_ms": ctx["tiempos_ms"], "prompt_cache": uso_prompt,
+                      "agent": {"steps": resultado["steps"], "stop_reason": resultado["stop_reason"], "elapsed_ms": resultado["elapsed_ms"]}}
+        if decision_rapida:
+            meta_envio["fast_path_shadow"] = decision_rapida
         if resp_content: 
-            status_envio = enviar_whatsapp(phone, resp_content)
-            meta_envio = {"whatsapp_delivery": status_envio}
+            status_envio = await enviar_whatsapp(phone, resp_content)
+            meta_envio["whatsapp_delivery"] = status_envio
 
-        save_message_pro(lead_id, phone, "assistant", resp_content, tokens=total_tokens, metadata=meta_envio)
+        await save_message_pro(lead_id, phone, "assistant", resp_content, tokens=total_tokens, metadata=meta_envio)
 
         # INICIAR nuevo timer de inactividad tras la respuesta SÓLO SI no se creó una orden
         if not order_created_this_turn:
-            inactivity_timers[phone] = asyncio.create_task(inactivity_manager(phone, lead_id))
+            iniciar_inactividad(phone, lead_id)
         else:
             logger.info(f"✅ Orden detectada para {phone}. Se omite timer de inactividad.")
 
@@ -797,110 +960,359 @@ Usa el formato exacto que entrega `calculate_quote`.
 
 
 # --- CONTROLADOR DEL BUFFER ---
-async def buffer_manager(phone: str, push_name: str):
+async def buffer_manager(phone: str, generation: int, delay: float = BUFFER_DELAY):
     """Espera X segundos. Si no llegan más mensajes, dispara el proceso."""
-    await asyncio.sleep(BUFFER_DELAY)
-    
-    # Verificar si seguimos siendo la tarea activa (no hemos sido cancelados/reemplazados)
-    if phone in message_buffer:
-        data = message_buffer.pop(phone) # Sacamos los mensajes y limpiamos el buffer
-        mensajes = data["messages"]
+    await asyncio.sleep(delay)
+
+    # Desde aquí ya no se nos puede cancelar: un mensaje nuevo sube la generación y arma su propio timer
+    if buffer_timers.get(phone) is asyncio.current_task():
+        del buffer_timers[phone]
+
+    # Claim atómico: sólo la última generación saca los mensajes (at-most-once entre workers)
+    claimed = await buffer_backend.claim(phone, generation)
+    if claimed:
+        mensajes, push_name = claimed
         # Disparar procesamiento en background real
         await procesar_y_responder(phone, mensajes, push_name)
 
+def arm_buffer_timer(phone: str, generation: int, delay: float = BUFFER_DELAY):
+    """(Re)arma el timer local del teléfono para la generación indicada."""
+    if phone in buffer_timers:
+        buffer_timers[phone].cancel()
+    buffer_timers[phone] = asyncio.create_task(buffer_manager(phone, generation, delay))
+
+@app.on_event("startup")
+async def recover_buffers():
+    """Re-arma los buffers que quedaron pendientes antes de un reinicio (backend durable)."""
+    pendientes = await buffer_backend.pending()
+    for phone, generation, deadline in pendientes:
+        arm_buffer_timer(phone, generation, max(0.0, deadline - time.time()))
+    if pendientes:
+        logger.info(f"♻️ Buffers recuperados tras reinicio: {len(pendientes)}")
+
 
 
 # --- COMUNICACIÓN EXTERNA ---
-def enviar_whatsapp(numero: str, texto: str) -> dict:
-    """Envía un mensaje de texto vía Evolution API y retorna el status."""
-    result = {"status": "unknown", "code": 0}
+async def enviar_whatsapp(numero: str, texto: str) -> dict:
+    """Envía un mensaje de texto vía Evolution API (cola FIFO por número) y retorna el status."""
+    logger.info(f"📤 Intentando enviar WA a {numero}...")
+    result = await evolution.send_text(numero, texto)
+    if result["status"] == "success":
+        logger.info(f"✅ WA enviado exitosamente a {numero}")
+    return result
+
+async def enviar_documento_wa(numero: str, archivo_bytes: bytes, filename: str, caption: str = "") -> dict:
+    """Envía un archivo PDF vía Evolution API como media (misma cola que los textos)."""
+    import base64
+    base64_data = base64.b64encode(archivo_bytes).decode('utf-8')
+    payload = {
+        "mediatype": "document",
+        "mimetype": "application/pdf",
+        "caption": caption,
+        "media": base64_data,
+        "fileName": filename
+    }
+    logger.info(f"📄 Intentando enviar PDF a {numero}...")
+    result = await evolution.send_media(numero, payload)
+    if result["status"] == "success":
+        logger.info(f"✅ Documento enviado exitosamente a {numero}")
+    return result
+
+# --- INGESTA DE MEDIOS (Workers en segundo plano) ---
+MEDIA_WORKERS = int(os.getenv("MEDIA_WORKERS", "4"))
+MEDIA_QUEUE_SIZE = int(os.getenv("MEDIA_QUEUE_SIZE", "100"))
+MEDIA_MAX_BYTES = int(os.getenv("MEDIA_MAX_MB", "50")) * 1024 * 1024
+MEDIA_RESOLVE_TIMEOUT = float(os.getenv("MEDIA_RESOLVE_TIMEOUT", "30")) # Segundos que el turno espera un archivo en proceso
+
+async def descargar_media(file_url: str) -> Optional[bytes]:
+    """Descarga en streaming (por chunks) con tope de tamaño MEDIA_MAX_BYTES."""
+    logger.info(f"📥 Intentando descargar media desde URL: {file_url}")
+    file_bytes = bytearray()
+    async with http_client.stream("GET", file_url, timeout=20, follow_redirects=True) as resp:
+        if resp.status_code != 200:
+            logger.warning(f"⚠️ Fallo descarga media {resp.status_code}")
+            return None
+        async for chunk in resp.aiter_bytes(64 * 1024):
+            file_bytes.extend(chunk)
+            if len(file_bytes) > MEDIA_MAX_BYTES:
+                logger.warning(f"⚠️ Media supera el máximo de {MEDIA_MAX_BYTES} bytes, se descarta la descarga")
+                return None
+    logger.info(f"✅ Descarga exitosa ({len(file_bytes)} bytes)")
+    return bytes(file_bytes)
+
+# Helper robusto para guardar medios (B64 o URL -> Supabase)
+# --- BLOBS DIRECCIONADOS POR CONTENIDO ---
+blob_registry = BlobRegistry(max_items=int(os.getenv("BLOB_REGISTRY_SIZE", "20000")))
+
+async def buscar_blob(content_hash: str) -> Optional[str]:
+    """Ruta física de un blob con este sha256 si ya está en el bucket (caché local, luego file_metadata).
+
+    Sólo cuentan filas con `blob_path`: un objeto anterior a los blobs vive en su ruta
+    lógica, register_order lo mueve al asignarle orden y una subida con upsert pudo
+    reemplazarlo (su content_hash ya no es confiable). Ese contenido se sube como blob nuevo.
+    """
+    path = blob_registry.get(content_hash)
+    if path:
+        return path
+    res = await supabase.table("file_metadata").select("blob_path").eq("content_hash", content_hash)\
+        .not_.is_("blob_path", "null").limit(1).execute()
+    if res.data:
+        path = res.data[0]["blob_path"]
+        blob_registry.add(content_hash, path)
+    return path
+
+async def guardar_blob(file_bytes: bytes, mime: str, ext: str) -> dict:
+    """Sube los bytes a su ruta por contenido, salvo que ya exista. Retorna blob_path, content_hash, size_bytes y reused."""
+    content_hash = await asyncio.to_thread(sha256_hex, file_bytes)
+    existing = await buscar_blob(content_hash)
+    if existing:
+        blob_registry.record(len(file_bytes), reused=True)
+        logger.info(f"♻️ Blob ya existente, no se sube de nuevo: {existing}")
+        return {"blob_path": existing, "content_hash": content_hash, "size_bytes": len(file_bytes), "reused": True}
+
+    path = blob_path_for(content_hash, ext)
+    logger.info(f"📤 Subiendo blob: {path}...")
     try:
-        base_url = EVOLUTION_API_URL.rstrip('/')
-        from urllib.parse import quote
-        instance_encoded = quote(INSTANCE_NAME)
-        url = f"{base_url}/message/sendText/{instance_encoded}"
-        
-        payload = {
-            "number": numero, 
-            "text": texto
-        }
-        
-        logger.info(f"📤 Intentando enviar WA a {numero}...")
-        response = requests.post(
-            url, 
-            json=payload, 
-            headers={"apikey": EVOLUTION_API_KEY, "Content-Type": "application/json"},
-            timeout=15
-        )
+        await supabase.storage.from_("chat-media").upload(path, file_bytes, {"content-type": mime, "upsert": "false"})
+    except Exception as e:
+        # Mismo contenido subido en paralelo (otro worker): el objeto ya es el correcto
+        if not is_duplicate_error(str(e)):
+            raise
+    blob_registry.add(content_hash, path)
+    blob_registry.record(len(file_bytes), reused=False)
+    return {"blob_path": path, "content_hash": content_hash, "size_bytes": len(file_bytes), "reused": False}
+
+async def save_media_to_supabase(b64_data, file_url, mime, ext, jid, custom_path=None):
+    """Descarga/decodifica el medio y lo guarda como blob. Retorna (url_pública, ruta_lógica, blob)."""
+    file_bytes = None
+    import base64
+
+    # 1. Prioridad: Intentar descargar desde URL (ya que suele estar desencriptada por MinIO)
+    if file_url and isinstance(file_url, str) and file_url.startswith("http"):
+        try:
+            file_bytes = await descargar_media(file_url)
+        except Exception as e:
+            logger.error(f"❌ Error downloading media: {e}")
+
+    # 2. Fallback: Intentar decode B64 si la descarga falló
+    if not file_bytes and b64_data and isinstance(b64_data, str) and len(b64_data) > 20:
+        try:
+            # Limpiar prefijos de data URI si existen
+            clean_b64 = b64_data.split(",")[-1] if "," in b64_data else b64_data
+            if not clean_b64.startswith("http"):
+                logger.info(f"🧬 Intentando Fallback a B64 (inicio: {clean_b64[:30]}...)")
+                # Decode fuera del event loop (puede ser de varios MB)
+                file_bytes = await asyncio.to_thread(base64.b64decode, clean_b64)
+        except Exception as e:
+            logger.error(f"❌ Error base64 decode: {e}")
+
+    # 3. Subir a Supabase si tenemos bytes
+    if file_bytes:
+        # [OPTIONAL] Validar si son bytes de imagen reales (opcional pero recomendado)
+        if not file_bytes.startswith(b'\xff\xd8') and not file_bytes.startswith(b'\x89PNG'):
+            logger.warning(f"⚠️ Los bytes recibidos no parecen una imagen válida (JPG/PNG). Primeros bytes: {file_bytes[:10].hex(' ')}")
         
-        result["code"] = response.status_code
-        if response.status_code in [200, 201]:
-            logger.info(f"✅ WA enviado exitosamente a {numero}")
-            result["status"] = "success"
-            result["evolution_id"] = response.json().get("key", {}).get("id")
-        else:
-            logger.error(f"❌ Error Evolution API ({response.status_code}): {response.text}")
-            result["status"] = "error"
-            result["response"] = response.text
+        try:
+            timestamp = int(time.time())
+            filename = f"{timestamp}.{ext}"
             
-    except Exception as e: 
-        logger.error(f"🔥 Error crítico envío WA: {e}")
-        result["status"] = "exception"
-        result["error"] = str(e)
-    
-    return result
+            if custom_path:
+                path = f"{custom_path}/{filename}"
+            else:
+                path = f"inbox/{jid}/{filename}"
+            
+            # Un blob por contenido: si el cliente reenvía el mismo archivo no se vuelve a subir
+            blob = await guardar_blob(file_bytes, mime, ext)
+            public_url = await supabase.storage.from_("chat-media").get_public_url(blob["blob_path"])
+
+            logger.info(f"✅ Media guardada en Supabase ({path} -> {blob['blob_path']}): {public_url}")
+            return public_url, path, blob
+        except Exception as e:
+            logger.error(f"Error uploading to Supabase: {e}")
 
-def enviar_documento_wa(numero: str, archivo_bytes: bytes, filename: str, caption: str = "") -> dict:
-    """Envía un archivo PDF vía Evolution API como media."""
-    result = {"status": "unknown", "code": 0}
+    
+    # 4. Fallback: Devolver URL original si no pudimos procesarla internamente
+    return file_url, None, None
+
+async def ingest_media_job(job: dict) -> str:
+    """Worker: descarga/decodifica/sube el medio y retorna el texto que verá el agente."""
+    jid = job["jid"]
+
+    # 2. Imágenes (Prohibidas bajo la nueva regla de "Solo PDF")
+    if job["kind"] == "image":
+        img_msg = job["message"]
+        caption = img_msg.get("caption", "")
+        
+        # Usar los campos inyectados que sabemos que funcionan
+        b64 = img_msg.get("evolution_base64") or img_msg.get("base64")
+        url_msg = img_msg.get("evolution_media_url") or img_msg.get("mediaUrl") or img_msg.get("url")
+        
+        # Detectar mime
+        mime = img_msg.get("mimetype", "image/jpeg")
+        ext = "jpg"
+        if "png" in mime: ext = "png"
+        elif "webp" in mime: ext = "webp"
+
+        logger.info(f"🖼️ Procesando imagen ({mime}).")
+        final_url, _, _ = await save_media_to_supabase(b64, url_msg, mime, ext, jid)
+        
+        # LA REGLA: Si es imagen, avisar que no sirve (se requiere PDF)
+        return f"[ARCHIVO_INVALIDO: Imagen (Mime: {mime})] Se recibió una imagen ({final_url}), pero el sistema requiere PDF para impresión profesional. {caption}"
+
+    # 3. Documentos (Solo PDF permitido)
+    doc_msg = job["message"]
+    filename = doc_msg.get("title", "doc")
+    caption = doc_msg.get("caption", "")
+    
+    b64 = doc_msg.get("evolution_base64") or doc_msg.get("base64")
+    url_msg = doc_msg.get("evolution_media_url") or doc_msg.get("mediaUrl") or doc_msg.get("url")
+    mime_type = doc_msg.get("mimetype", "application/pdf")
+    
+    logger.info(f"📄 Procesando documento ({mime_type}).")
+    
+    # Determinar extensión basada en mime
+    if "pdf" not in mime_type.lower():
+        ext = "pdf"
+        if "image" in mime_type: ext = "jpg"
+        elif "word" in mime_type: ext = "docx"
+        elif "excel" in mime_type: ext = "xlsx"
+        
+        final_url, _, _ = await save_media_to_supabase(b64, url_msg, mime_type, ext, jid)
+        return f"[ARCHIVO_INVALIDO: Documento No-PDF (Mime: {mime_type})] El archivo {filename} ({final_url}) no es un PDF. El sistema solo acepta PDF. {caption}"
+
+    # ES UN PDF VÁLIDO
+    # Determinar carpeta de destino: archivos/nombre_cliente/orden_id/
+    # Buscamos si el cliente tiene una orden reciente
+    order_path = "global"
+    current_order_id = None
+    lead_db_id = None
     try:
-        import base64
-        base_url = EVOLUTION_API_URL.rstrip('/')
-        from urllib.parse import quote
-        instance_encoded = quote(INSTANCE_NAME)
-        url = f"{base_url}/message/sendMedia/{instance_encoded}"
-        
-        base64_data = base64.b64encode(archivo_bytes).decode('utf-8')
-        
-        payload = {
-            "number": numero,
-            "mediatype": "document",
-            "mimetype": "application/pdf",
-            "caption": caption,
-            "media": base64_data,
-            "fileName": filename
-        }
+        # Buscar lead_id (O CREARLO SI ES NUEVO para asociar el archivo)
+        target_phone = jid
+        target_pushname = job.get("push_name")
         
-        logger.info(f"📄 Intentando enviar PDF a {numero}...")
-        response = requests.post(
-            url, 
-            json=payload, 
-            headers={"apikey": EVOLUTION_API_KEY, "Content-Type": "application/json"},
-            timeout=30
-        )
+        # Intentar buscar primero
+        lead_res = await supabase.table("leads").select("id, name").eq("phone_number", target_phone).execute()
         
-        result["code"] = response.status_code
-        if response.status_code in [200, 201]:
-            logger.info(f"✅ Documento enviado exitosamente a {numero}")
-            result["status"] = "success"
-        else:
-            logger.error(f"❌ Error Evolution Media ({response.status_code}): {response.text}")
-            result["status"] = "error"
+        if not lead_res.data:
+            # Si no existe, CREARLO AHORA MISMO para no perder el archivo
+            logger.info(f"🆕 Cliente nuevo detectado por archivo: {target_phone}. Creando Lead...")
+            try:
+                new_lead_data = {"phone_number": target_phone, "name": target_pushname, "status": "new"}
+                create_res = await supabase.table("leads").insert(new_lead_data).execute()
+                if create_res.data:
+                    lead_res = create_res # Asignar para usar abajo
+                    lead_ids.add(create_res.data[0]["id"], clean_name(create_res.data[0].get("name")))
+            except Exception as e_create:
+                logger.error(f"❌ Error creando lead en webhook: {e_create}")
+
+        if lead_res.data:
+            lead_obj = lead_res.data[0]
+            lead_db_id = lead_obj["id"]
+            
+            # Buscar orden pendiente/activa (Solo últimos 120 min)
+            from datetime import datetime, timezone
+            ord_res = await supabase.table("orders").select("id, status, created_at").eq("lead_id", lead_db_id).order("created_at", desc=True).limit(1).execute()
+            if ord_res.data:
+                last_ord = ord_res.data[0]
+                is_active_and_recent = False
+                try:
+                    # Convertir created_at a datetime
+                    ord_ts = last_ord["created_at"].replace('Z', '+00:00')
+                    fecha_ord = datetime.fromisoformat(ord_ts)
+                    if (datetime.now(timezone.utc) - fecha_ord).total_seconds() < 7200: # 2 horas
+                        if last_ord["status"] not in ["LISTO", "ENTREGADO", "ANULADO"]:
+                            is_active_and_recent = True
+                except Exception as te:
+                    logger.error(f"Error parseando fecha orden: {te}")
+
+                if is_active_and_recent:
+                    current_order_id = last_ord["id"]
+                    order_path = order_folder(lead_obj["name"], lead_db_id, current_order_id)
+                else:
+                    # Si la orden es vieja o está lista/entregada, el archivo va a /general
+                    # para que register_order lo "succione" si es una nueva orden.
+                    order_path = order_folder(lead_obj["name"], lead_db_id)
+            else:
+                order_path = order_folder(lead_obj["name"], lead_db_id)
     except Exception as e:
-        logger.error(f"🔥 Error enviando media: {e}")
-        result["status"] = "exception"
+        logger.error(f"Error calculando path de archivo: {e}")
+
+    final_url, storage_path, blob = await save_media_to_supabase(b64, url_msg, mime_type, "pdf", jid, custom_path=order_path)
     
-    return result
+    # Registrar en metadata si tenemos lead_id
+    if storage_path and lead_db_id:
+        try:
+            meta_res = await supabase.table("file_metadata").insert({
+                "file_path": storage_path,
+                "blob_path": blob["blob_path"],
+                "content_hash": blob["content_hash"],
+                "size_bytes": blob["size_bytes"],
+                "file_name": filename,
+                "file_type": mime_type,
+                "lead_id": lead_db_id,
+                "order_id": current_order_id,
+                "status": "original"
+            }).execute()
+            lead_sessions.invalidate_pending_files(lead_db_id)
+            for row in meta_res.data or []:
+                folder_index.upsert(row)
+        except Exception as e:
+            logger.error(f"Error guardando metadata: {e}")
+
+    return f"[DOCUMENTO RECIBIDO (PDF VÁLIDO): {filename} - URL: {final_url}] {caption}"
+
+media_queue = MediaIngestQueue(
+    ingest_media_job,
+    workers=MEDIA_WORKERS,
+    maxsize=MEDIA_QUEUE_SIZE,
+    results_backend=buffer_backend if BUFFER_BACKEND == "sqlite" else None
+)
+
+@app.on_event("startup")
+async def start_media_workers():
+    media_queue.start()
+
+@app.on_event("startup")
+async def load_knowledge_index():
+    await cargar_indice_conocimiento()
+    await cargar_indice_reglas()
+
+@app.on_event("startup")
+async def load_price_catalog():
+    await cargar_catalogo_precios()
+
+@app.on_event("startup")
+async def fit_fast_path():
+    # Los embeddings de las frases semilla pasan por la caché; no frenamos el arranque
+    if FAST_PATH_MODE != "off":
+        en_segundo_plano(fast_path.fit(), "centroides fast path")
+
+@app.on_event("startup")
+async def load_tokenizer():
+    # tiktoken descarga el encoding la primera vez: mejor aquí que en el primer turno
+    await asyncio.to_thread(count_tokens, "warmup")
+
+@app.on_event("startup")
+async def start_inactivity_scheduler():
+    await inactivity.start() # Recupera los timers pendientes de antes del redeploy
+
+@app.on_event("shutdown")
+async def stop_media_workers():
+    await media_queue.stop()
+
+@app.on_event("shutdown")
+async def stop_inactivity_scheduler():
+    await inactivity.stop()
 
 @app.post("/webhook")
 async def webhook_whatsapp(request: Request):
+    msg_id = None
     try:
         payload = await request.json()
         
-        # [DEBUG EXTREMO] Guardar el último payload
-        import json
-        with open("last_payload.json", "w") as f:
-            json.dump(payload, f, indent=4)
+        # [DEBUG] Muestrear el payload en el ring buffer (redactado, sin I/O de disco en el hot path)
+        payload_ring.record(payload)
 
         if isinstance(payload, list): payload = payload[0]
         body = payload.get("body", {}) if "body" in payload else payload
@@ -929,6 +1341,14 @@ async def webhook_whatsapp(request: Request):
         # Desempaquetar el mensaje real
         real_message = unwrap_message(message)
 
+        # [IDEMPOTENCIA] Reintentos/duplicados de Evolution se descartan antes de cualquier I/O
+        msg_id = key.get("id")
+        if msg_id:
+            kind = "media" if ("imageMessage" in real_message or "documentMessage" in real_message) else "text"
+            if not await webhook_dedupe.claim(msg_id, kind):
+                logger.info(f"♻️ Webhook duplicado ignorado ({kind}): {msg_id}")
+                return {"status": "duplicate"}
+
         # [CRÍTICO] Extraer 'base64' y 'mediaUrl' buscando en 'data' y en 'message' 
         # (Evolution API varía la ubicación según la versión/configuración)
         evolution_base64 = data.get("base64") or message.get("base64")
@@ -947,69 +1367,11 @@ async def webhook_whatsapp(request: Request):
                     break
 
 
-        # --- EXTRACCIÓN Y SUBIDA DE MEDIOS ---
+        # --- EXTRACCIÓN DE CONTENIDO ---
+        # Los medios NO se descargan aquí: se encolan para los media workers y al buffer
+        # entra un placeholder que se resuelve antes del turno del LLM.
         texto = ""
-        media_url = None
-        
-        # Helper robusto para guardar medios (B64 o URL -> Supabase)
-        def save_media_to_supabase(b64_data, file_url, mime, ext, custom_path=None):
-            file_bytes = None
-            import base64
-            import time
-
-            # 1. Prioridad: Intentar descargar desde URL (ya que suele estar desencriptada por MinIO)
-            if file_url and isinstance(file_url, str) and file_url.startswith("http"):
-                try:
-                    logger.info(f"📥 Intentando descargar media desde URL: {file_url}")
-                    resp = requests.get(file_url, timeout=20)
-                    if resp.status_code == 200:
-                        file_bytes = resp.content
-                        logger.info(f"✅ Descarga exitosa ({len(file_bytes)} bytes)")
-                    else:
-                        logger.warning(f"⚠️ Fallo descarga media {resp.status_code}")
-                except Exception as e:
-                    logger.error(f"❌ Error downloading media: {e}")
-
-            # 2. Fallback: Intentar decode B64 si la descarga falló
-            if not file_bytes and b64_data and isinstance(b64_data, str) and len(b64_data) > 20:
-                try:
-                    # Limpiar prefijos de data URI si existen
-                    clean_b64 = b64_data.split(",")[-1] if "," in b64_data else b64_data
-                    if not clean_b64.startswith("http"):
-                        logger.info(f"🧬 Intentando Fallback a B64 (inicio: {clean_b64[:30]}...)")
-                        file_bytes = base64.b64decode(clean_b64)
-                except Exception as e:
-                    logger.error(f"❌ Error base64 decode: {e}")
-
-            # 3. Subir a Supabase si tenemos bytes
-            if file_bytes:
-                # [OPTIONAL] Validar si son bytes de imagen reales (opcional pero recomendado)
-                if not file_bytes.startswith(b'\xff\xd8') and not file_bytes.startswith(b'\x89PNG'):
-                    logger.warning(f"⚠️ Los bytes recibidos no parecen una imagen válida (JPG/PNG). Primeros bytes: {file_bytes[:10].hex(' ')}")
-                
-                try:
-                    jid = key.get('remoteJid', 'unknown').split('@')[0]
-                    timestamp = int(time.time())
-                    filename = f"{timestamp}.{ext}"
-                    
-                    if custom_path:
-                        path = f"{custom_path}/{filename}"
-                    else:
-                        path = f"inbox/{jid}/{filename}"
-                    
-                    logger.info(f"📤 Subiendo a carpeta: {path}...")
-                    # upsert=True por si acaso
-                    supabase.storage.from_("chat-media").upload(path, file_bytes, {"content-type": mime, "upsert": "true"})
-                    public_url = supabase.storage.from_("chat-media").get_public_url(path)
-
-                    logger.info(f"✅ Media guardada en Supabase: {public_url}")
-                    return public_url, path
-                except Exception as e:
-                    logger.error(f"Error uploading to Supabase: {e}")
-
-            
-            # 4. Fallback: Devolver URL original si no pudimos procesarla internamente
-            return file_url, None
+        jid = key.get("remoteJid", "unknown").split("@")[0]
 
         # [PROCESAMIENTO SEGURO DEL CONTENIDO]
         try:
@@ -1021,122 +1383,12 @@ async def webhook_whatsapp(request: Request):
             
             # 2. Imágenes (Prohibidas bajo la nueva regla de "Solo PDF")
             elif "imageMessage" in real_message:
-                img_msg = real_message["imageMessage"]
-                caption = img_msg.get("caption", "")
-                
-                # Usar los campos inyectados que sabemos que funcionan
-                b64 = img_msg.get("evolution_base64") or img_msg.get("base64")
-                url_msg = img_msg.get("evolution_media_url") or img_msg.get("mediaUrl") or img_msg.get("url")
-                
-                # Detectar mime
-                mime = img_msg.get("mimetype", "image/jpeg")
-                ext = "jpg"
-                if "png" in mime: ext = "png"
-                elif "webp" in mime: ext = "webp"
-
-                logger.info(f"🖼️ Procesando imagen ({mime}).")
-                final_url = save_media_to_supabase(b64, url_msg, mime, ext)
-                
-                # LA REGLA: Si es imagen, avisar que no sirve (se requiere PDF)
-                texto = f"[ARCHIVO_INVALIDO: Imagen (Mime: {mime})] Se recibió una imagen ({final_url}), pero el sistema requiere PDF para impresión profesional. {caption}"
+                texto = await media_queue.submit({"kind": "image", "message": real_message["imageMessage"], "jid": jid, "push_name": data.get("pushName")})
 
             # 3. Documentos (Solo PDF permitido)
             elif "documentMessage" in real_message:
-                doc_msg = real_message["documentMessage"]
-                filename = doc_msg.get("title", "doc")
-                caption = doc_msg.get("caption", "")
-                
-                b64 = doc_msg.get("evolution_base64") or doc_msg.get("base64")
-                url_msg = doc_msg.get("evolution_media_url") or doc_msg.get("mediaUrl") or doc_msg.get("url")
-                mime_type = doc_msg.get("mimetype", "application/pdf")
-                
-                logger.info(f"📄 Procesando documento ({mime_type}).")
-                
-                # Determinar extensión basada en mime
-                ext = "pdf"
-                if "pdf" not in mime_type.lower():
-                    if "image" in mime_type: ext = "jpg"
-                    elif "word" in mime_type: ext = "docx"
-                    elif "excel" in mime_type: ext = "xlsx"
-                    
-                    final_url = save_media_to_supabase(b64, url_msg, mime_type, ext)
-                    texto = f"[ARCHIVO_INVALIDO: Documento No-PDF (Mime: {mime_type})] El archivo {filename} ({final_url}) no es un PDF. El sistema solo acepta PDF. {caption}"
-                # ES UN PDF VÁLIDO
-                # Determinar carpeta de destino: archivos/nombre_cliente/orden_id/
-                # Buscamos si el cliente tiene una orden reciente
-                order_path = "global"
-                current_order_id = None
-                try:
-                    # Buscar lead_id (O CREARLO SI ES NUEVO para asociar el archivo)
-                    target_phone = key.get("remoteJid", "").split("@")[0]
-                    target_pushname = data.get("pushName")
-                    
-                    # Intentar buscar primero
-                    lead_res = supabase.table("leads").select("id, name").eq("phone_number", target_phone).execute()
-                    
-                    if not lead_res.data:
-                        # Si no existe, CREARLO AHORA MISMO para no perder el archivo
-                        logger.info(f"🆕 Cliente nuevo detectado por archivo: {target_phone}. Creando Lead...")
-                        try:
-                            new_lead_data = {"phone_number": target_phone, "name": target_pushname, "status": "new"}
-                            create_res = supabase.table("leads").insert(new_lead_data).execute()
-                            if create_res.data:
-                                lead_res = create_res # Asignar para usar abajo
-                        except Exception as e_create:
-                            logger.error(f"❌ Error creando lead en webhook: {e_create}")
-
-                    if lead_res.data:
-                        lead_obj = lead_res.data[0]
-                        lead_db_id = lead_obj["id"]
-                        cust_name_clean = "".join(x for x in lead_obj["name"] if x.isalnum()) or "cliente"
-                        
-                        # Buscar orden pendiente/activa (Solo últimos 120 min)
-                        from datetime import datetime, timezone
-                        ord_res = supabase.table("orders").select("id, status, created_at").eq("lead_id", lead_db_id).order("created_at", desc=True).limit(1).execute()
-                        if ord_res.data:
-                            last_ord = ord_res.data[0]
-                            is_active_and_recent = False
-                            try:
-                                # Convertir created_at a datetime
-                                ord_ts = last_ord["created_at"].replace('Z', '+00:00')
-                                fecha_ord = datetime.fromisoformat(ord_ts)
-                                if (datetime.now(timezone.utc) - fecha_ord).total_seconds() < 7200: # 2 horas
-                                    if last_ord["status"] not in ["LISTO", "ENTREGADO", "ANULADO"]:
-                                        is_active_and_recent = True
-                            except Exception as te:
-                                logger.error(f"Error parseando fecha orden: {te}")
-
-                            if is_active_and_recent:
-                                current_order_id = last_ord["id"]
-                                order_path = f"{cust_name_clean}_{lead_db_id[:5]}/{current_order_id[:8]}"
-                            else:
-                                # Si la orden es vieja o está lista/entregada, el archivo va a /general
-                                # para que register_order lo "succione" si es una nueva orden.
-                                order_path = f"{cust_name_clean}_{lead_db_id[:5]}/general"
-                        else:
-                            order_path = f"{cust_name_clean}_{lead_db_id[:5]}/general"
-                except Exception as e:
-                    logger.error(f"Error calculando path de archivo: {e}")
+                texto = await media_queue.submit({"kind": "document", "message": real_message["documentMessage"], "jid": jid, "push_name": data.get("pushName")})
 
-                final_url, storage_path = save_media_to_supabase(b64, url_msg, mime_type, "pdf", custom_path=order_path)
-                
-                # Registrar en metadata si tenemos lead_id
-                if storage_path and 'lead_db_id' in locals():
-                    try:
-                        supabase.table("file_metadata").insert({
-                            "file_path": storage_path,
-                            "file_name": filename,
-                            "file_type": mime_type,
-                            "lead_id": lead_db_id,
-                            "order_id": current_order_id,
-                            "status": "original"
-                        }).execute()
-                    except Exception as e:
-                        logger.error(f"Error guardando metadata: {e}")
-
-                texto = f"[DOCUMENTO RECIBIDO (PDF VÁLIDO): {filename} - URL: {final_url}] {caption}"
-
-                    
         except Exception as e:
             logger.error(f"🔥 CRASH LÓGICA CONTENIDO: {e}")
             texto = "[ERROR INTERNO PROCESANDO MENSAJE - EL USUARIO ENVIÓ ALGO PERO FALLÓ EL PROCESO]"
@@ -1151,25 +1403,103 @@ async def webhook_whatsapp(request: Request):
         push_name = data.get("pushName")
 
         # --- LÓGICA DE BUFFER ---
-        if numero in message_buffer:
-            message_buffer[numero]["timer"].cancel()
-            message_buffer[numero]["messages"].append(texto)
-        else:
-            message_buffer[numero] = {"messages": [texto]}
-        
-        task = asyncio.create_task(buffer_manager(numero, push_name))
-        message_buffer[numero]["timer"] = task
+        generation = await buffer_backend.append(numero, texto, push_name, BUFFER_DELAY)
+        arm_buffer_timer(numero, generation)
         
         return {"status": "buffered"}
 
     except Exception as e:
         logger.error(f"🔥 Error Webhook: {e}")
+        # Si alcanzamos a reclamar el id, lo liberamos para que un reintento sí se procese
+        if msg_id:
+            await webhook_dedupe.release(msg_id)
         return {"status": "error"}
 
 @app.get("/")
 def health_check():
     return {"status": "ok", "service": "Whatsapp Bot & API"}
 
+@app.post("/knowledge/reload")
+async def reload_knowledge(request: Request):
+    """Recarga el índice local de la base de conocimiento (lo llama ingest.py al terminar)."""
+    if ADMIN_API_KEY and request.headers.get("x-admin-key") != ADMIN_API_KEY:
+        raise HTTPException(status_code=401, detail="No autorizado")
+    await cargar_indice_conocimiento()
+    return {"status": "success" if knowledge_index.ready else "error", "chunks": len(knowledge_index)}
+
+@app.get("/metrics")
+async def get_metrics():
+    """Contadores internos (cachés, colas) para observar el ahorro de llamadas."""
+    return {
+        "embeddings": embedding_cache.stats(),
+        "media_queue": media_queue.stats(),
+        "payloads": payload_ring.stats(),
+        "knowledge_index": {"ready": knowledge_index.ready, "chunks": len(knowledge_index)},
+        "learnings_index": {"ready": learnings_index.ready, "rules": len(learnings_index)},
+        "lead_sessions": lead_sessions.stats(),
+        "context_assembly": context_timings.stats(),
+        "prompt_cache": prompt_cache_stats.stats(),
+        "history": history_stats.stats(),
+        "fast_path": dict(fast_path_stats.stats(), mode=FAST_PATH_MODE, latency=fast_path_timings.stats()),
+        "whatsapp_send": evolution.stats(),
+        "webhook_dedupe": webhook_dedupe.stats(),
+        "inactivity": inactivity.stats(),
+        "invoices": invoice_renderer.stats(),
+        "folder_index": folder_index.stats(),
+        "blobs": blob_registry.stats(),
+        "id_index": {"leads": lead_ids.stats(), "orders": order_ids.stats()}
+    }
+
+@app.get("/debug/payloads")
+async def get_recent_payloads(request: Request, limit: int = 20):
+    """Retorna los últimos N payloads del webhook (base64 redactado). Requiere ADMIN_API_KEY."""
+    if not ADMIN_API_KEY:
+        raise HTTPException(status_code=404, detail="Not Found") # Traen teléfonos y mensajes: sin clave no se sirven
+    if request.headers.get("x-admin-key") != ADMIN_API_KEY:
+        raise HTTPException(status_code=401, detail="No autorizado")
+    return {"stats": payload_ring.stats(), "payloads": payload_ring.last(max(0, min(limit, 500)))}
+
+# --- COTIZACIONES EN LOTE ---
+class QuoteItem(BaseModel):
+    product_type: str
+    quantity: int
+    sides: int = 1
+    finish: str = "normal"
+    design_service: str = "none"
+    size: str = "estandar"
+
+class QuoteBatch(BaseModel):
+    items: List[QuoteItem]
+    include_text: bool = False
+
+@app.post("/quotes/batch")
+async def quote_batch(payload: QuoteBatch):
+    """Cotiza muchos ítems en una sola llamada (sin pasar por el LLM)."""
+    if len(payload.items) > QUOTE_BATCH_MAX:
+        raise HTTPException(status_code=413, detail=f"Máximo {QUOTE_BATCH_MAX} ítems por lote")
+    catalogo = price_catalog # Mismo catálogo para todo el lote aunque se recargue a mitad
+    resultados = catalogo.quote_many([item.dict() for item in payload.items])
+    for i, (item, r) in enumerate(zip(payload.items, resultados)):
+        r["index"] = i
+        if payload.include_text:
+            r["text"] = catalogo.format_quote(r, item.product_type, item.quantity, item.size)
+    return {
+        "status": "success",
+        "catalog_version": catalogo.version,
+        "count": len(resultados),
+        "priced": sum(1 for r in resultados if r["ok"]),
+        "total": sum(r["total"] for r in resultados),
+        "items": resultados
+    }
+
+@app.post("/quotes/reload")
+async def reload_price_catalog(request: Request):
+    """Recarga el catálogo de precios (DB o archivo) sin redeploy."""
+    if ADMIN_API_KEY and request.headers.get("x-admin-key") != ADMIN_API_KEY:
+        raise HTTPException(status_code=401, detail="No autorizado")
+    await cargar_catalogo_precios()
+    return {"status": "success", "catalog_version": price_catalog.version, "products": len(price_catalog.products)}
+
 # --- ENDPOINT NOTIFICACIÓN ESTADOS ---
 class StatusUpdate(BaseModel):
     order_id: str
@@ -1182,7 +1512,7 @@ async def notify_status_update(update: StatusUpdate):
         logger.info(f"🔔 Recibida notificación de estado: Order {update.order_id} -> {update.new_status}")
         
         # 1. Obtener datos de la orden y el cliente
-        res = supabase.table("orders").select("*, leads(name, phone_number)").eq("id", update.order_id).execute()
+        res = await supabase.table("orders").select("*, leads(name, phone_number)").eq("id", update.order_id).execute()
         if not res.data:
             logger.warning(f"⚠️ Orden {update.order_id} no encontrada en DB")
             return {"status": "error", "message": "Orden no encontrada"}
@@ -1215,10 +1545,10 @@ async def notify_status_update(update: StatusUpdate):
         
         # 3. Enviar Mensaje
         if mensaje:
-            status_envio = enviar_whatsapp(phone, mensaje)
+            status_envio = await enviar_whatsapp(phone, mensaje)
             
             # 4. GUARDAR EN EL LOG (Para rastreo)
-            save_message_pro(lead_id, phone, "assistant", mensaje, intent="NOTIFICATION_UPDATE", metadata={"whatsapp_delivery": status_envio})
+            await save_message_pro(lead_id, phone, "assistant", mensaje, intent="NOTIFICATION_UPDATE", metadata={"whatsapp_delivery": status_envio})
             
             return {"status": "sent", "message": mensaje, "delivery": status_envio}
         else:
@@ -1228,12 +1558,26 @@ async def notify_status_update(update: StatusUpdate):
     except Exception as e:
         logger.error(f"🔥 Error en notify_status_update: {e}")
         return {"status": "error", "detail": str(e)}
+# --- FACTURAS (render en ProcessPool + caché de PDFs) ---
+invoice_renderer = InvoiceRenderer(
+    workers=int(os.getenv("INVOICE_WORKERS", "2")),
+    cache_items=int(os.getenv("INVOICE_CACHE_ITEMS", "256"))
+)
+
+@app.on_event("startup")
+async def start_invoice_renderer():
+    invoice_renderer.start()
+
+@app.on_event("shutdown")
+async def stop_invoice_renderer():
+    invoice_renderer.shutdown()
+
 @app.post("/generate_invoice")
 async def generate_invoice(update: StatusUpdate):
     """Genera un PDF de factura proforma y lo envía por WhatsApp."""
     try:
         # 1. Obtener datos
-        res = supabase.table("orders").select("*, leads(*)").eq("id", update.order_id).execute()
+        res = await supabase.table("orders").select("*, leads(*)").eq("id", update.order_id).execute()
         if not res.data:
             return {"status": "error", "message": "Orden no encontrada"}
         
@@ -1245,64 +1589,18 @@ async def generate_invoice(update: StatusUpdate):
         phone = lead['phone_number']
         nombre_cliente = lead.get('name', 'Cliente')
         
-        # 2. Generar PDF en Memoria
-        buffer = BytesIO()
-        p = canvas.Canvas(buffer, pagesize=LETTER)
-        width, height = LETTER
-
-        # Logo / Encabezado
-        p.setFont("Helvetica-Bold", 16)
-        p.drawString(2*cm, height-2*cm, "PITRÓN BEÑA IMPRESIÓN")
-        p.setFont("Helvetica", 10)
-        p.drawString(2*cm, height-2.5*cm, "Arturo Prat 230, Local 117, Santiago")
-        p.drawString(2*cm, height-3*cm, "RUT: 15.355.843-4")
-        
-        p.setFont("Helvetica-Bold", 14)
-        p.drawRightString(width-2*cm, height-2*cm, "FACTURA PROFORMA")
-        p.setFont("Helvetica", 10)
-        p.drawRightString(width-2*cm, height-2.5*cm, f"Orden: #{order['id'][:8]}")
-        p.drawRightString(width-2*cm, height-3*cm, f"Fecha: {order['created_at'][:10]}")
-
-        # Datos Cliente
-        p.line(2*cm, height-4*cm, width-2*cm, height-4*cm)
-        p.setFont("Helvetica-Bold", 11)
-        p.drawString(2*cm, height-4.8*cm, "DATOS DEL CLIENTE:")
-        p.setFont("Helvetica", 10)
-        p.drawString(2*cm, height-5.4*cm, f"Nombre: {nombre_cliente}")
-        p.drawString(2*cm, height-6*cm, f"RUT: {lead.get('rut', 'No informado')}")
-        p.drawString(2*cm, height-6.6*cm, f"Email: {lead.get('email', '--')}")
-
-        # Detalle
-        p.line(2*cm, height-7.5*cm, width-2*cm, height-7.5*cm)
-        p.setFont("Helvetica-Bold", 11)
-        p.drawString(2*cm, height-8.2*cm, "DESCRIPCIÓN")
-        p.drawRightString(width-2*cm, height-8.2*cm, "TOTAL (IVA INC.)")
-        
-        p.setFont("Helvetica", 10)
-        p.drawString(2*cm, height-9.2*cm, order.get('description', 'Servicio de Impresión'))
-        p.drawRightString(width-2*cm, height-9.2*cm, f"${order.get('total_amount', 0):,}")
-
-        # Pie de página / Transferencia
-        p.line(2*cm, 4*cm, width-2*cm, 4*cm)
-        p.setFont("Helvetica-Bold", 10)
-        p.drawString(2*cm, 3.4*cm, "DATOS DE TRANSFERENCIA:")
-        p.setFont("Helvetica", 9)
-        p.drawString(2*cm, 2.9*cm, "Banco Santander - Cta Corriente 79-63175-2")
-        p.drawString(2*cm, 2.4*cm, "Luis Pitron - RUT 15.355.843-4 - contacto@pitron.cl")
-
-        p.showPage()
-        p.save()
-        
-        pdf_bytes = buffer.getvalue()
-        buffer.close()
+        # 2. Generar PDF en un proceso worker (o desde la caché si la orden no cambió)
+        pdf_bytes, desde_cache = await invoice_renderer.render(invoice_fields(order, lead))
+        if desde_cache:
+            logger.info(f"♻️ Factura {order['id'][:8]} servida desde caché")
 
         # 3. Enviar por WhatsApp
         filename = f"Factura_PB_{order['id'][:6]}.pdf"
         caption = f"📄 Hola {nombre_cliente.split(' ')[0]}, adjuntamos la factura proforma de tu pedido."
-        status_wa = enviar_documento_wa(phone, pdf_bytes, filename, caption)
+        status_wa = await enviar_documento_wa(phone, pdf_bytes, filename, caption)
 
         # 4. Log
-        save_message_pro(lead['id'], phone, "assistant", f"[ARCHIVO ENVIADO: {filename}]", intent="INVOICE_GENERATION", metadata={"whatsapp_delivery": status_wa})
+        await save_message_pro(lead['id'], phone, "assistant", f"[ARCHIVO ENVIADO: {filename}]", intent="INVOICE_GENERATION", metadata={"whatsapp_delivery": status_wa})
 
         return {"status": "success", "wa_status": status_wa}
 
@@ -1314,12 +1612,35 @@ class OrderStatusUpdate(BaseModel):
     order_id: str
     new_status: str
 
+ESTADO_EMOJIS = {
+    "NUEVO": "🆕",
+    "DISEÑO": "🎨",
+    "PRODUCCIÓN": "⚙️",
+    "LISTO": "✅",
+    "ENTREGADO": "🚀"
+}
+
+def mensaje_estado_orden(name: str, order_id: str, new_status: str) -> str:
+    """Mensaje de WhatsApp para un cambio de estado (compartido por el endpoint individual y el masivo)."""
+    emoji = ESTADO_EMOJIS.get(new_status, "ℹ️")
+    msg = f"Hola {name.split(' ')[0]}! 👋\nActualización de tu pedido *#{order_id[:5]}*:\n\nNuevo Estado: *{new_status}* {emoji}\n\n"
+    
+    if new_status == "LISTO":
+        msg += "¡Tu pedido está listo para retiro o despacho! 📦✨ Avísanos cuando vendrás."
+    elif new_status == "DISEÑO":
+        msg += "Estamos trabajando en tu diseño. Pronto te enviaremos una propuesta. 🎨"
+    elif new_status == "PRODUCCIÓN":
+        msg += "Tu pedido ha entrado a máquinas. ¡Ya falta poco! 🖨️"
+    elif new_status == "ENTREGADO":
+        msg += "¡Que lo disfrutes! Gracias por confiar en Pitrón Beña. ⭐"
+    return msg
+
 @app.post("/orders/update_status")
 async def update_order_status(payload: OrderStatusUpdate):
     """Actualiza estado de orden y notifica al cliente por WhatsApp"""
     try:
         # 1. Obtener datos de la orden + lead
-        order_res = supabase.table("orders").select("*, leads(phone_number, name, id)").eq("id", payload.order_id).execute()
+        order_res = await supabase.table("orders").select("*, leads(phone_number, name, id)").eq("id", payload.order_id).execute()
         if not order_res.data:
             return {"status": "error", "message": "Orden no encontrada"}
         
@@ -1329,35 +1650,17 @@ async def update_order_status(payload: OrderStatusUpdate):
         name = lead.get("name") or "Cliente"
         
         # 2. Actualizar en BD
-        supabase.table("orders").update({"status": payload.new_status}).eq("id", payload.order_id).execute()
+        await supabase.table("orders").update({"status": payload.new_status}).eq("id", payload.order_id).execute()
         
         # 3. Notificar por WhatsApp (Si tiene teléfono)
         if phone:
-            emojis = {
-                "NUEVO": "🆕",
-                "DISEÑO": "🎨",
-                "PRODUCCIÓN": "⚙️",
-                "LISTO": "✅",
-                "ENTREGADO": "🚀"
-            }
-            emoji = emojis.get(payload.new_status, "ℹ️")
-            
-            msg = f"Hola {name.split(' ')[0]}! 👋\nActualización de tu pedido *#{payload.order_id[:5]}*:\n\nNuevo Estado: *{payload.new_status}* {emoji}\n\n"
-            
-            if payload.new_status == "LISTO":
-                msg += "¡Tu pedido está listo para retiro o despacho! 📦✨ Avísanos cuando vendrás."
-            elif payload.new_status == "DISEÑO":
-                msg += "Estamos trabajando en tu diseño. Pronto te enviaremos una propuesta. 🎨"
-            elif payload.new_status == "PRODUCCIÓN":
-                msg += "Tu pedido ha entrado a máquinas. ¡Ya falta poco! 🖨️"
-            elif payload.new_status == "ENTREGADO":
-                msg += "¡Que lo disfrutes! Gracias por confiar en Pitrón Beña. ⭐"
+            msg = mensaje_estado_orden(name, payload.order_id, payload.new_status)
             
-            status_wa = enviar_whatsapp(phone, msg)
+            status_wa = await enviar_whatsapp(phone, msg)
             
             # Guardar log del mensaje
             if lead.get("id"):
-                save_message_pro(lead.get("id"), phone, "assistant", msg, intent="STATUS_UPDATE", metadata={"whatsapp_delivery": status_wa})
+                await save_message_pro(lead.get("id"), phone, "assistant", msg, intent="STATUS_UPDATE", metadata={"whatsapp_delivery": status_wa})
 
         return {"status": "success", "notified": bool(phone)}
 
@@ -1365,6 +1668,84 @@ async def update_order_status(payload: OrderStatusUpdate):
         logger.error(f"Error actualizando estado: {e}")
         return {"status": "error", "message": str(e)}
 
+# --- ACTUALIZACIÓN MASIVA DE ESTADOS ---
+BULK_STATUS_MAX = int(os.getenv("BULK_STATUS_MAX", "200"))
+BULK_NOTIFY_CONCURRENCY = int(os.getenv("BULK_NOTIFY_CONCURRENCY", "8"))
+
+class BulkStatusUpdate(BaseModel):
+    order_ids: List[str]
+    new_status: str
+
+async def notificar_estados(ordenes: List[dict], new_status: str, salida: asyncio.Queue):
+    """Envía las notificaciones (concurrencia acotada, la cola de Evolution ordena por número) y guarda los logs en un solo insert."""
+    semaforo = asyncio.Semaphore(BULK_NOTIFY_CONCURRENCY)
+    logs: List[dict] = []
+
+    async def notificar(order: dict) -> dict:
+        lead = order.get("leads") or {}
+        phone = lead.get("phone_number")
+        if not phone:
+            return {"type": "result", "order_id": order["id"], "status": "success", "notified": False}
+        msg = mensaje_estado_orden(lead.get("name") or "Cliente", order["id"], new_status)
+        async with semaforo:
+            status_wa = await enviar_whatsapp(phone, msg)
+        if lead.get("id"):
+            logs.append({"lead_id": lead["id"], "phone_number": phone, "role": "assistant", "content": msg,
+                         "intent": "STATUS_UPDATE", "tokens_used": None, "metadata": {"whatsapp_delivery": status_wa}})
+        return {"type": "result", "order_id": order["id"], "status": "success", "notified": True,
+                "delivery": status_wa.get("status")}
+
+    try:
+        for siguiente in asyncio.as_completed([notificar(o) for o in ordenes]):
+            await salida.put(await siguiente)
+        if logs:
+            await save_messages_bulk(logs)
+    finally:
+        await salida.put(None) # Fin del stream
+
+@app.post("/orders/bulk_update_status")
+async def bulk_update_order_status(payload: BulkStatusUpdate):
+    """Actualiza el estado de varias órdenes en una sola sentencia y notifica a los clientes.
+
+    Responde NDJSON: una línea `start`, una `result` por orden (a medida que sale cada
+    notificación) y una `done` al final. Si el dashboard se desconecta, los envíos y
+    los logs se completan igual.
+    """
+    try:
+        order_ids = list(dict.fromkeys(payload.order_ids)) # Sin duplicados, en el orden pedido
+        if len(order_ids) > BULK_STATUS_MAX:
+            return {"status": "error", "message": f"Máximo {BULK_STATUS_MAX} órdenes por llamada"}
+
+        # 1. Una lectura y una escritura para todo el lote
+        order_res = await supabase.table("orders").select("id, leads(phone_number, name, id)").in_("id", order_ids).execute()
+        ordenes = order_res.data or []
+        encontradas = {o["id"] for o in ordenes}
+        if encontradas:
+            await supabase.table("orders").update({"status": payload.new_status}).in_("id", list(encontradas)).execute()
+    except Exception as e:
+        logger.error(f"Error actualizando estados en lote: {e}")
+        return {"status": "error", "message": str(e)}
+
+    logger.info(f"📦 {len(encontradas)} órdenes -> {payload.new_status}")
+    salida: asyncio.Queue = asyncio.Queue()
+    en_segundo_plano(notificar_estados(ordenes, payload.new_status, salida), "notificaciones de estado en lote")
+
+    async def stream():
+        yield json.dumps({"type": "start", "requested": len(order_ids), "updated": len(encontradas), "new_status": payload.new_status}) + "\n"
+        for order_id in order_ids:
+            if order_id not in encontradas:
+                yield json.dumps({"type": "result", "order_id": order_id, "status": "error", "message": "Orden no encontrada"}) + "\n"
+        notificadas = 0
+        while True:
+            linea = await salida.get()
+            if linea is None:
+                break
+            notificadas += linea["notified"]
+            yield json.dumps(linea, ensure_ascii=False) + "\n"
+        yield json.dumps({"type": "done", "updated": len(encontradas), "notified": notificadas}) + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
 # --- ENDPOINTS HUMAN TAKEOVER ---
 
 class ManualChatPayload(BaseModel):
@@ -1376,22 +1757,22 @@ async def send_manual_message(payload: ManualChatPayload):
     """Envía un mensaje manual desde el Dashboard"""
     try:
         # 1. Obtener teléfono del lead
-        lead_res = supabase.table("leads").select("phone_number").eq("id", payload.lead_id).execute()
+        lead_res = await supabase.table("leads").select("phone_number").eq("id", payload.lead_id).execute()
         if not lead_res.data:
             return {"status": "error", "message": "Lead no encontrado"}
         
         phone = lead_res.data[0]["phone_number"]
         
         # 2. Enviar por WhatsApp
-        status_wa = enviar_whatsapp(phone, payload.content)
+        status_wa = await enviar_whatsapp(phone, payload.content)
         
         # 3. Guardar en historial
-        save_message_pro(payload.lead_id, phone, "assistant", payload.content, intent="HUMAN_RESPONSE", metadata={"manual": True, "whatsapp_delivery": status_wa})
+        await save_message_pro(payload.lead_id, phone, "assistant", payload.content, intent="HUMAN_RESPONSE", metadata={"manual": True, "whatsapp_delivery": status_wa})
         
+        lead_sessions.invalidate(lead_id=payload.lead_id)
+
         # 4. Manejar timers de inactividad (Para que el bot no interrumpa al humano)
-        if phone in inactivity_timers:
-            inactivity_timers[phone].cancel()
-        inactivity_timers[phone] = asyncio.create_task(inactivity_manager(phone, payload.lead_id))
+        iniciar_inactividad(phone, payload.lead_id) # Re-arma (reemplaza el timer anterior)
 
         return {"status": "success"}
     except Exception as e:
@@ -1406,7 +1787,8 @@ class AIToggle(BaseModel):
 async def toggle_ai(payload: AIToggle):
     """Activa o desactiva la IA para un cliente específico"""
     try:
-        supabase.table("leads").update({"ai_enabled": payload.enabled}).eq("id", payload.lead_id).execute()
+        await supabase.table("leads").update({"ai_enabled": payload.enabled}).eq("id", payload.lead_id).execute()
+        lead_sessions.invalidate(lead_id=payload.lead_id)
         
         # Log de auditoría básico
         logger.info(f"🔄 IA para Lead {payload.lead_id} cambiada a: {payload.enabled}")
@@ -1424,7 +1806,7 @@ async def sync_lead_picture(payload: dict):
         if not lead_id:
             return {"status": "error", "message": "Falta lead_id"}
         
-        res = supabase.table("leads").select("phone_number").eq("id", lead_id).execute()
+        res = await supabase.table("leads").select("phone_number").eq("id", lead_id).execute()
         if not res.data:
             return {"status": "error", "message": "Lead no encontrado"}
         
@@ -1433,15 +1815,16 @@ async def sync_lead_picture(payload: dict):
         clean_phone = "".join(filter(str.isdigit, phone))
         
         # 1. Intentar con número limpio
-        pic_url = get_whatsapp_profile_picture(clean_phone)
+        pic_url = await get_whatsapp_profile_picture(clean_phone)
         
         # 2. Fallback con @s.whatsapp.net si falló
         if not pic_url:
             logger.info(f"🔄 Reintentando con suffix JID para {clean_phone}...")
-            pic_url = get_whatsapp_profile_picture(f"{clean_phone}@s.whatsapp.net")
+            pic_url = await get_whatsapp_profile_picture(f"{clean_phone}@s.whatsapp.net")
         
         if pic_url:
-            supabase.table("leads").update({"profile_picture_url": pic_url}).eq("id", lead_id).execute()
+            await supabase.table("leads").update({"profile_picture_url": pic_url}).eq("id", lead_id).execute()
+            lead_sessions.update(lead_id, {"profile_picture_url": pic_url})
             return {"status": "success", "profile_picture_url": pic_url}
         else:
             # Aquí podríamos haber capturado un error más específico en get_whatsapp_profile_picture
@@ -1456,24 +1839,71 @@ async def sync_lead_picture(payload: dict):
 
 # --- ENDPOINTS PITRONB DRIVE ---
 
+# Índice de carpetas en memoria (agregados por carpeta, ETag por versión)
+folder_index = FolderIndex()
+STORAGE_PAGE_MAX = int(os.getenv("STORAGE_PAGE_MAX", "500"))
+
+async def cargar_indice_carpetas():
+    """Reconcilia el índice de carpetas con file_metadata (sólo aplica las diferencias)."""
+    try:
+        rows = await fetch_all_rows("file_metadata", "*, leads(name)", is_deleted=False)
+        folder_index.reconcile(rows)
+        logger.info(f"🗂️ Índice de carpetas reconciliado: {len(folder_index)} archivos")
+    except Exception as e:
+        logger.error(f"⚠️ No se pudo cargar el índice de carpetas: {e}")
+
+@app.on_event("startup")
+async def load_folder_index():
+    await cargar_indice_carpetas()
+
 @app.get("/storage/tree")
 async def get_storage_tree():
-    """Retorna la jerarquía de archivos para el explorador."""
+    """Retorna la jerarquía de archivos para el explorador (lista plana; preferir /storage/folders)."""
     try:
+        if folder_index.ready:
+            return folder_index.rows()
         # Obtenemos toda la metadata
-        res = supabase.table("file_metadata").select("*, leads(name)").eq("is_deleted", False).execute()
+        res = await supabase.table("file_metadata").select("*, leads(name)").eq("is_deleted", False).execute()
         return res.data
     except Exception as e:
         logger.error(f"Error en storage tree: {e}")
         return []
 
+@app.get("/storage/folders")
+async def list_storage_folder(request: Request, path: str = "", cursor: Optional[str] = None, limit: int = 100):
+    """Hijos directos de `path` (carpetas con conteo y tamaño, luego archivos), paginados por cursor.
+
+    Responde 304 si el `If-None-Match` coincide con la versión actual de la carpeta,
+    y comprime con gzip si el cliente lo acepta.
+    """
+    if not folder_index.ready:
+        await cargar_indice_carpetas()
+    folder = folder_index.folder(path)
+    etag = folder_index.etag(folder)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"} # El navegador revalida siempre (barato: 304)
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    try:
+        listing = folder_index.list(path, cursor=cursor, limit=max(1, min(limit, STORAGE_PAGE_MAX)))
+    except (ValueError, TypeError) as e:
+        return Response(content=json.dumps({"status": "error", "message": f"Cursor inválido: {e}"}), status_code=400, media_type="application/json")
+    body = json.dumps(listing, ensure_ascii=False, default=str).encode("utf-8")
+    if len(body) > 1024 and "gzip" in request.headers.get("accept-encoding", ""):
+        body = gzip.compress(body, compresslevel=5)
+        headers["Content-Encoding"] = "gzip"
+        headers["Vary"] = "Accept-Encoding"
+    return Response(content=body, media_type="application/json", headers=headers)
+
 @app.post("/storage/update_metadata")
 async def update_storage_metadata(payload: dict):
     """Actualiza etiquetas o estado de un archivo."""
     try:
         file_id = payload.get("id")
         update_data = payload.get("data", {})
-        res = supabase.table("file_metadata").update(update_data).eq("id", file_id).execute()
+        res = await supabase.table("file_metadata").update(update_data).eq("id", file_id).execute()
+        lead_sessions.invalidate_pending_files()
+        for row in res.data or []:
+            folder_index.upsert(row)
         return {"status": "success", "data": res.data}
     except Exception as e:
         return {"status": "error", "message": str(e)}
@@ -1487,7 +1917,9 @@ async def delete_file(payload: dict):
              return {"status": "error", "message": "ID requerido"}
              
         # Soft delete en DB
-        res = supabase.table("file_metadata").update({"is_deleted": True}).eq("id", file_id).execute()
+        res = await supabase.table("file_metadata").update({"is_deleted": True}).eq("id", file_id).execute()
+        lead_sessions.invalidate_pending_files()
+        folder_index.remove(file_id)
         
         logger.info(f"🗑️ Archivo eliminado (Soft Delete): {file_id}")
         return {"status": "success", "data": res.data}
@@ -1495,29 +1927,162 @@ async def delete_file(payload: dict):
         logger.error(f"Error eliminando archivo: {e}")
         return {"status": "error", "message": str(e)}
 
+# --- RESOLUCIÓN DE IDS CORTOS (carpetas Cliente_fe5d0/1a2b3c4d) ---
+lead_ids = PrefixIndex("leads", LEAD_PREFIX_LEN)
+order_ids = PrefixIndex("orders", ORDER_PREFIX_LEN)
+ID_MISS_TTL = float(os.getenv("ID_MISS_TTL", "300")) # Segundos que un prefijo inexistente no vuelve a consultarse
+
+async def cargar_indice_ids():
+    """Carga (o reconcilia) los IDs de leads y órdenes para resolver prefijos de carpeta en memoria."""
+    try:
+        leads = await fetch_all_rows("leads", "id, name")
+        orders = await fetch_all_rows("orders", "id, lead_id")
+        lead_ids.load((r["id"], clean_name(r.get("name"))) for r in leads)
+        order_ids.load((r["id"], r.get("lead_id")) for r in orders)
+        logger.info(f"🔑 Índice de IDs cargado: {len(lead_ids)} leads, {len(order_ids)} órdenes "
+                    f"(colisiones de prefijo: {lead_ids.collisions}/{order_ids.collisions})")
+    except Exception as e:
+        logger.error(f"⚠️ No se pudo cargar el índice de IDs: {e}")
+
+@app.on_event("startup")
+async def load_id_index():
+    await cargar_indice_ids()
+
+async def resolver_id(indice: PrefixIndex, tabla: str, prefijo: Optional[str], etiqueta: Optional[str] = None) -> Optional[str]:
+    """Prefijo de carpeta -> ID completo. Ambiguo = None (no adivinamos).
+
+    Si el índice no lo tiene (p.ej. lo creó otro worker desde la última carga) se hace
+    una única consulta por rango de `id` y el resultado queda en el índice. Los fallos
+    se recuerdan ID_MISS_TTL segundos (o hasta la próxima carga del índice), así una
+    carpeta que no corresponde a ningún ID no consulta la DB en cada subida.
+    """
+    if not prefijo or indice.known_miss(prefijo):
+        return None
+    try:
+        encontrado = indice.resolve(prefijo, etiqueta)
+    except AmbiguousPrefix as e:
+        logger.warning(f"⚠️ {e} en {tabla}: {e.candidates}")
+        return None
+    if encontrado:
+        return encontrado
+    rango = uuid_bounds(prefijo)
+    if rango is None:
+        # No es hex (p.ej. "documentos" de archivos/Mis_Documentos): no puede ser un ID
+        indice.add_miss(prefijo, ID_MISS_TTL)
+        return None
+    try:
+        tag_col = "name" if tabla == "leads" else "lead_id"
+        res = await supabase.table(tabla).select(f"id, {tag_col}").gte("id", rango[0]).lte("id", rango[1]).limit(2).execute()
+        for row in res.data or []:
+            indice.add(row["id"], clean_name(row.get("name")) if tabla == "leads" else row.get("lead_id"))
+        if not res.data:
+            indice.add_miss(prefijo, ID_MISS_TTL)
+            return None
+        return indice.resolve(prefijo, etiqueta)
+    except AmbiguousPrefix as e:
+        logger.warning(f"⚠️ {e} en {tabla}: {e.candidates}")
+    except Exception as e:
+        logger.warning(f"⚠️ Falló búsqueda de {tabla} por ID parcial: {e}")
+    return None
+
+# --- SUBIDAS EN STREAMING ---
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_MB", "300")) * 1024 * 1024
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_KB", "1024")) * 1024
+
+class UploadTooLarge(Exception):
+    pass
+
+async def hash_upload(source: UploadFile) -> Tuple[int, str]:
+    """Única pasada de hash sobre el archivo ya recibido (Starlette lo tiene en disco): tamaño y sha256, memoria constante.
+
+    Se hace antes de subir para poder saltarse la subida si el blob ya existe.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = await source.read(UPLOAD_CHUNK_BYTES)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > UPLOAD_MAX_BYTES:
+            raise UploadTooLarge(f"El archivo supera el máximo de {UPLOAD_MAX_BYTES // (1024 * 1024)} MB")
+        digest.update(chunk)
+    await source.seek(0)
+    return size, digest.hexdigest()
+
+async def subir_stream_storage(bucket: str, path: str, source: UploadFile, mime: str, upsert: bool = True,
+                               content_hash: Optional[str] = None) -> Tuple[int, str]:
+    """Sube `source` por chunks a la API REST de Storage; retorna (bytes, sha256) calculados al vuelo.
+
+    Memoria constante por subida (un chunk). Si se supera UPLOAD_MAX_BYTES se corta el
+    envío a mitad de camino y Storage descarta el objeto incompleto. Si el llamador ya
+    tiene el sha256 (`content_hash`), no se vuelve a calcular.
+    """
+    digest = hashlib.sha256() if content_hash is None else None
+    size = 0
+
+    async def chunks():
+        nonlocal size
+        while True:
+            chunk = await source.read(UPLOAD_CHUNK_BYTES)
+            if not chunk:
+                return
+            size += len(chunk)
+            if size > UPLOAD_MAX_BYTES:
+                raise UploadTooLarge(f"El archivo supera el máximo de {UPLOAD_MAX_BYTES // (1024 * 1024)} MB")
+            if digest is not None:
+                digest.update(chunk)
+            yield chunk
+
+    headers = {
+        "Authorization": f"Bearer {SUPABASE_KEY}",
+        "apikey": SUPABASE_KEY,
+        "Content-Type": mime,
+        "x-upsert": "true" if upsert else "false"
+    }
+    url = f"{SUPABASE_URL}/storage/v1/object/{bucket}/{quote(path)}"
+    try:
+        response = await http_client.post(url, content=chunks(), headers=headers, timeout=httpx.Timeout(60.0))
+    except Exception:
+        if size > UPLOAD_MAX_BYTES:
+            raise UploadTooLarge(f"El archivo supera el máximo de {UPLOAD_MAX_BYTES // (1024 * 1024)} MB")
+        raise
+    if response.status_code not in (200, 201):
+        raise Exception(f"Storage Error ({response.status_code}): {response.text}")
+    return size, digest.hexdigest() if digest is not None else content_hash
+
 @app.post("/storage/upload")
 async def upload_file(file: UploadFile = File(...), path: str = Form(...)):
-    """Sube un archivo manualmente desde el Dashboard."""
+    """Sube un archivo manualmente desde el Dashboard (en streaming, sin cargarlo entero en RAM)."""
     import traceback
     try:
-        content = await file.read()
-        size_bytes = len(content)
         mime_type = file.content_type or "application/octet-stream"
+        # Starlette ya conoce el tamaño del multipart: rechazamos antes de subir nada
+        if file.size is not None and file.size > UPLOAD_MAX_BYTES:
+            raise UploadTooLarge(f"El archivo supera el máximo de {UPLOAD_MAX_BYTES // (1024 * 1024)} MB")
         
         # Path format: archivos/Customer_Name_LeadID/OrderID or archivos/Customer_Name_LeadID/general
         clean_path = path.strip("/")
         full_path = f"{clean_path}/{file.filename}"
         
-        logger.info(f"📁 [UPLOAD] Intentando: {full_path} ({size_bytes} bytes)")
+        logger.info(f"📁 [UPLOAD] Intentando: {full_path} ({file.size} bytes)")
         
-        # 1. Subir a Supabase Storage
+        # 1. Hash del contenido (lectura local) y subida del blob sólo si el bucket no lo tiene ya
+        size_bytes, content_hash = await hash_upload(file)
+        blob_path = await buscar_blob(content_hash)
         try:
-            # Intentar con upsert como string "true" que es lo estándar para headers HTTP
-            supabase.storage.from_("chat-media").upload(
-                full_path, 
-                content, 
-                {"content-type": mime_type, "upsert": "true"} 
-            )
+            if blob_path:
+                blob_registry.record(size_bytes, reused=True)
+                logger.info(f"♻️ [UPLOAD] Contenido ya existente, se reutiliza {blob_path}")
+            else:
+                ext = file.filename.rsplit(".", 1)[-1] if "." in (file.filename or "") else "bin"
+                blob_path = blob_path_for(content_hash, ext)
+                # El sha256 ya está calculado: la subida sólo lee y envía los chunks
+                await subir_stream_storage("chat-media", blob_path, file, mime_type, upsert=False, content_hash=content_hash)
+                blob_registry.add(content_hash, blob_path)
+                blob_registry.record(size_bytes, reused=False)
+        except UploadTooLarge:
+            raise
         except Exception as storage_err:
             str_err = str(storage_err).lower()
             # Si el error es "new row violates row-level security policy", 
@@ -1530,54 +2095,18 @@ async def upload_file(file: UploadFile = File(...), path: str = Form(...)):
                 # Si existe, asumimos éxito parcial y continuamos para registrar metadata
                 # Podríamos intentar listar para ver si está?
                 pass 
-            elif "already exists" in str_err:
-                 logger.warning(f"⚠️ El archivo ya existe: {full_path}")
+            elif is_duplicate_error(str_err):
+                 # Mismo contenido subido en paralelo: el blob ya es el correcto
+                 logger.warning(f"⚠️ El blob ya existe: {blob_path}")
+                 blob_registry.add(content_hash, blob_path)
             else:
                 logger.error(f"❌ Error crítico en Storage: {storage_err}")
                 raise Exception(f"Storage Error: {str(storage_err)}")
         
-        # 2. Extraer IDs para metadata
-        parts = clean_path.split('/') 
-        lead_id = None
-        order_id = None
-        
-        if len(parts) >= 2:
-            lead_segment = parts[1]
-            if "_" in lead_segment:
-                lead_id_hint = lead_segment.split("_")[-1]
-                # FIX: UUID column cannot use ilike directly without casting to text
-                # We use .ilike("id::text", pattern) if supported, or filter on client side?
-                # Safer: Supabase client filter syntax .ilike("id::text", ...) might fail if not exposed efficiently.
-                # Actually, the error `operator does not exist: uuid ~~* unknown` means we are trying to ILIKE a UUID.
-                # We need to explicitly cast. Or search by other field? Name?
-                # Since 'lead_id_hint' is just a prefix (fe5d0), we MUST use text casting.
-                
-                # NOTE: PostgREST syntax for casting is usually column::type.
-                # But python library might not support it directly in the key string easily.
-                # Let's try explicit casting via filter modifier if possible, or use `or` filter.
-                
-                # ALTERNATIVE: Don't use ID prefix. Use the NAME if unique enough?
-                # "FrancoBlanco_fe5d0". Name = FrancoBlanco.
-                # But name is not unique. ID prefix is better.
-                
-                # Correct PostgREST way for casting: "id::text"
-                try:
-                    leads_res = supabase.table("leads").select("id").ilike("id::text", f"{lead_id_hint}%").execute()
-                    if leads_res.data:
-                        lead_id = leads_res.data[0]["id"]
-                except Exception as e_lead:
-                    logger.warning(f"⚠️ Falló búsqueda de Lead por ID parcial: {e_lead}")
-
-        if len(parts) >= 3:
-            order_segment = parts[2]
-            if order_segment != "general":
-                try:
-                    # Same fix for orders
-                    orders_res = supabase.table("orders").select("id").ilike("id::text", f"{order_segment}%").execute()
-                    if orders_res.data:
-                        order_id = orders_res.data[0]["id"]
-                except Exception as e_order:
-                    logger.warning(f"⚠️ Falló búsqueda de Orden por ID parcial: {e_order}")
+        # 2. Extraer IDs para metadata (prefijos de la carpeta -> IDs completos, sin escanear las tablas)
+        name_key, lead_prefix, order_prefix = parse_folder(clean_path)
+        lead_id = await resolver_id(lead_ids, "leads", lead_prefix, name_key)
+        order_id = await resolver_id(order_ids, "orders", order_prefix, lead_id)
 
         # 3. Insertar metadata
         data_to_insert = {
@@ -1585,19 +2114,31 @@ async def upload_file(file: UploadFile = File(...), path: str = Form(...)):
             "file_name": file.filename,
             "file_type": mime_type,
             "size_bytes": size_bytes,
+            "content_hash": content_hash,
+            "blob_path": blob_path,
             "lead_id": lead_id,
             "order_id": order_id,
             "status": "original"
         }
         
-        insert_res = supabase.table("file_metadata").insert(data_to_insert).execute()
+        insert_res = await supabase.table("file_metadata").insert(data_to_insert).execute()
         
         if not insert_res.data:
             raise Exception("No se pudo insertar la metadata en la base de datos.")
+        if lead_id:
+            lead_sessions.invalidate_pending_files(lead_id)
+        folder_index.upsert(insert_res.data[0])
 
         logger.info(f"✅ Subida exitosa: {full_path}")
         return {"status": "success", "data": insert_res.data[0]}
         
+    except UploadTooLarge as e:
+        logger.warning(f"⚠️ [UPLOAD] Rechazado: {e}")
+        return Response(
+            content=json.dumps({"status": "error", "message": str(e)}),
+            status_code=413,
+            media_type="application/json"
+        )
     except Exception as e:
         err_detail = traceback.format_exc()
         logger.error(f"❌ Error en upload_file:\n{err_detail}")
@@ -1617,7 +2158,7 @@ async def update_order_payment(payload: PaymentUpdate):
     """Registra pago/abono y notifica al cliente"""
     try:
         # 1. Obtener datos actuales
-        order_res = supabase.table("orders").select("*, leads(phone_number, name, id)").eq("id", payload.order_id).execute()
+        order_res = await supabase.table("orders").select("*, leads(phone_number, name, id)").eq("id", payload.order_id).execute()
         if not order_res.data:
             return {"status": "error", "message": "Orden no encontrada"}
         
@@ -1631,7 +2172,7 @@ async def update_order_payment(payload: PaymentUpdate):
         if payload.total_amount is not None:
             upd["total_amount"] = payload.total_amount
         
-        supabase.table("orders").update(upd).eq("id", payload.order_id).execute()
+        await supabase.table("orders").update(upd).eq("id", payload.order_id).execute()
         
         # 3. Determinar incremento (abono actual)
         abono_ahora = payload.deposit_amount - old_deposit
@@ -1650,11 +2191,11 @@ async def update_order_payment(payload: PaymentUpdate):
             else:
                 msg += f"📉 Saldo pendiente: *${balance:,}*\n\n¡Gracias por tu abono! 😊"
             
-            status_wa = enviar_whatsapp(phone, msg)
+            status_wa = await enviar_whatsapp(phone, msg)
             
             # Log
             if lead.get("id"):
-                save_message_pro(lead.get("id"), phone, "assistant", msg, intent="PAYMENT_UPDATE", metadata={"whatsapp_delivery": status_wa})
+                await save_message_pro(lead.get("id"), phone, "assistant", msg, intent="PAYMENT_UPDATE", metadata={"whatsapp_delivery": status_wa})
 
             return {"status": "success", "notified": True}
         
@@ -1670,7 +2211,7 @@ async def update_order_payment(payload: PaymentUpdate):
 async def get_learnings():
     """Obtiene las lecciones aprendidas (errores y propuestas)."""
     try:
-        res = supabase.table("agent_learnings").select("*").order("created_at", desc=True).limit(50).execute()
+        res = await supabase.table("agent_learnings").select("*").order("created_at", desc=True).limit(50).execute()
         return res.data
     except Exception as e:
         logger.error(f"Error fetching learnings: {e}")
@@ -1684,14 +2225,14 @@ async def approve_learning(action: LearningAction):
     """Aprueba una regla propuesta y genera su embedding."""
     try:
         # 1. Obtener el texto de la regla
-        res = supabase.table("agent_learnings").select("proposed_rule").eq("id", action.id).execute()
+        res = await supabase.table("agent_learnings").select("proposed_rule, error_description").eq("id", action.id).execute()
         if not res.data:
             return {"status": "error", "message": "Regla no encontrada"}
         
         rule_text = res.data[0]["proposed_rule"]
         
         # 2. Generar Embedding
-        vector = get_embedding(rule_text)
+        vector = await get_embedding(rule_text)
         
         # 3. Actualizar en DB
         update_data = {
@@ -1701,7 +2242,10 @@ async def approve_learning(action: LearningAction):
         if vector:
             update_data["embedding"] = vector
             
-        supabase.table("agent_learnings").update(update_data).eq("id", action.id).execute()
+        await supabase.table("agent_learnings").update(update_data).eq("id", action.id).execute()
+
+        # 4. Actualizar el índice local sin recargarlo entero
+        learnings_index.upsert(action.id, vector, {"proposed_rule": rule_text, "error_description": res.data[0].get("error_description")})
         
         return {"status": "success"}
     except Exception as e:
@@ -1712,9 +2256,10 @@ async def approve_learning(action: LearningAction):
 async def reject_learning(action: LearningAction):
     """Rechaza una regla propuesta."""
     try:
-        supabase.table("agent_learnings").update({
+        await supabase.table("agent_learnings").update({
             "status": "rejected"
         }).eq("id", action.id).execute()
+        learnings_index.remove(action.id)
         return {"status": "success"}
     except Exception as e:
         return {"status": "error", "message": str(e)}
@@ -1740,8 +2285,8 @@ async def run_audit_job():
         # Ejecutar en un thread aparte para no bloquear el loop principal
         import asyncio
         loop = asyncio.get_event_loop()
-        await loop.run_in_executor(None, run_audit)
-        logger.info("✅ [CRON] Auditoría finalizada exitosamente.")
+        report = await loop.run_in_executor(None, run_audit)
+        logger.info(f"✅ [CRON] Auditoría finalizada exitosamente: {report}")
     except Exception as e:
         logger.error(f"❌ [CRON] Error en auditoría: {e}")
 
@@ -1752,6 +2297,14 @@ def start_scheduler():
     trigger = CronTrigger(hour=3, minute=0, timezone=chile_tz)
     
     scheduler.add_job(run_audit_job, trigger)
+    # Refresco periódico del índice local (cubre ingestas hechas con varios workers/réplicas)
+    scheduler.add_job(cargar_indice_conocimiento, "interval", minutes=int(os.getenv("KNOWLEDGE_REFRESH_MINUTES", "30")))
+    # Reconciliación de reglas cambiadas directamente en la DB (o aprobadas en otro worker)
+    scheduler.add_job(cargar_indice_reglas, "interval", minutes=int(os.getenv("LEARNINGS_RECONCILE_MINUTES", "10")))
+    # Reconciliación del índice de carpetas (subidas desde otros workers o cambios directos en la DB)
+    scheduler.add_job(cargar_indice_carpetas, "interval", minutes=int(os.getenv("FOLDER_INDEX_RECONCILE_MINUTES", "5")))
+    # Reconciliación del índice de IDs cortos (leads/órdenes creados en otros workers)
+    scheduler.add_job(cargar_indice_ids, "interval", minutes=int(os.getenv("ID_INDEX_RECONCILE_MINUTES", "30")))
     scheduler.start()
     logger.info("⏰ Scheduler iniciado: Auditoría programada para las 03:00 AM (Chile).")
 
@@ -1770,16 +2323,16 @@ async def send_custom_message_endpoint(payload: CustomMessage):
         phone = payload.phone_number.replace("+", "").replace(" ", "")
         
         # 1. Enviar por WhatsApp
-        res = enviar_whatsapp(phone, payload.message)
+        res = await enviar_whatsapp(phone, payload.message)
         
         # 2. Registrar en DB (CRÍTICO: role='assistant')
         if res.get("status") == "success":
             # Intentar obtener lead_id si no viene
             final_lead_id = payload.lead_id
             if not final_lead_id:
-                final_lead_id = get_or_create_lead(phone)
+                final_lead_id = await get_or_create_lead(phone)
             
-            save_message_pro(
+            await save_message_pro(
                 lead_id=final_lead_id, 
                 phone=phone, 
                 role="assistant", 
@@ -0,0 +1,62 @@
+"""
+Latencias por fuente dentro del turno del agente (historial, RAG, reglas, archivos...).
+
+Cada fuente acumula cuántas veces corrió, cuántas se pasaron de su presupuesto o
+fallaron, y una ventana de las últimas N duraciones para sacar p50/p95. Con eso
+/metrics muestra qué dependencia domina la latencia del turno.
+"""
+from collections import deque
+from typing import Deque, Dict
+
+
+class _SourceStats:
+    __slots__ = ("calls", "timeouts", "errors", "total_ms", "max_ms", "window")
+
+    def __init__(self, window: int):
+        self.calls = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.window: Deque[float] = deque(maxlen=window)
+
+
+def _percentile(values, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct * (len(ordered) - 1))))]
+
+
+class TurnTimings:
+    def __init__(self, window: int = 500):
+        self.window = window
+        self._sources: Dict[str, _SourceStats] = {}
+
+    def record(self, source: str, elapsed_ms: float, outcome: str = "ok"):
+        """outcome: 'ok', 'timeout' o 'error'."""
+        stats = self._sources.get(source)
+        if stats is None:
+            stats = self._sources[source] = _SourceStats(self.window)
+        stats.calls += 1
+        stats.total_ms += elapsed_ms
+        stats.max_ms = max(stats.max_ms, elapsed_ms)
+        stats.window.append(elapsed_ms)
+        if outcome == "timeout":
+            stats.timeouts += 1
+        elif outcome == "error":
+            stats.errors += 1
+
+    def stats(self) -> dict:
+        return {
+            name: {
+                "calls": s.calls,
+                "timeouts": s.timeouts,
+                "errors": s.errors,
+                "avg_ms": round(s.total_ms / s.calls, 1) if s.calls else 0.0,
+                "p50_ms": round(_percentile(s.window, 0.50), 1),
+                "p95_ms": round(_percentile(s.window, 0.95), 1),
+                "max_ms": round(s.max_ms, 1),
+            }
+            for name, s in self._sources.items()
+        }
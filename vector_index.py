@@ -0,0 +1,110 @@
+"""
+Índice vectorial en memoria (NumPy) para colecciones pequeñas de embeddings.
+
+Replica la semántica de las RPC `match_documents` / `match_learnings` de Supabase:
+similitud coseno (1 - distancia `<=>`), filtro estricto `> match_threshold`,
+orden descendente y `limit match_count`, pero en microsegundos y sin red.
+
+Cada carga construye un snapshot nuevo (matriz normalizada + items) y lo publica
+con una sola asignación, así las búsquedas concurrentes nunca ven un índice a medias.
+"""
+import json
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+def parse_vector(value: Any) -> Optional[List[float]]:
+    """PostgREST entrega las columnas pgvector como string '[0.1,0.2,...]'."""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = json.loads(value)
+    return list(value)
+
+
+class _Snapshot:
+    __slots__ = ("ids", "matrix", "items")
+
+    def __init__(self, ids: List[Any], matrix: np.ndarray, items: List[Dict]):
+        self.ids = ids
+        self.matrix = matrix
+        self.items = items
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class VectorIndex:
+    def __init__(self, name: str = "index"):
+        self.name = name
+        self._snap: Optional[_Snapshot] = None
+
+    @property
+    def ready(self) -> bool:
+        return self._snap is not None
+
+    def __len__(self) -> int:
+        return len(self._snap.ids) if self._snap else 0
+
+    def load(self, rows: Sequence[Tuple[Any, Sequence[float], Dict]]):
+        """Reemplaza el índice completo con filas (id, vector, item)."""
+        rows = [r for r in rows if r[1]]
+        if rows:
+            matrix = _normalize_rows(np.asarray([r[1] for r in rows], dtype=np.float32))
+        else:
+            matrix = np.zeros((0, 0), dtype=np.float32)
+        self._snap = _Snapshot([r[0] for r in rows], matrix, [r[2] for r in rows])
+
+    def upsert(self, item_id: Any, vector: Sequence[float], item: Dict):
+        """Agrega o reemplaza una fila sin recargar todo (copy-on-write del snapshot).
+
+        Si el índice nunca se cargó no hace nada: un índice parcial ocultaría filas
+        que sí devolvería el fallback RPC.
+        """
+        snap = self._snap
+        if snap is None or not vector:
+            return
+        row = _normalize_rows(np.asarray([vector], dtype=np.float32))
+        ids = list(snap.ids)
+        items = list(snap.items)
+        if item_id in ids:
+            i = ids.index(item_id)
+            matrix = snap.matrix.copy()
+            matrix[i] = row[0]
+            items[i] = item
+        else:
+            matrix = np.vstack([snap.matrix, row]) if ids else row
+            ids.append(item_id)
+            items.append(item)
+        self._snap = _Snapshot(ids, matrix, items)
+
+    def remove(self, item_id: Any):
+        """Quita una fila si existe (copy-on-write del snapshot)."""
+        snap = self._snap
+        if snap is None or item_id not in snap.ids:
+            return
+        i = snap.ids.index(item_id)
+        self._snap = _Snapshot(snap.ids[:i] + snap.ids[i + 1:], np.delete(snap.matrix, i, axis=0), snap.items[:i] + snap.items[i + 1:])
+
+    def search(self, vector: Sequence[float], match_threshold: float, match_count: int) -> List[Dict]:
+        """Top-k por similitud coseno con `similarity > match_threshold`."""
+        snap = self._snap
+        if snap is None or not snap.ids or not vector:
+            return []
+        query = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm == 0 or query.shape[0] != snap.matrix.shape[1]:
+            return []
+        sims = snap.matrix @ (query / norm)
+        candidates = np.nonzero(sims > match_threshold)[0]
+        if candidates.size == 0:
+            return []
+        if candidates.size > match_count:
+            top = np.argpartition(-sims[candidates], match_count - 1)[:match_count]
+            candidates = candidates[top]
+        ordered = candidates[np.argsort(-sims[candidates], kind="stable")]
+        return [dict(snap.items[i], id=snap.ids[i], similarity=float(sims[i])) for i in ordered]